@@ -11,7 +11,7 @@ from sett.utils import optional_import
 from sett.paths import ROOT
 from sett.parallel import parallel
 from sett.deploy_context import DeployContext
-from sett.task_loaders import TaskAlternative, TaskAlternativeTaskFinder
+from sett.task_loaders import TaskAlternative, TaskAlternativeTaskFinder, TaskIndex
 
 from paver.path import path
 from paver.easy import debug
@@ -44,10 +44,44 @@ def get_libs(environ=os.environ, pavement=environment.pavement):
 
 
 class SettTaskLoader(object):
-    def __init__(self, enabled_libs, disabled_libs):
+    """
+    Loads the tasks of the sett modules.
+
+    All the modules are imported when the whole list of tasks is required and
+    an index of the tasks is written in ``defaults.CACHE_DIR``. Then, as long
+    as the modules are not modified, ``find`` only imports the modules
+    defining the task that is looked for.
+    """
+    def __init__(self, alternatives, enabled_libs, disabled_libs):
+        self.alternatives = alternatives
         self.enabled_libs = enabled_libs
         self.disabled_libs = disabled_libs
         self._tasks = None
+        self._index = None
+
+    @property
+    def libs(self):
+        return sorted(lib for lib in self.enabled_libs if lib not in self.disabled_libs)
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = TaskIndex(ROOT.joinpath(defaults.CACHE_DIR, 'tasks.json'), self.signature())
+        return self._index
+
+    def signature(self):
+        """
+        Returns the mtime and the size of the source of each loaded lib
+        """
+        signature = {}
+        sett_dir = path(__file__).dirname()
+        for lib in self.libs:
+            try:
+                stat = sett_dir.joinpath(lib + '.py').stat()
+            except OSError:
+                continue
+            signature[lib] = [stat.st_mtime, stat.st_size]
+        return signature
 
     def get_tasks(self):
         if self._tasks is None:
@@ -55,18 +89,51 @@ class SettTaskLoader(object):
             self._tasks = list(self._load())
         return self._tasks
 
+    def find(self, name):
+        """
+        Imports and returns the modules defining a task or a task alternative
+        named *name*. When the index is out of date, all the modules are
+        loaded and the index is rebuilt.
+        """
+        if self._tasks is None and not self.index.load():
+            self.get_tasks()
+
+        for lib in self.index.eager_modules():
+            self._import(lib)
+
+        modules = (self._import(lib) for lib in self.index.modules(name))
+        return [module for module in modules if module is not None]
+
+    def _import(self, lib):
+        try:
+            return importlib.import_module('sett.' + lib)
+        except ImportError as ie:
+            debug('Error loading %s: %s', lib, ie)
+            return None
+
     def _load(self):
-        for enabled_lib in self.enabled_libs:
-            if enabled_lib in self.disabled_libs:
+        modules = {}
+        eager = []
+        for lib in self.libs:
+            finders_count = len(environment.task_finders)
+            module = self._import(lib)
+            if module is None:
                 continue
-            try:
-                module = importlib.import_module('sett.' + enabled_lib)
-                for var in vars(module).values():
-                    if isinstance(var, Task):
-                        yield var
-            except ImportError as ie:
-                debug('Error loading %s: %s', module, ie)
-                pass
+
+            if len(environment.task_finders) != finders_count:
+                eager.append(lib)
+
+            modules[lib] = [var for var in vars(module).values() if isinstance(var, Task)]
+            for task in modules[lib]:
+                yield task
+
+        alternatives = []
+        for name, weight, task in self.alternatives.items():
+            package, _, lib = task.func.__module__.partition('.')
+            if package == 'sett' and lib in modules:
+                alternatives.append((name, weight, lib))
+
+        self.index.update(modules, alternatives, eager)
 
 
 class SettTaskFinder(object):
@@ -76,8 +143,18 @@ class SettTaskFinder(object):
     def get_tasks(self):
         return self.loader.get_tasks()
 
-    def get_task(self, task):
-        return
+    def get_task(self, name):
+        tasks = set(task
+                    for module in self.loader.find(name)
+                    for task in vars(module).values()
+                    if isinstance(task, Task) and task.shortname == name)
+        if len(tasks) != 1:
+            # Not found or ambiguous, let paver decide
+            return None
+
+        task, = tasks
+        debug('Found %s: %s', task.name, task.description)
+        return task
 
 
 class SettModule(object):
@@ -154,7 +231,7 @@ def install_init():
 sys.modules['sett'] = SettModule(sys.modules['sett'])
 sys.path.append(ROOT)
 task_alternative = TaskAlternative(environment)
-loader = SettTaskLoader(*get_libs())
+loader = SettTaskLoader(task_alternative, *get_libs())
 
 
 install_init()
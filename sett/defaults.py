@@ -5,6 +5,15 @@ import os
 
 USE_THREADING = os.environ.get('LINEAR', 'no').lower() != 'yes'
 
+# The implementation of @parallel: threaded or process
+PARALLEL_BACKEND = os.environ.get('SETT_PARALLEL_BACKEND', 'threaded')
+
+# The default number of workers of @parallel, an integer or auto for the number of CPUs
+PARALLEL_JOBS = os.environ.get('SETT_PARALLEL_JOBS', 4)
+
+# The directory in which sett keeps its caches, absolute or relative to ROOT
+CACHE_DIR = os.environ.get('SETT_CACHE_DIR', 'var/cache/sett')
+
 HTTP_WSGI_IP = 'localhost'
 HTTP_WSGI_PORT = 8000
 STATIC_SERVER = 'nginx'
@@ -28,6 +37,10 @@ PYPI_PACKAGE_INDEX = 'https://enixpi.enix.org/simple/'
 PYPI_PACKAGE_INDEX_IGNORE_SSL = False
 
 
+# The backend of the file watchers: auto, inotify or watchdog
+WATCH_BACKEND = os.environ.get('SETT_WATCH_BACKEND', 'auto')
+
+
 # The name of the directory containing compass sass sources
 SASS_SRC_DIR = COMPASS_DIR = 'compass/'
 
@@ -37,8 +50,17 @@ SASS_BUILD_DIR = 'static/css'
 # The style of the CSS ouput
 SASS_OUTPUT_STYLE = 'compact'
 
+# The outputs of each Sass entry point, a list of (output style, suffix,
+# source map), eg [('compressed', '.css', True), ('expanded', '.debug.css',
+# False)]. Empty for a .css in SASS_OUTPUT_STYLE without source map.
+SASS_OUTPUTS = []
+
 SASS_FUNCTIONS = []
 
+# The @parallel backend and number of workers compiling the sass entry points
+SASS_PARALLEL_BACKEND = os.environ.get('SETT_SASS_PARALLEL_BACKEND', 'process')
+SASS_JOBS = os.environ.get('SETT_SASS_JOBS', 'auto')
+
 SCSS_LINT_CONFIG = 'compass/.scss-lint.yml'
 
 
@@ -49,6 +71,8 @@ CURL_EXTRA_HEADERS = {}
 
 TESTS_ROOT = 'tests'
 TESTS_NAMING_STRATEGY = None
+# The number of processes running the tests, the tests are split by module
+TESTS_PROCESSES = int(os.environ.get('SETT_TESTS_PROCESSES', 1))
 
 
 RJS_BUILD_DIR = 'build/static/js'
@@ -61,6 +85,31 @@ RJS_PARAMS = {
     'wrap': 'true',
 }
 
+# The source and the destination of the uglify task, relative to ROOT
+UGLIFY_SRC_DIR = 'scripts/js'
+UGLIFY_BUILD_DIR = 'static/js'
+# The options of uglifyjs
+UGLIFY_OPTIONS = ['--compress', '--mangle']
+# The number of uglifyjs running simultaneously, auto for the number of CPUs
+UGLIFY_JOBS = os.environ.get('SETT_UGLIFY_JOBS', 'auto')
+
+# The number of flake8 processes of the quality task, auto for the number of CPUs
+QUALITY_JOBS = os.environ.get('SETT_QUALITY_JOBS', 'auto')
+
+# The directory in which virtual_static keeps the static files for rjs and
+# madge, relative to CACHE_DIR. Empty to collect them in a new temporary
+# directory each time.
+VIRTUAL_STATIC_DIR = os.environ.get('SETT_VIRTUAL_STATIC_DIR', 'static')
+
+# The rules of the watch_assets task, a list of (glob pattern relative to ROOT,
+# task [, template of the values given to the task [, option of the task taking
+# the values]]), eg ('static/js/app/*.js', 'rjs', 'app/{name}', 'paths'). ** matches
+# any number of directories.
+WATCH_RULES = [
+    ('compass/**/*.s[ac]ss', 'sassc_compile'),
+    ('scripts/js/**/*.js', 'uglify', '{relname}'),
+]
+
 
 DEPLOY_TEMPLATES_DIR = 'sett-templates'
 DOMAIN_TEMPLATE = 'dev.{name}.emencia.net'
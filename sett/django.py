@@ -247,6 +247,9 @@ if django_module:
         del sys.argv[1:]
 
         for key, values in options.test_runner.items():
+            if key == 'processes':
+                # Django's runner splits the tests in processes itself
+                key = 'parallel'
             if not isinstance(values, list):
                 values = [values]
 
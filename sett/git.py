@@ -2,6 +2,8 @@
 # -*- coding: utf-8 -*-
 
 
+import os
+
 from paver.easy import task, consume_args, call_task, sh
 from sett import which
 
@@ -16,3 +18,25 @@ def git_copy(args):
 @consume_args
 def git(args):
     sh([which.git] + args)
+
+
+def changed_files(since, patterns=()):
+    """
+    Returns the paths relative to the current directory of the files added,
+    copied, modified or renamed since the git ref *since*, including the
+    changes not committed yet and the untracked files, that match one of the
+    git *patterns* (all the files if none is given).
+    """
+    patterns = list(patterns)
+    diff = sh([which.git, 'diff', '--name-only', '--relative', '--diff-filter=ACMR', since, '--'] + patterns,
+              capture=True)
+    untracked = sh([which.git, 'ls-files', '--others', '--exclude-standard', '--'] + patterns, capture=True)
+
+    files = []
+    seen = set()
+    for filename in diff.splitlines() + untracked.splitlines():
+        filename = filename.strip()
+        if filename and filename not in seen:
+            seen.add(filename)
+            files.append(os.path.normpath(filename))
+    return files
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+"""
+Task graph
+==========
+
+Paver runs the requirements of a task (``@needs``) one after the other. The
+*run_graph* task collects the given tasks and all their requirements in a
+graph and runs the tasks whose requirements are done concurrently.
+
+    $ paver run_graph --jobs 3 nginx_conf monit_conf uwsgi_conf
+
+Only the requirements declared by ``@needs`` are known, tasks invoked with
+``call_task`` in the body of another task still run sequentially inside it.
+The tasks run in threads of the same process, they share the paver
+environment and should not rely on the current directory or other process
+wide state that another task changes.
+"""
+
+import time
+import optparse
+import collections
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from paver.easy import task, consume_args, info, debug, environment, BuildFailure
+from sett import defaults, parallel
+
+
+class TaskGraph(object):
+    """
+    A graph of paver tasks and their requirements. Tasks are indexed by their
+    full name.
+
+    >>> graph = TaskGraph(environment)
+    >>> graph.add('jenkins')
+    >>> graph.needs['sett.jenkins.jenkins']
+    set()
+    """
+    def __init__(self, env):
+        self.env = env
+        self.tasks = {}
+        self.needs = {}
+
+    def __repr__(self):
+        return 'TaskGraph({})'.format(', '.join(sorted(self.tasks)))
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def __iter__(self):
+        return iter(self.tasks)
+
+    def _get_task(self, name, required_by=None):
+        task = self.env.get_task(name)
+        if not task:
+            if required_by:
+                raise BuildFailure('Requirement {} for task {} not found'.format(name, required_by))
+            raise BuildFailure('Unknown task: {}'.format(name))
+        return task
+
+    def add(self, name):
+        """
+        Adds the task named *name* and all its requirements. Returns the full
+        name of the task.
+        """
+        return self._add(self._get_task(name))
+
+    def _add(self, task):
+        if task.name in self.tasks:
+            return task.name
+
+        self.tasks[task.name] = task
+        self.needs[task.name] = set()
+        for required in task.needs:
+            self.needs[task.name].add(self._add(self._get_task(required, task.name)))
+        return task.name
+
+    def dependents(self):
+        """
+        Returns a mapping of each task to the tasks requiring it
+        """
+        dependents = collections.defaultdict(set)
+        for name, needs in self.needs.items():
+            for required in needs:
+                dependents[required].add(name)
+        return dependents
+
+    def topological_order(self):
+        """
+        Returns the names of the tasks, each one after its requirements. Raises
+        a BuildFailure if there is a cycle.
+        """
+        remaining = dict((name, set(needs)) for name, needs in self.needs.items())
+        dependents = self.dependents()
+        ready = sorted(name for name, needs in remaining.items() if not needs)
+        order = []
+
+        while ready:
+            name = ready.pop(0)
+            order.append(name)
+            for dependent in sorted(dependents[name]):
+                remaining[dependent].discard(name)
+                if not remaining[dependent]:
+                    ready.append(dependent)
+            del remaining[name]
+
+        if remaining:
+            raise BuildFailure('Cyclic requirements between {}'.format(', '.join(sorted(remaining))))
+        return order
+
+
+class GraphRunner(object):
+    """
+    Runs the tasks of a ``TaskGraph`` on *jobs* threads, starting each task
+    as soon as its requirements are done. The first failure stops the
+    scheduling of new tasks.
+
+    The start and end time of each task are recorded in ``timings``.
+    """
+    def __init__(self, graph, jobs=4):
+        self.graph = graph
+        self.jobs = jobs
+        self.timings = {}
+
+    def _run_task(self, name):
+        task = self.graph.tasks[name]
+        start = time.time()
+        try:
+            if not task.called:
+                task()
+        finally:
+            self.timings[name] = (start, time.time())
+            debug('%s done in %.2fs', name, self.timings[name][1] - start)
+        return name
+
+    def __call__(self):
+        order = self.graph.topological_order()
+        remaining = dict((name, set(needs)) for name, needs in self.graph.needs.items())
+        dependents = self.graph.dependents()
+        done = queue.Queue()
+
+        runner = parallel(self._run_task, backend='threaded', n=self.jobs, fail_fast=True)
+        running = 0
+        failed = False
+
+        ready = [name for name in order if not remaining[name]]
+        while ready or running:
+            if not failed:
+                for name in ready:
+                    debug('Scheduling %s', name)
+                    running += 1
+                    runner(name).add_done_callback(done.put)
+            ready = []
+
+            if not running:
+                break
+
+            future = done.get()
+            running -= 1
+            if not future.successful():
+                failed = True
+                continue
+
+            name = future.result()
+            for dependent in dependents[name]:
+                remaining[dependent].discard(name)
+                if not remaining[dependent]:
+                    ready.append(dependent)
+
+        runner.wait()
+
+    def critical_path(self):
+        """
+        Returns the chain of tasks that took the longest time, from the first
+        requirement to the last task, and its total duration.
+        """
+        cost = {}
+        previous = {}
+        for name in self.graph.topological_order():
+            if name not in self.timings:
+                continue
+            start, end = self.timings[name]
+            longest = None
+            for required in self.graph.needs[name]:
+                if required in cost and (longest is None or cost[required] > cost[longest]):
+                    longest = required
+            previous[name] = longest
+            cost[name] = (end - start) + (cost[longest] if longest else 0)
+
+        if not cost:
+            return [], 0
+
+        name = max(cost, key=cost.get)
+        total = cost[name]
+        path = []
+        while name:
+            path.append(name)
+            name = previous[name]
+        path.reverse()
+        return path, total
+
+    def summary(self):
+        """
+        Returns the lines of the timing summary
+        """
+        if not self.timings:
+            return []
+
+        starts, ends = zip(*self.timings.values())
+        wall_time = max(ends) - min(starts)
+        tasks_time = sum(end - start for start, end in self.timings.values())
+        path, path_time = self.critical_path()
+
+        return [
+            'Ran {} tasks in {:.2f}s ({:.2f}s of tasks time)'.format(len(self.timings), wall_time, tasks_time),
+            'Critical path {:.2f}s: {}'.format(path_time, ' -> '.join(
+                '{} ({:.2f}s)'.format(name, self.timings[name][1] - self.timings[name][0])
+                for name in path
+            )),
+        ]
+
+
+@task
+@consume_args
+def run_graph(args):
+    """Usage: run_graph [-j|--jobs N] task [task...]
+Run the tasks and their requirements, concurrently when they do not depend on
+each other.
+
+The number of jobs defaults to defaults.PARALLEL_JOBS. A summary of the timing
+and the critical path is shown at the end.
+"""
+    parser = optparse.OptionParser(usage='run_graph [-j|--jobs N] task [task...]')
+    parser.add_option('-j', '--jobs', default=defaults.PARALLEL_JOBS,
+                      help='Number of tasks to run simultaneously, or auto')
+    values, task_names = parser.parse_args(list(args))
+
+    if not task_names:
+        raise BuildFailure('run_graph requires at least a task')
+
+    graph = TaskGraph(environment)
+    for name in task_names:
+        graph.add(name)
+    debug('Graph is %s', graph)
+
+    runner = GraphRunner(graph, jobs=values.jobs)
+    try:
+        runner()
+    finally:
+        for line in runner.summary():
+            info(line)
@@ -1,29 +1,28 @@
 # -*- coding: utf-8 -*-
 
+import re
+import json
 import time
 import os.path
+import hashlib
+import optparse
 import collections
 import importlib
-import traceback
-import threading
 
-from sett import optional_import, defaults, ROOT
+from sett import optional_import, defaults, parallel, ROOT
+from sett.utils import file_hash
+from sett.utils.fs import atomic_write, OutputCache
+from sett.utils import watch
 from sett.utils.dispatch import Dispatcher
-from paver.easy import task, info, debug, consume_args, path, error
-from paver.deps.six import string_types, moves
+from paver.easy import task, info, debug, consume_args, cmdopts, path, error
+from paver.deps.six import string_types, text_type
 
-observers = optional_import('watchdog.observers')
-events = optional_import('watchdog.events')
 libsass = optional_import('sass', 'libsass')
 
 
-# Time to wait for additional events in seconds
-DEBOUNCE_WAIT = 0.250
-
-
 class SassDispatcher(Dispatcher):
-    def __init__(self):
-        self._sass = Sass.default()
+    def __init__(self, sass=None):
+        self._sass = sass or Sass.default()
 
     @Dispatcher.auto
     @Dispatcher.on('watch', -1)
@@ -56,10 +55,19 @@ def sass(args):
 
 
 @task
-def sassc_compile():
+@cmdopts([
+    optparse.make_option('-s', '--stats',
+                         action='store_true',
+                         default=False,
+                         help='Show the statistics of the output cache'),
+])
+def sassc_compile(options):
     """Compile the sass files"""
-    sd = SassDispatcher()
+    sass = Sass.default()
+    sd = SassDispatcher(sass)
     sd.compile()
+    if options.get('stats'):
+        info(sass.format_stats())
 
 
 @task
@@ -69,124 +77,171 @@ def sassc_watch():
     sd.watch()
 
 
-class EventDispatcher(object):
-    """Watchdog compatible event dispatcher. It calls the builder when a file
-    is modified and have the right extension"""
-    def __init__(self, queue):
-        self.extensions = {'.css', '.scss'}
-        self.queue = queue
-
-    def dispatch(self, event):
-        #  events.FileCreatedEvent triggers FileModifiedEvent
-        debug(event)
-        if isinstance(event, (events.FileModifiedEvent)) and event.src_path in self:
-            self.queue.put(event.src_path)
-
-    def __contains__(self, path):
-        stem, ext = os.path.splitext(path)
-        if ext not in self.extensions:
-            return False
-        return True
-
-
-class Watcher(object):
-    """Watchdog compatible event dispatcher. It can be called in the same
-    thread or started in another thread.
+class Watcher(watch.Watcher):
+    """
+    Watches the source directories of the builder and builds the modified
+    files. It can be called in the same thread or started in another thread.
 
     >>> with Watcher(Sass.default()):
-    ...     call_task('runserver')  # Running an http server and building at the same time
+    ...     call_task('runserver')  # Running an http server and building at the same time
 
     >>> w = Watcher(Sass.default())
-    >>> w()  # Blocks until it's stopped
+    >>> w()  # Blocks until it's stopped
     """
-    def __init__(self, builder):
-        self.observer = observers.Observer()
-        self.queue = moves.queue.Queue()
-        self._thread = None
-        self._stop = object()
-
-        self.watches = {}
-        for filepath in builder.paths:
-            watch = self.observer.schedule(EventDispatcher(self.queue), filepath, recursive=True)
-            debug('Watching %s', filepath)
-            self.watches[filepath] = watch
+    PATTERNS = ['*.css', '*.scss', '*.sass']
+
+    def __init__(self, builder, backend=None):
         self.builder = builder
+        super(Watcher, self).__init__(builder.paths, self.rebuild, patterns=self.PATTERNS,
+                                      backend=backend, on_overflow=builder)
 
-    def start(self):
-        self.start_observer()
-        assert self._thread is None
-        self._thread = threading.Thread(target=self.run)
-        self._thread.start()
+    def rebuild(self, paths):
+        # The deleted entry points are not built, the deleted partials are
+        # reported by the build of the entry points importing them.
+        self.builder.rebuild([
+            p for p in paths
+            if os.path.exists(p) or os.path.basename(p).startswith('_')
+        ])
 
-    def stop(self):
-        self.stop_observer()
-        self.queue.put(self._stop)
-        self._thread.join()
 
-    def __call__(self):
-        self.start_observer()
-        debug('Processing loop')
-        try:
-            self.run()
-        finally:
-            self.stop_observer()
+class DependencyTracker(object):
+    """
+    A sass importer recording the names imported and, in ``imports``, each
+    name with the file importing it.
+    """
+    def __init__(self, imports=()):
+        self._deps = set(imports)
+        self.imports = []
 
-    def run(self):
-        while True:
-            path = self.queue.get()
-            if path is self._stop:
-                break
+    def __contains__(self, file):
+        return file in self._deps
 
-            paths = set()
-            first_event = time.time()
-            try:
-                # Debounce: capture all events occuring 250ms after the fist
-                delay = DEBOUNCE_WAIT
-                while delay > 0:
-                    paths.add(self.queue.get(timeout=delay))
-                    delay = first_event - time.time() + DEBOUNCE_WAIT
+    def __iter__(self):
+        return iter(self._deps)
 
-            except moves.queue.Empty:
-                pass
+    def __call__(self, import_string, prev=None):
+        self._deps.add(import_string)
+        self.imports.append((import_string, prev))
+        return [(import_string, )]
 
-            if self._stop in paths:
-                break
 
-            for path in paths:
-                try:
-                    self.builder(path)
-                except:
-                    traceback.print_exc()
+class DependencyGraph(object):
+    """
+    The imports of each entry point, with a reverse index of the entry points
+    importing each name.
 
-    def start_observer(self):
-        debug('Start observer')
-        self.observer.start()
+    The graph is kept in *cache_file* with the hash of the files each entry
+    point was compiled from. When it's loaded, the entry points of which a
+    file changed are left out of the graph.
+    """
+    VERSION = 2
 
-    def stop_observer(self):
-        debug('Stop observer')
-        self.observer.stop()
-        self.observer.join()
+    def __init__(self, cache_file=None):
+        self.cache_file = cache_file
+        self._imports = {}
+        self._files = {}
+        self._importers = collections.defaultdict(set)
 
-    def __enter__(self):
-        self.start()
+    def __repr__(self):
+        return 'DependencyGraph({} entries)'.format(len(self))
+
+    def __len__(self):
+        return len(self._imports)
+
+    def __contains__(self, entry):
+        return entry in self._imports
+
+    def __getitem__(self, entry):
+        return self._imports[entry]
+
+    def add(self, entry, dep_tracker, files):
+        """
+        Sets the imports of *entry*, given by a ``DependencyTracker``, and
+        *files*, a dict of the files it's compiled from to their hash, or None
+        when they are not known.
+        """
+        self.discard(entry)
+        self._imports[entry] = dep_tracker
+        self._files[entry] = files
+        for name in self._names(entry):
+            self._importers[name].add(entry)
+
+    def _names(self, entry):
+        return set(self._imports[entry]).union(os.path.abspath(f) for f in self._files[entry] or ())
+
+    def discard(self, entry):
+        if entry not in self._imports:
+            return
+        for name in self._names(entry):
+            self._importers[name].discard(entry)
+        del self._imports[entry]
+        del self._files[entry]
+
+    def files(self, entry):
+        """
+        Returns the files *entry* was compiled from and their hash
+        """
+        return self._files.get(entry)
+
+    def importers(self, names):
+        """
+        Returns the entry points importing any of *names*, import names or
+        absolute paths of the files they read.
+        """
+        entries = set()
+        for name in names:
+            entries.update(self._importers.get(name, ()))
+        return entries
+
+    def load(self):
+        if not self.cache_file:
+            return
 
-    def __exit__(self, exc_value, exc_type, tb):
-        self.stop()
+        try:
+            with open(self.cache_file, 'r') as cache_file:
+                graph = json.load(cache_file)
+        except (IOError, OSError, ValueError) as e:
+            debug('Cannot read %s: %s', self.cache_file, e)
+            return
 
+        if graph.get('version') != self.VERSION:
+            return
 
-class DependencyTracker(object):
-    def __init__(self):
-        self._deps = set()
+        for entry, deps in graph['entries'].items():
+            if not deps['files']:
+                continue
+            try:
+                changed = any(file_hash(f) != h for f, h in deps['files'].items())
+            except (IOError, OSError):
+                changed = True
+            if changed:
+                debug('%s changed since %s', entry, self.cache_file)
+                continue
+            self.add(path(entry), DependencyTracker(deps['imports']), deps['files'])
+
+        debug('Loaded %s from %s', self, self.cache_file)
+
+    def save(self):
+        if not self.cache_file:
+            return
 
-    def __contains__(self, file):
-        return file in self._deps
+        graph = {
+            'version': self.VERSION,
+            'entries': dict(
+                (entry, {'imports': sorted(self._imports[entry]), 'files': self._files[entry]})
+                for entry in self._imports
+            ),
+        }
+        atomic_write(self.cache_file, json.dumps(graph).encode('utf-8'))
 
-    def __call__(self, import_string):
-        self._deps.add(import_string)
-        return [(import_string, )]
+
+SassOutput = collections.namedtuple('SassOutput', ['style', 'suffix', 'source_map'])
 
 
 class BaseSass(object):
+    # The imports kept as CSS @import by sass
+    CSS_IMPORT = re.compile(r'^(url\(|https?://|//)|\.css$')
+
     @classmethod
     def get_default_paths(self):
         sp = defaults.SASS_PATH
@@ -227,12 +282,12 @@ class BaseSass(object):
             ROOT.joinpath(defaults.SASS_BUILD_DIR),
             cls.get_default_paths(),
             cls.get_default_functions(),
+            cache_dir=ROOT.joinpath(defaults.CACHE_DIR, 'sass'),
         )
 
-    def __init__(self, src, dest, include_paths, functions):
+    def __init__(self, src, dest, include_paths, functions, cache_dir=None):
         self._src = src
         self._dest = dest
-        self._deps = {}
         self._functions = functions
 
         paths = [self._src]
@@ -240,6 +295,13 @@ class BaseSass(object):
         # Ensure trailing slashes so it does not mess with deps computation
         self._paths = [os.path.join(p, '') for p in paths]
 
+        cache_dir = path(cache_dir) if cache_dir else None
+        self._deps = DependencyGraph(cache_dir and cache_dir.joinpath('deps.json'))
+        self._deps.load()
+        self._outputs = OutputCache(cache_dir and cache_dir.joinpath('outputs.json'))
+        self._outputs.load()
+        self.stats = collections.Counter()
+
     @property
     def paths(self):
         return self._paths
@@ -264,56 +326,253 @@ class BaseSass(object):
             self._build_all()
             return
 
-        filename = path(filename)
-        if filename.basename().startswith('_'):
-            if not self._deps:
-                self._build_all()
-                return
-
-            dep_names = {
-                os.path.join(filename.dirname()[len(p):], filename.basename().stripext().lstrip('_'))
-                for p in self._paths
-                if filename.startswith(p)
-            }
-
-            if not dep_names:
-                return
-
-            for main_file, deps in self._deps.items():
-                if any(dep_name in deps for dep_name in dep_names):
-                    self._build_file(main_file)
-            return
-
-        self._build_file(filename)
-
-    def _build_file(self, filename):
+        self.rebuild([filename])
+
+    def rebuild(self, filenames):
+        """
+        Builds the modified *filenames* and the files importing the modified
+        partials.
+        """
+        to_build = set()
+        partials = False
+        for filename in filenames:
+            filename = path(filename)
+            if not filename.basename().startswith('_'):
+                to_build.add(filename)
+                continue
+
+            partials = True
+            to_build.update(self._dependents(filename))
+
+        if partials:
+            # The imports of the entry points not in the graph are unknown
+            to_build.update(entry for entry in self._entries() if entry not in self._deps)
+
+        self._build_files(sorted(to_build))
+
+    def _dependents(self, filename):
+        dep_names = {
+            os.path.join(filename.dirname()[len(p):], filename.basename().stripext().lstrip('_'))
+            for p in self._paths
+            if filename.startswith(p)
+        }
+        dep_names.add(os.path.abspath(filename))
+        return self._deps.importers(dep_names)
+
+    def _entries(self):
+        return [
+            filename
+            for filename in path(self._src).walkfiles()
+            if filename.ext in {'.scss', '.sass'} and not filename.basename().startswith('_')
+        ]
+
+    def _resolve(self, infile, dep_tracker):
+        """
+        Returns the files read by the compilation of *infile* and their hash,
+        looking for each import like sass in the dir of the file importing it
+        then in the include paths. Returns None when an import is not found:
+        the files read are not known.
+        """
+        files = {infile: file_hash(infile)}
+        for name, importer in dep_tracker.imports:
+            if self.CSS_IMPORT.search(name):
+                continue
+            filename = self._find(name, importer or infile)
+            if filename is None:
+                debug('Cannot find %s imported by %s', name, importer or infile)
+                return None
+            files[filename] = file_hash(filename)
+        return files
+
+    def _find(self, name, importer):
+        head, tail = os.path.split(name)
+        candidates = [os.path.join(head, prefix + tail + ext)
+                      for prefix in ('_', '')
+                      for ext in ('', '.scss', '.sass', '.css')]
+        candidates.extend(os.path.join(name, index) for index in ('_index.scss', 'index.scss'))
+        for directory in [os.path.dirname(importer)] + self._paths:
+            for candidate in candidates:
+                filename = os.path.join(directory, candidate)
+                if os.path.isfile(filename):
+                    return filename
+        return None
+
+    def get_outputs(self):
+        """
+        Returns the ``SassOutput`` written for each entry point, from
+        defaults.SASS_OUTPUTS or a .css in defaults.SASS_OUTPUT_STYLE.
+        """
+        if not defaults.SASS_OUTPUTS:
+            return [SassOutput(defaults.SASS_OUTPUT_STYLE, '.css', False)]
+        return [SassOutput(*output) for output in defaults.SASS_OUTPUTS]
+
+    def _key(self, files, output):
+        """
+        Returns the key of a compilation to *output* from the hash of the
+        *files* it reads and the compile options.
+        """
         kwargs = self.get_compile_kwargs()
+        key = {
+            'files': sorted(files.items()),
+            'output': list(output),
+            'include_paths': kwargs.get('include_paths'),
+            'functions': sorted(text_type(getattr(f, 'signature', f)) for f in kwargs.get('custom_functions', ())),
+        }
+        return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _current_files(self, infile):
+        """
+        Returns the files *infile* read the last time it was compiled if none
+        of them changed since, else None.
+        """
+        files = self._deps.files(infile)
+        if not files:
+            return None
+        try:
+            if any(file_hash(f) != h for f, h in files.items()):
+                return None
+        except (IOError, OSError):
+            return None
+        return files
+
+    def _compile(self, job):
+        """
+        Compiles the entry point to the output of the *job*, a tuple of the
+        entry point and a ``SassOutput``. Returns the input file, the output,
+        its dependencies, the CSS, the source map or None and the time spent.
+        It may run in another process.
+        """
+        filename, output = job
+        kwargs = self.get_compile_kwargs()
+        kwargs['output_style'] = output.style
         dep_tracker = DependencyTracker()
         kwargs['importers'].append((0, dep_tracker))
 
         infile = self._src.joinpath(filename)
+        if output.source_map:
+            outfile = self._outfile(infile, output)
+            kwargs['source_map_filename'] = outfile + '.map'
+            kwargs['output_filename_hint'] = outfile
+
+        start = time.time()
         try:
             result = libsass.compile(filename=infile, **kwargs)
         except Exception as e:
             error('Cannot build %s: %s', infile, e)
             raise
 
-        self._deps[infile] = dep_tracker
+        source_map = None
+        if output.source_map:
+            result, source_map = result
+        return infile, output, dep_tracker, result, source_map, time.time() - start
+
+    def _outfile(self, infile, output):
         relative_infile = os.path.relpath(infile, self._src)
+        return self._dest.joinpath(relative_infile).stripext() + output.suffix
+
+    def _outfiles(self, infile, output):
+        outfile = self._outfile(infile, output)
+        if output.source_map:
+            return [outfile, outfile + '.map']
+        return [outfile]
+
+    def _write(self, infile, outfile, result, duration):
+        """
+        Writes *result* in *outfile* unless it already has this content.
+        Returns the hash of the content.
+        """
+        content = result.encode('utf-8')
+        out_hash = hashlib.sha1(content).hexdigest()
 
-        outfile = self._dest.joinpath(relative_infile).stripext() + '.css'
-        if not outfile.parent.isdir():
-            outfile.parent.makedirs_p()
+        try:
+            unchanged = file_hash(outfile) == out_hash
+        except (IOError, OSError):
+            unchanged = False
+
+        if unchanged:
+            info('Build %s -> %s (%.2fs, unchanged)', infile, outfile, duration)
+            self.stats['unchanged'] += 1
+        else:
+            info('Build %s -> %s (%.2fs)', infile, outfile, duration)
+            atomic_write(outfile, content)
+            self.stats['written'] += 1
+        return out_hash
 
-        info('Build %s -> %s', filename, outfile)
-        with open(outfile, 'wb') as out_stream:
-            out_stream.write(result.encode('utf-8'))
+    def _build_file(self, filename):
+        self._build_files([filename])
+
+    def _build_files(self, filenames):
+        """
+        Compiles *filenames* to each output concurrently, on
+        defaults.SASS_JOBS workers of the defaults.SASS_PARALLEL_BACKEND, and
+        writes the outputs.
+        """
+        outputs = self.get_outputs()
+        jobs = []
+        for filename in filenames:
+            infile = self._src.joinpath(filename)
+            files = self._current_files(infile)
+            for output in outputs:
+                if files and all(self._outputs.is_fresh(outfile, self._key(files, output))
+                                 for outfile in self._outfiles(infile, output)):
+                    debug('%s is up to date', self._outfile(infile, output))
+                    self.stats['hits'] += 1
+                else:
+                    jobs.append((filename, output))
+
+        if not jobs:
+            return
 
-    def _build_all(self):
-        for filename in path(self._src).walkfiles():
+        self.stats['misses'] += len(jobs)
+        start = time.time()
+        if len(jobs) == 1:
+            results = [self._compile(jobs[0])]
+        else:
+            compiler = parallel(self._compile, backend=defaults.SASS_PARALLEL_BACKEND, n=defaults.SASS_JOBS)
+            results = compiler.imap_unordered(jobs)
 
-            if filename.ext in {'.scss', '.sass'} and not filename.basename().startswith('_'):
-                self._build_file(filename)
+        timings = []
+        try:
+            for infile, output, dep_tracker, result, source_map, duration in results:
+                files = self._resolve(infile, dep_tracker)
+                self._deps.add(infile, dep_tracker, files)
+                key = self._key(files, output) if files else None
+
+                outfile = self._outfile(infile, output)
+                self._outputs.set(outfile, key, self._write(infile, outfile, result, duration))
+                if source_map is not None:
+                    map_file = outfile + '.map'
+                    self._outputs.set(map_file, key, self._write(infile, map_file, source_map, duration))
+
+                label = os.path.relpath(infile, self._src)
+                if len(outputs) > 1:
+                    label = '{} ({})'.format(label, output.style)
+                timings.append((duration, label))
+        finally:
+            self._deps.save()
+            self._outputs.save()
+            if len(timings) > 1:
+                self.report(timings, time.time() - start)
+
+    def report(self, timings, wall_time):
+        """
+        Shows the compilation time of each file, the slowest first
+        """
+        info('Built %s files in %.2fs (%.2fs of compilation)',
+             len(timings), wall_time, sum(duration for duration, label in timings))
+        for duration, label in sorted(timings, reverse=True):
+            info('%6.2fs %s', duration, label)
+
+    def format_stats(self):
+        return 'Sass cache: {} hits, {} misses, {} written, {} unchanged'.format(
+            self.stats['hits'],
+            self.stats['misses'],
+            self.stats['written'],
+            self.stats['unchanged'],
+        )
+
+    def _build_all(self):
+        self._build_files(self._entries())
 
 
 class Sass(BaseSass):
@@ -1,10 +1,102 @@
 # -*- coding: utf-8 -*-
 
+"""
+Loaddata
+========
+
+The *loaddata* task loads a JSON fixture by inserting the objects of each
+model with a single ``bulk_create``, once the models they depend on are
+inserted.
+
+The whole fixture is deserialized before the first insertion. With
+``--stream``, the fixture is parsed incrementally and the objects of each
+model are inserted by batches of ``--batch-size`` as soon as the models they
+depend on are inserted. The objects waiting for their dependencies are kept in
+memory up to ``--memory-limit`` objects and spilled in a temporary file beyond.
+
+    $ paver loaddata --stream --batch-size 5000 dump.json
+
+The models are expected to be grouped in the fixture, as written by dumpdata:
+a model is complete, and the models depending on it can be inserted, when the
+fixture goes on with another model.
+
+When the database rejects a batch, it's split until the rejected rows are
+isolated, the other rows are inserted. The rejected rows are written in the
+``--rejected`` JSON lines file, with the error. ``--ignore-conflicts`` lets
+the database skip the rows conflicting with existing ones instead.
+
+    $ paver loaddata --ignore-conflicts --rejected rejected.jsonl dump.json
+
+The many to many relations are added by inserting the rows of their through
+tables by batches, once all the objects are inserted. With ``--eager-m2m``,
+the streaming mode inserts them with the objects instead, which relies on the
+database checking the foreign keys at the end of the transaction (as the
+tables created by Django on PostgreSQL and SQLite do). The ``m2m_changed``
+signals are not sent.
+
+With ``--jobs N``, the models whose dependencies are inserted are inserted
+concurrently by N threads, each model in a transaction of its own database
+connection. The models depending on them wait for the whole level to be
+committed. The fixture is not loaded in a single transaction anymore: once
+all the models are inserted, the deferred foreign keys and the many to many
+relations are inserted in a last transaction, in which the foreign keys of
+the tables and the number of rows are checked. It's meant for databases accepting concurrent writers,
+like PostgreSQL.
+
+    $ paver loaddata --jobs 4 dump.json
+
+Load plan
+---------
+
+Without ``--stream``, the order of the models is planned before the first
+insertion from the foreign keys between the models of the fixture. The models
+referencing each other, or themselves, are inserted with those of their
+foreign keys that are nullable set to NULL, and the foreign keys are filled
+by bulk updates once all the objects are inserted. ``--plan`` prints the
+plan without loading anything.
+
+    $ paver loaddata --plan dump.json
+
+Formats
+-------
+
+The fixtures are JSON (``.json``), JSON lines (``.jsonl``), YAML (``.yaml``)
+or pickle records (``.pickle``), compressed with gzip (``.gz``), bzip2
+(``.bz2``) or xz (``.xz``). The compression is detected from the content of
+the file, the format from its extension or its content.
+
+The pickle records are lists of objects in the format of Django's python
+serializer, pickled with the highest protocol after a header. They keep the
+python values (dates, decimals, uuids) and are the fastest to read. As any
+pickle, they must come from a trusted source.
+
+The *dumpdata* task writes the objects of the given apps or models, or all of
+them, in the format of the extension of the output, each model after the
+models it depends on.
+
+    $ paver dumpdata -o staging.pickle.xz
+    $ paver loaddata --stream staging.pickle.xz
+"""
+
+import io
+import re
+import bz2
+import gzip
+import json
+import codecs
+import pickle
+import threading
+import tempfile
+import itertools
 import collections
 import optparse
 
-from paver.easy import task, needs, debug, info, consume_nargs, cmdopts
-from sett import optional_import
+from paver.easy import task, needs, debug, info, consume_args, consume_nargs, cmdopts, BuildFailure
+from paver.deps.six import text_type
+from sett import optional_import, parallel
+
+lzma = optional_import('lzma')
+yaml = optional_import('yaml')
 
 
 @task
@@ -16,16 +108,134 @@ from sett import optional_import
         action='store_true',
         default=False,
     ),
+    optparse.make_option(
+        '-s', '--stream',
+        action='store_true',
+        default=False,
+    ),
+    optparse.make_option(
+        '-b', '--batch-size',
+        dest='batch_size',
+        type='int',
+        default=1000,
+    ),
+    optparse.make_option(
+        '-m', '--memory-limit',
+        dest='memory_limit',
+        type='int',
+        default=100000,
+    ),
+    optparse.make_option(
+        '-i', '--ignore-conflicts',
+        dest='ignore_conflicts',
+        action='store_true',
+        default=False,
+    ),
+    optparse.make_option(
+        '-r', '--rejected',
+        dest='rejected',
+        default=None,
+    ),
+    optparse.make_option(
+        '-e', '--eager-m2m',
+        dest='eager_m2m',
+        action='store_true',
+        default=False,
+    ),
+    optparse.make_option(
+        '-j', '--jobs',
+        dest='jobs',
+        type='int',
+        default=1,
+    ),
+    optparse.make_option(
+        '-p', '--plan',
+        dest='plan',
+        action='store_true',
+        default=False,
+    ),
 ])
 def loaddata(args, options):
+    """Usage: loaddata [-f|--force] [-s|--stream [-e|--eager-m2m] [-m|--memory-limit N]] [-b|--batch-size N]
+                [-i|--ignore-conflicts] [-r|--rejected rejected.jsonl] [-j|--jobs N] [-p|--plan] fixture
+Load the objects of a fixture, each model after the models it depends on. The
+fixture is in JSON, JSON lines, YAML or pickle records, compressed or not.
+The many to many relations are inserted by batches of N rows.
+
+With --plan, print the order in which the models would be inserted and the
+foreign keys filled after the insertion, without loading anything.
+
+With --jobs, the models ready at the same time are inserted concurrently by N
+threads on their own connections and transactions, and checked at the end.
+
+With --stream, the fixture is parsed incrementally and inserted by batches of
+N objects, at most N objects waiting for their dependencies are kept in memory.
+With --eager-m2m, the many to many relations are inserted with the objects
+instead of at the end.
+
+The rows rejected by the database are skipped and written in the --rejected
+file. With --ignore-conflicts, the database skips the rows conflicting with
+the existing ones, when it supports it.
+"""
     filepath, = args
 
+    if options.plan:
+        _print_plan(filepath)
+        return
+
+    if options.stream and options.jobs > 1:
+        raise BuildFailure('loaddata --stream does not support --jobs')
+
+    # The eager many to many relations may reference objects not inserted yet
+    inserter = Inserter(ignore_conflicts=options.ignore_conflicts, report=options.rejected,
+                        check_constraints=not (options.stream and options.eager_m2m))
+    try:
+        if options.stream:
+            _load_stream(filepath, options, inserter)
+        else:
+            _load(filepath, options, inserter)
+    finally:
+        inserter.close()
+
+    if inserter.rejected:
+        info('Rejected %s rows: %s', sum(inserter.rejected.values()), ', '.join(
+            '{} {}'.format(count, label) for label, count in sorted(inserter.rejected.items())))
+
+
+def _load_stream(filepath, options, inserter):
+    from django.db import transaction
+
+    loader = StreamLoader(batch_size=options.batch_size, memory_limit=options.memory_limit, inserter=inserter,
+                          eager_related=options.eager_m2m)
+    with open_fixture(filepath) as handle:
+        with transaction.atomic():
+            loader.load(read_fixture(handle, fixture_format(filepath, handle)))
+            loader.finish(options.force)
+    info('Loaded %s objects (%s spilled on disk)', loader.stats['objects'], loader.stats['spilled'])
+
+
+def _print_plan(filepath):
+    from django.apps import apps
+
+    with open_fixture(filepath) as handle:
+        labels = collections.Counter(data['model'] for data in read_fixture(handle, fixture_format(filepath, handle)))
+
+    counts = collections.Counter()
+    for label, count in labels.items():
+        counts[apps.get_model(label)] += count
+
+    info('Load plan of %s:\n%s', filepath, LoadPlan.from_models(counts).describe(counts))
+
+
+def _load(filepath, options, inserter):
+    from django.db import connection, transaction
+
     deserialize = optional_import('django.core.serializers').deserialize
-    with open(filepath, 'r') as handle:
+    with open_fixture(filepath) as handle:
         models_by_class = collections.defaultdict(list)
         related_models = list()
 
-        for model in deserialize('json', handle):
+        for model in deserialize('python', read_fixture(handle, fixture_format(filepath, handle))):
             model_class = model.object.__class__
             models_by_class[model_class].append(model.object)
 
@@ -33,37 +243,670 @@ def loaddata(args, options):
                 if values:
                     related_models.append((model.object, field, values))
 
-    from django.db import transaction
-    waiting_room = WaitingRoom()
+    plan = LoadPlan.from_models(models_by_class)
+    debug('Load plan:\n%s', plan.describe())
+    plan.check(options.force)
+    if plan.cycles:
+        # The forced references are only valid once everything is inserted
+        inserter.check_constraints = False
+
+    deferred = [
+        (model_class, plan.defer(model_class, models_by_class[model_class]))
+        for model_class in plan.deferred
+    ]
+
+    if options.jobs > 1:
+        if connection.in_atomic_block:
+            raise BuildFailure('loaddata --jobs cannot run in a transaction')
+
+        # Each model is committed by its own connection, so that the models
+        # of the next levels see it
+        for number, level in enumerate(plan.levels, 1):
+            proceeds = [Proceed(model_class, models_by_class[model_class], inserter) for model_class in level]
+            debug('Running level %s: %s', number, proceeds)
+            runner = parallel(_run_in_transaction, backend='threaded', n=min(options.jobs, len(proceeds)))
+            list(runner.map(proceeds))
+
+        with transaction.atomic():
+            _finish_load(plan, deferred, related_models, inserter, options)
+            check_consistency(models_by_class, inserter)
+        return
 
     with transaction.atomic():
-        for model_class, models_list in models_by_class.items():
+        for number, level in enumerate(plan.levels, 1):
+            proceeds = [Proceed(model_class, models_by_class[model_class], inserter) for model_class in level]
+            debug('Running level %s: %s', number, proceeds)
+            for proceed in proceeds:
+                proceed()
+
+        _finish_load(plan, deferred, related_models, inserter, options)
+
+
+def _finish_load(plan, deferred, related_models, inserter, options):
+    """
+    Fills the *deferred* foreign keys of the *plan* and inserts the
+    *related_models*, once all the models are inserted
+    """
+    for model_class, models in deferred:
+        plan.backfill(model_class, models, batch_size=options.batch_size)
+
+    related = RelatedInserter(inserter, batch_size=options.batch_size)
+    for model, field, values in related_models:
+        related.add(model.__class__, model.pk, field, values)
+    related.flush()
+
+
+@task
+@needs('django_settings')
+@consume_args
+@cmdopts([
+    optparse.make_option(
+        '-o', '--output',
+        dest='output',
+    ),
+    optparse.make_option(
+        '-b', '--batch-size',
+        dest='batch_size',
+        type='int',
+        default=1000,
+    ),
+])
+def dumpdata(args, options):
+    """Usage: dumpdata -o|--output fixture [-b|--batch-size N] [app_label[.ModelName]...]
+Write the objects of the apps or models, or of all the models, in a fixture in
+the format of the extension of the output: .json, .jsonl, .yaml or .pickle,
+followed by .gz, .bz2 or .xz to compress it.
+
+The models are written after the models they depend on, their objects are
+read by batches of N.
+"""
+    if not options.get('output'):
+        raise BuildFailure('dumpdata requires an --output')
+
+    count = 0
+    with FixtureWriter(options.output) as writer:
+        for model_class in dump_models(args):
+            debug('Dumping %s', model_class._meta.label)
+            queryset = model_class._base_manager.order_by(model_class._meta.pk.name)
+            for batch in batches(queryset.iterator(), options.batch_size):
+                writer.write(serialize_batch(model_class, batch))
+                count += len(batch)
+    info('Dumped %s objects in %s', count, options.output)
+
+
+def serialize_batch(model_class, models):
+    """
+    Returns the *models* in the format of Django's python serializer. The many
+    to many relations are read with a query by field for all the *models*
+    instead of a query by model and field.
+    """
+    from django.core.serializers import serialize
+
+    fields = [field.name for field in model_class._meta.local_fields if not field.primary_key]
+    serialized = serialize('python', models, fields=fields)
+
+    for field in model_class._meta.many_to_many:
+        columns = through_columns(field)
+        if columns is None:
+            continue
+
+        through, source, target = columns
+        related = collections.defaultdict(list)
+        rows = through._base_manager.filter(**{source + '__in': [model.pk for model in models]})
+        for source_pk, target_pk in rows.order_by(source, target).values_list(source, target):
+            related[source_pk].append(target_pk)
+
+        for model, data in zip(models, serialized):
+            data['fields'][field.name] = related[model.pk]
+    return serialized
+
+
+def dump_models(labels=()):
+    """
+    Returns the models of the *labels* (app_label or app_label.ModelName), or
+    all the models, each after the models it depends on when possible.
+    """
+    from django.apps import apps
+    from django.core import serializers
+
+    if labels:
+        app_list = collections.OrderedDict()
+        for label in labels:
+            app_label, _, model_name = label.partition('.')
+            app_config = apps.get_app_config(app_label)
+            if model_name:
+                models = app_list.setdefault(app_config, [])
+                if models is not None:
+                    models.append(app_config.get_model(model_name))
+            else:
+                app_list[app_config] = None
+        app_list = list(app_list.items())
+    else:
+        app_list = [(app_config, None) for app_config in apps.get_app_configs()]
+
+    try:
+        models = serializers.sort_dependencies(app_list)
+    except RuntimeError as e:
+        info('Cannot sort the models with their natural keys, using the load plan: %s', e)
+        models = [model for app_config, model_list in app_list
+                  for model in (model_list or app_config.get_models())]
+        models = [model for level in LoadPlan.from_models(models).levels for model in level]
+
+    return [model for model in models if not model._meta.proxy]
+
+
+def check_consistency(models_by_class, inserter):
+    """
+    Checks the foreign keys of the tables of the models and that all the
+    objects of *models_by_class* not rejected by the *inserter* are in the
+    database.
+    """
+    from django.db import connection
+
+    connection.check_constraints(table_names=[model_class._meta.db_table for model_class in models_by_class])
+
+    missing = {}
+    for model_class, models_list in models_by_class.items():
+        pks = set(model.pk for model in models_list)
+        found = sum(model_class.objects.filter(pk__in=batch).count() for batch in batches(pks, 1000))
+        expected = len(pks) - inserter.rejected[model_class._meta.label]
+        if found < expected:
+            missing[model_class._meta.label] = expected - found
+
+    if missing:
+        raise RuntimeError('Missing rows after loading: {}'.format(', '.join(
+            '{} {}'.format(count, label) for label, count in sorted(missing.items()))))
+    info('Checked %s models', len(models_by_class))
+
+
+def iter_json_array(handle, chunk_size=65536):
+    """
+    Yields the items of the JSON array read from the text file *handle*,
+    reading *chunk_size* characters at a time.
+    """
+    decoder = json.JSONDecoder()
+    blank = re.compile(r'[\s,]*')
+
+    buffer = handle.read(chunk_size).lstrip()
+    if not buffer.startswith('['):
+        raise ValueError('Expected a JSON array')
+    position = 1
+
+    while True:
+        position = blank.match(buffer, position).end()
+        if position == len(buffer) or buffer[position] != ']':
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                item, end = None, None
+
+            if end is None or end == len(buffer):
+                # The item may be cut by the end of the buffer
+                chunk = handle.read(chunk_size)
+                if chunk:
+                    buffer = buffer[position:] + chunk
+                    position = 0
+                    continue
+                if end is None:
+                    raise ValueError('Unterminated JSON array')
+
+            yield item
+            position = end
+        else:
+            return
+
+
+PICKLE_HEADER = b'sett-fixture:pickle:1\n'
+
+COMPRESSIONS = collections.OrderedDict([
+    # extension, magic number
+    ('.gz', b'\x1f\x8b'),
+    ('.bz2', b'BZh'),
+    ('.xz', b'\xfd7zXZ\x00'),
+])
+
+FORMATS = {
+    '.json': 'json',
+    '.jsonl': 'jsonl',
+    '.yaml': 'yaml',
+    '.yml': 'yaml',
+    '.pickle': 'pickle',
+}
+
+
+def _split_compression(filepath):
+    for extension in COMPRESSIONS:
+        if filepath.endswith(extension):
+            return filepath[:-len(extension)], extension
+    return filepath, None
+
+
+def _compressed_file(filepath, compression, mode):
+    if compression == '.gz':
+        return gzip.GzipFile(filepath, mode)
+    if compression == '.bz2':
+        return bz2.BZ2File(filepath, mode)
+    if compression == '.xz':
+        if not lzma:
+            raise BuildFailure('The xz compression requires the lzma module')
+        return lzma.LZMAFile(filepath, mode)
+    return io.open(filepath, mode)
+
+
+def open_fixture(filepath):
+    """
+    Opens the fixture *filepath* for reading bytes, decompressing it
+    according to its magic number.
+    """
+    with io.open(filepath, 'rb') as raw:
+        head = raw.read(6)
+
+    for compression, magic in COMPRESSIONS.items():
+        if head.startswith(magic):
+            debug('%s is compressed with %s', filepath, compression)
+            return _compressed_file(filepath, compression, 'rb')
+    return _compressed_file(filepath, None, 'rb')
+
+
+def fixture_format(filepath, handle=None):
+    """
+    Returns the format of the fixture *filepath*, from its extension, or from
+    the beginning of the content of the opened *handle*, which must be
+    seekable.
+    """
+    name, compression = _split_compression(filepath)
+    for extension, format in FORMATS.items():
+        if name.endswith(extension):
+            return format
+
+    if handle is None:
+        raise BuildFailure('Unknown fixture format for {}'.format(filepath))
+
+    head = handle.read(len(PICKLE_HEADER))
+    handle.seek(0)
+    if head.startswith(PICKLE_HEADER):
+        return 'pickle'
+    head = head.lstrip()
+    if head.startswith(b'['):
+        return 'json'
+    if head.startswith(b'{'):
+        return 'jsonl'
+    return 'yaml'
+
+
+def read_fixture(handle, format):
+    """
+    Yields the objects, in the format of Django's python serializer, of the
+    fixture in *format* read from the binary *handle*.
+    """
+    if format == 'json':
+        for data in iter_json_array(codecs.getreader('utf-8')(handle)):
+            yield data
+    elif format == 'jsonl':
+        for line in handle:
+            line = line.strip()
+            if line:
+                yield json.loads(line.decode('utf-8'))
+    elif format == 'yaml':
+        if not yaml:
+            raise BuildFailure('The YAML fixtures require PyYAML')
+        for data in yaml.load(handle, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader)) or []:
+            yield data
+    elif format == 'pickle':
+        if handle.read(len(PICKLE_HEADER)) != PICKLE_HEADER:
+            raise ValueError('Not a pickle fixture')
+        while True:
+            try:
+                records = pickle.load(handle)
+            except EOFError:
+                break
+            for data in records:
+                yield data
+    else:
+        raise ValueError('Unknown fixture format {}'.format(format))
+
+
+class FixtureWriter(object):
+    """
+    Writes a fixture in *filepath*, in the format and the compression of its
+    extension. The objects are given by lists in the format of Django's python
+    serializer.
+
+    >>> with FixtureWriter('dump.pickle.xz') as writer:
+    ...     writer.write(serialize('python', objects))
+    """
+    def __init__(self, filepath):
+        self.filepath = filepath
+        name, self.compression = _split_compression(filepath)
+        self.format = fixture_format(name)
+        self._handle = None
+        self._first = True
+
+    def __enter__(self):
+        self._handle = _compressed_file(self.filepath, self.compression, 'wb')
+        if self.format == 'json':
+            self._handle.write(b'[')
+        elif self.format == 'pickle':
+            self._handle.write(PICKLE_HEADER)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        try:
+            if self.format == 'json':
+                self._handle.write(b'\n]\n')
+        finally:
+            self._handle.close()
+            self._handle = None
+
+    def _dumps(self, data):
+        from django.core.serializers.json import DjangoJSONEncoder
+        return json.dumps(data, cls=DjangoJSONEncoder, sort_keys=True).encode('utf-8')
+
+    def write(self, objects):
+        if not objects:
+            return
+
+        if self.format == 'json':
+            for data in objects:
+                self._handle.write((b'\n' if self._first else b',\n') + self._dumps(data))
+                self._first = False
+        elif self.format == 'jsonl':
+            for data in objects:
+                self._handle.write(self._dumps(data) + b'\n')
+        elif self.format == 'yaml':
+            from django.core.serializers.pyyaml import DjangoSafeDumper
+            self._handle.write(yaml.dump(objects, Dumper=DjangoSafeDumper, default_flow_style=False,
+                                         allow_unicode=True, encoding='utf-8'))
+        elif self.format == 'pickle':
+            pickle.dump(list(objects), self._handle, pickle.HIGHEST_PROTOCOL)
+
+
+class SpillStore(object):
+    """
+    A sequence of objects kept in memory until ``spill`` moves them in a
+    temporary file. The objects are pickled.
+    """
+    def __init__(self):
+        self._memory = []
+        self._file = None
+        self._spilled = 0
+
+    def __len__(self):
+        return len(self._memory) + self._spilled
+
+    def __repr__(self):
+        return '<SpillStore {} in memory, {} spilled>'.format(len(self._memory), self._spilled)
+
+    @property
+    def in_memory(self):
+        return len(self._memory)
+
+    def append(self, value):
+        self._memory.append(value)
+
+    def spill(self):
+        """
+        Moves the objects kept in memory to the temporary file, returns how
+        many were moved.
+        """
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(prefix='sett-loaddata-')
+        for value in self._memory:
+            pickle.dump(value, self._file, pickle.HIGHEST_PROTOCOL)
+        spilled = len(self._memory)
+        self._spilled += spilled
+        self._memory = []
+        return spilled
+
+    def drain(self):
+        """
+        Yields all the objects in the order they were appended and empties
+        the store.
+        """
+        if self._file is not None:
+            spilled, self._file, self._spilled = self._file, None, 0
+            with spilled:
+                spilled.seek(0)
+                while True:
+                    try:
+                        yield pickle.load(spilled)
+                    except EOFError:
+                        break
+
+        memory, self._memory = self._memory, []
+        for value in memory:
+            yield value
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+class StreamLoader(object):
+    """
+    Inserts the objects of a fixture, given as an iterable of the dicts of
+    Django's python serializer, by batches of *batch_size*.
+
+    The objects of a model are kept in a ``SpillStore`` until the models it
+    depends on are in the ``WaitingRoom``. When more than *memory_limit*
+    objects are kept in memory, the largest stores are spilled on disk. The
+    many to many relations are added once all the objects are inserted, or
+    with the objects when *eager_related* is set.
+    """
+    def __init__(self, batch_size=1000, memory_limit=100000, inserter=None, eager_related=False):
+        self.batch_size = batch_size
+        self.memory_limit = memory_limit
+        self.inserter = inserter or Inserter()
+        self.eager_related = eager_related
+        self.related_inserter = RelatedInserter(self.inserter, batch_size=batch_size)
+        self.waiting_room = WaitingRoom()
+        self.stores = collections.OrderedDict()
+        self.related = SpillStore()
+        self.stats = collections.Counter()
+        self._dependencies = {}
+        self._entered = set()
+
+    def dependencies(self, model_class):
+        if model_class not in self._dependencies:
             dependencies = Dependencies.from_model(model_class)
             debug('Needs %s for %s', dependencies, model_class.__name__)
-
             if model_class in dependencies:
                 debug('Circual dependencies for %s, proceed with caution', model_class)
+            self._dependencies[model_class] = dependencies
+        return self._dependencies[model_class]
 
-            proceed = Proceed(model_class, models_list)
-            waiting_room.enter(dependencies, proceed)
+    def is_ready(self, model_class):
+        return model_class in self.waiting_room or all(
+            dependency in self.waiting_room for dependency in self.dependencies(model_class))
 
-        waiting_room.empty()
+    def load(self, objects):
+        from django.apps import apps
 
-        if options.force:
-            for proceed, deps in list(waiting_room):
-                for dep in deps:
-                    def noop():
-                        debug('== Force resolve for %s ==', proceed)
-                        return dep
-                    waiting_room.enter(Dependencies.none(), noop)
+        current = None
+        for data in objects:
+            model_class = apps.get_model(data['model'])
+            if model_class is not current:
+                self.close(current)
+                current = model_class
 
-        if waiting_room:
-            raise RuntimeError('Still some people in the waiting room:\n{}'.format(
-                waiting_room))
+            store = self.stores.setdefault(model_class, SpillStore())
+            store.append(data)
+            self.stats['objects'] += 1
 
-        for model, field, values in related_models:
-            debug('Adding %s to %s(%s)', values, model, field)
-            getattr(model, field).add(*values)
+            if len(store) >= self.batch_size and self.is_ready(model_class):
+                self.flush(model_class)
+            self.check_memory()
+
+        self.close(current)
+
+    def close(self, model_class):
+        """
+        Marks the objects of *model_class* as complete
+        """
+        if model_class is None:
+            return
+
+        if model_class not in self._entered:
+            self._entered.add(model_class)
+            self.waiting_room.enter(self.dependencies(model_class), StreamProceed(model_class, self))
+        elif model_class in self.waiting_room:
+            # Objects of a model coming after the model was complete
+            self.flush(model_class)
+
+    def check_memory(self):
+        in_memory = sum(store.in_memory for store in self.stores.values()) + self.related.in_memory
+        if in_memory <= self.memory_limit:
+            return
+
+        for store in sorted(list(self.stores.values()) + [self.related], key=lambda s: s.in_memory, reverse=True):
+            spilled = store.spill()
+            debug('Spilled %s objects of %s', spilled, store)
+            self.stats['spilled'] += spilled
+            in_memory -= spilled
+            if in_memory <= self.memory_limit // 2:
+                break
+
+    def flush(self, model_class, plan=None):
+        """
+        Inserts the objects of *model_class* waiting in its store. With a
+        *plan*, the deferred foreign keys are inserted as NULL and the models
+        to fill are returned.
+        """
+        from django.core.serializers import deserialize
+
+        deferred = []
+        for batch in batches(self.stores[model_class].drain(), self.batch_size):
+            models = []
+            for deserialized in deserialize('python', batch):
+                models.append(deserialized.object)
+                for field, values in deserialized.m2m_data.items():
+                    if not values:
+                        continue
+                    if self.eager_related:
+                        self.related_inserter.add(model_class, deserialized.object.pk, field, values)
+                    else:
+                        self.related.append((model_class._meta.label, deserialized.object.pk, field, values))
+            if plan is not None:
+                deferred.extend(plan.defer(model_class, models))
+            debug('Inserting %s %s', len(models), model_class.__name__)
+            self.inserter(model_class, models)
+        return deferred
+
+    def resolve(self, force=False):
+        """
+        Inserts the models still waiting for their dependencies once the
+        fixture is read, in the order of their ``LoadPlan``. The foreign keys
+        between them are filled after the insertion and the references to the
+        models already inserted are ignored. Raises a RuntimeError when they
+        cannot be ordered, unless *force* is set.
+        """
+        waiting = [proceed.model_class for proceed in self.waiting_room.drain()]
+        if not waiting:
+            return
+
+        plan = LoadPlan.from_models(waiting, present=self.waiting_room)
+        debug('Load plan of the waiting models:\n%s', plan.describe())
+        plan.check(force)
+        if plan.cycles:
+            self.inserter.check_constraints = False
+
+        deferred = []
+        for level in plan.levels:
+            for model_class in level:
+                deferred.append((model_class, self.flush(model_class, plan)))
+
+        for model_class, models in deferred:
+            plan.backfill(model_class, models, batch_size=self.batch_size)
+
+    def finish(self, force=False):
+        """
+        Inserts the objects still waiting and adds the many to many relations
+        """
+        from django.apps import apps
+
+        self.resolve(force)
+
+        for label, pk, field, values in self.related.drain():
+            self.related_inserter.add(apps.get_model(label), pk, field, values)
+        self.related_inserter.flush()
+
+
+def through_columns(field):
+    """
+    Returns the through model of the many to many *field* and the names of its
+    columns of the source and the target, or None when the through model is
+    not created by Django.
+    """
+    through = (field.remote_field if hasattr(field, 'remote_field') else field.rel).through
+    if not through._meta.auto_created:
+        return None
+    return (
+        through,
+        through._meta.get_field(field.m2m_field_name()).attname,
+        through._meta.get_field(field.m2m_reverse_field_name()).attname,
+    )
+
+
+class RelatedInserter(object):
+    """
+    Adds many to many relations by inserting the rows of their through
+    tables with the *inserter*, by batches of *batch_size* rows of each
+    through model.
+
+    The relations with a custom through model are added with the related
+    manager.
+    """
+    def __init__(self, inserter, batch_size=1000):
+        self.inserter = inserter
+        self.batch_size = batch_size
+        self._rows = collections.OrderedDict()
+        self._columns = {}
+
+    def _get_columns(self, model_class, field_name):
+        key = (model_class, field_name)
+        if key not in self._columns:
+            self._columns[key] = through_columns(model_class._meta.get_field(field_name))
+        return self._columns[key]
+
+    def add(self, model_class, pk, field_name, values):
+        """
+        Adds the objects of primary keys *values* to the field *field_name* of
+        the object *pk* of *model_class*.
+        """
+        columns = self._get_columns(model_class, field_name)
+        if columns is None:
+            debug('Adding %s to %s(%s).%s', values, model_class.__name__, pk, field_name)
+            getattr(model_class(pk=pk), field_name).add(*values)
+            return
+
+        through, source, target = columns
+        rows = self._rows.setdefault(through, [])
+        seen = set()
+        for value in values:
+            if value not in seen:
+                seen.add(value)
+                rows.append(through(**{source: pk, target: value}))
+
+        if len(rows) >= self.batch_size:
+            self._insert(through)
+
+    def _insert(self, through):
+        rows = self._rows.pop(through, [])
+        for batch in batches(rows, self.batch_size):
+            debug('Inserting %s %s', len(batch), through.__name__)
+            self.inserter(through, batch)
+
+    def flush(self):
+        """
+        Inserts the rows waiting
+        """
+        for through in list(self._rows):
+            self._insert(through)
 
 
 class WaitingRoom(object):
@@ -103,6 +946,9 @@ class WaitingRoom(object):
     def __repr__(self):
         return '<W {}>'.format(self._waiting_room)
 
+    def __contains__(self, model_class):
+        return model_class in self._present
+
     def _is_ready(self, deps):
         return deps.issubset(self._present)
 
@@ -129,35 +975,34 @@ class WaitingRoom(object):
             for dep in dependencies:
                 self._index[dep].add(dependencies)
 
-    def empty(self):
-        while self:
-            remaining = dict(self)
+    def drain(self):
+        """
+        Removes and returns the actions still waiting
+        """
+        actions = [action for actions in self._waiting_room.values() for action in actions]
+        self._waiting_room.clear()
+        self._index.clear()
+        return actions
 
-            for proceed in list(remaining):
-                for p, deps in remaining.items():
-                    if p is proceed:
-                        continue
-                    if proceed.model_class in deps:
-                        debug('Skip <%s> because <%s> is in <%s>', p, proceed, deps)
-                        del remaining[p]
-                        break
 
-            promoted_optional = set()
-            for deps in set(remaining.values()):
-                if deps.all_optional():
-                    promoted_optional.update(deps)
-
-            if not promoted_optional:
-                break
+def _run_in_transaction(action):
+    """
+    Runs *action* in a transaction committed on a connection closed after
+    """
+    from django.db import connection, transaction
 
-            for dep in promoted_optional:
-                self._dep_is_ready(dep)
+    try:
+        with transaction.atomic():
+            return action()
+    finally:
+        connection.close()
 
 
 class Proceed(object):
-    def __init__(self, model_class, models):
+    def __init__(self, model_class, models, inserter=None):
         self.model_class = model_class
         self.models = models
+        self.inserter = inserter or Inserter()
 
     def __repr__(self):
         return '{} models for {Model.__module__}.{Model.__name__}'.format(
@@ -166,22 +1011,117 @@ class Proceed(object):
         )
 
     def __call__(self):
-        from django.db import utils, transaction
+        self.inserter(self.model_class, self.models)
+        return self.model_class
+
+
+class StreamProceed(Proceed):
+    """
+    Inserts the objects of *model_class* kept by the StreamLoader *loader*
+    """
+    def __init__(self, model_class, loader):
+        super(StreamProceed, self).__init__(model_class, loader.stores[model_class], loader.inserter)
+        self.loader = loader
+
+    def __call__(self):
+        self.loader.flush(self.model_class)
+        return self.model_class
+
+
+class Inserter(object):
+    """
+    Inserts lists of models with ``bulk_create``.
+
+    When a list is rejected by the database, it's split in halves inserted
+    separately, until the rejected rows are isolated. A few rejected rows
+    amongst n are found in a few times log(n) queries. The rejected rows are
+    counted by model in ``rejected`` and written in the JSON lines file
+    *report*.
+
+    The databases deferring the foreign key checks to the commit, like
+    PostgreSQL and SQLite with the tables of Django, are made to check the
+    foreign keys of each insertion, so that the rows referencing missing rows
+    are isolated too, unless *check_constraints* is False.
+
+    With *ignore_conflicts*, the rows conflicting with the rows of the
+    database are skipped by the database itself, when it supports it. Those
+    rows are not reported.
+    """
+    def __init__(self, ignore_conflicts=False, report=None, check_constraints=True):
+        self.ignore_conflicts = ignore_conflicts
+        self.report = report
+        self.check_constraints = check_constraints
+        self.rejected = collections.Counter()
+        self.queries = 0
+        self._lock = threading.Lock()
+        self._report_file = None
+        self._checked_support = False
+
+    def __call__(self, model_class, models):
+        models = list(models)
+        if not models:
+            return
+
+        if self.ignore_conflicts and self._supports_ignore_conflicts():
+            self.queries += 1
+            model_class.objects.bulk_create(models, ignore_conflicts=True)
+        else:
+            self._bisect(model_class, models)
+
+    def _supports_ignore_conflicts(self):
+        from django.db import connection
+
+        supported = getattr(connection.features, 'supports_ignore_conflicts', False)
+        if not self._checked_support:
+            self._checked_support = True
+            if not supported:
+                info('The database does not support ignoring conflicts, isolating the rejected rows')
+        return supported
+
+    def _needs_check(self, model_class):
+        from django.db import connection, models
+
+        if not self.check_constraints or not connection.features.can_defer_constraint_checks:
+            return False
+        return any(isinstance(field, models.ForeignKey) for field in model_class._meta.local_fields)
+
+    def _bisect(self, model_class, models):
+        from django.db import connection, utils, transaction
 
         try:
+            self.queries += 1
             with transaction.atomic():
-                self.model_class.objects.bulk_create(self.models)
+                model_class.objects.bulk_create(models)
+                if self._needs_check(model_class):
+                    connection.check_constraints(table_names=[model_class._meta.db_table])
         except utils.IntegrityError as ie:
-            info('An error occured: %s , trying one by one', ie)
-            info('Already present are %s', self.model_class.objects.all())
-            for model in self.models:
-                try:
-                    with transaction.atomic():
-                        model.save(force_insert=True)
-                except utils.IntegrityError as ie:
-                    info('Error: cannot insert %s(%s), skip', self.model_class.__name__, model.__dict__)
+            if len(models) == 1:
+                self.reject(models[0], ie)
+            else:
+                debug('%s rejected %s rows, splitting', model_class.__name__, len(models))
+                middle = len(models) // 2
+                self._bisect(model_class, models[:middle])
+                self._bisect(model_class, models[middle:])
 
-        return self.model_class
+    def reject(self, model, exception):
+        from django.core.serializers import serialize
+
+        label = model._meta.label
+        info('Error: cannot insert %s(%s), skip: %s', label, model.pk, exception)
+        with self._lock:
+            self.rejected[label] += 1
+
+            if self.report:
+                if self._report_file is None:
+                    self._report_file = io.open(self.report, 'w', encoding='utf-8')
+                data, = json.loads(serialize('json', [model]))
+                data['error'] = text_type(exception)
+                self._report_file.write(text_type(json.dumps(data, sort_keys=True)) + u'\n')
+
+    def close(self):
+        if self._report_file is not None:
+            self._report_file.close()
+            self._report_file = None
 
 
 class Dependencies(collections.Set):
@@ -192,9 +1132,7 @@ class Dependencies(collections.Set):
         optional = []
         for f in model_class._meta.get_fields():
             if isinstance(f, (models.ForeignKey, models.ManyToManyField)):
-                relation = f.rel.to
-                while relation._meta.proxy:
-                    relation = relation._meta.proxy_for_model
+                relation = _related_model(f)
                 values.append(relation)
                 if f.null or isinstance(f, models.ManyToManyField):
                     optional.append(relation)
@@ -250,3 +1188,232 @@ class Dependencies(collections.Set):
 
     def issubset(self, other):
         return self._deps.issubset(other)
+
+
+def _related_model(field):
+    relation = field.remote_field.model if hasattr(field, 'remote_field') else field.rel.to
+    while relation._meta.proxy:
+        relation = relation._meta.proxy_for_model
+    return relation
+
+
+def strongly_connected_components(graph):
+    """
+    Returns the strongly connected components of *graph*, a dict of each node
+    to its successors, each component after the components it leads to.
+
+    This is Tarjan's algorithm, without recursion so that long chains of
+    models don't reach the recursion limit.
+    """
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    components = []
+
+    def visit(node):
+        index[node] = lowlink[node] = len(index)
+        stack.append(node)
+        on_stack.add(node)
+        return node, iter(graph[node])
+
+    for root in graph:
+        if root in index:
+            continue
+
+        work = [visit(root)]
+        while work:
+            node, successors = work[-1]
+            for successor in successors:
+                if successor not in index:
+                    work.append(visit(successor))
+                    break
+                elif successor in on_stack:
+                    lowlink[node] = min(lowlink[node], index[successor])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member is node:
+                            break
+                    components.append(component)
+    return components
+
+
+def _label(model_class):
+    return model_class._meta.label
+
+
+class LoadPlan(object):
+    """
+    The order in which the models are inserted, computed from *foreign_keys*,
+    a dict of each model to the list of its foreign keys, as tuples of the
+    field and the model it references.
+
+    The graph of the references between the models is split in strongly
+    connected components. In the components of models referencing each other,
+    or themselves, the nullable foreign keys to the models of the component
+    are ``deferred``: the objects are inserted with NULL and the values are
+    filled afterwards. The components are then sorted in ``levels``: the
+    models of a level reference only the models of the previous levels.
+
+    The models still referencing each other with foreign keys that are not
+    nullable are in ``cycles``, the models referencing with a foreign key
+    that is not nullable models that are not planned are in ``missing``.
+    """
+    def __init__(self, foreign_keys):
+        self.models = sorted(foreign_keys, key=_label)
+        self.deferred = collections.OrderedDict()
+        self.missing = collections.OrderedDict()
+        self.cycles = []
+
+        references = collections.OrderedDict((model_class, []) for model_class in self.models)
+        for model_class in self.models:
+            for field, related in foreign_keys[model_class]:
+                if related in references:
+                    references[model_class].append((field, related))
+                elif not field.null:
+                    self.missing.setdefault(model_class, []).append(related)
+
+        graph = self._graph(references)
+        for component in strongly_connected_components(graph):
+            members = set(component)
+            if len(component) == 1 and component[0] not in graph[component[0]]:
+                continue
+            for model_class in sorted(component, key=_label):
+                fields = [field for field, related in references[model_class] if related in members and field.null]
+                if fields:
+                    self.deferred[model_class] = fields
+
+        self.deferred = collections.OrderedDict(sorted(self.deferred.items(), key=lambda item: _label(item[0])))
+
+        graph = self._graph(references, exclude=self.deferred)
+        self.levels = []
+        level_of = {}
+        for component in strongly_connected_components(graph):
+            members = set(component)
+            if len(component) > 1 or component[0] in graph[component[0]]:
+                self.cycles.append(sorted(component, key=_label))
+
+            level = max([level_of[related] + 1 for model_class in component
+                         for related in graph[model_class] if related not in members] or [0])
+            if level == len(self.levels):
+                self.levels.append([])
+            self.levels[level].extend(component)
+            for model_class in component:
+                level_of[model_class] = level
+
+        for level in self.levels:
+            level.sort(key=_label)
+
+    @classmethod
+    def from_models(cls, model_classes, present=()):
+        """
+        Returns the plan of the Django *model_classes*, the references to the
+        models *present*, already inserted, are ignored.
+        """
+        from django.db import models
+
+        foreign_keys = {}
+        for model_class in model_classes:
+            foreign_keys[model_class] = [
+                (field, _related_model(field))
+                for field in model_class._meta.local_fields
+                if isinstance(field, models.ForeignKey) and _related_model(field) not in present
+            ]
+        return cls(foreign_keys)
+
+    @staticmethod
+    def _graph(references, exclude=None):
+        graph = collections.OrderedDict()
+        for model_class, fields in references.items():
+            excluded = (exclude or {}).get(model_class, [])
+            graph[model_class] = sorted(set(
+                related for field, related in fields if field not in excluded
+            ), key=_label)
+        return graph
+
+    def check(self, force=False):
+        """
+        Raises a RuntimeError when the plan has cycles or missing models,
+        unless *force* is set: the database has to accept them.
+        """
+        errors = []
+        for cycle in self.cycles:
+            errors.append('- {} reference each other'.format(', '.join(map(_label, cycle))))
+        for model_class, missing in self.missing.items():
+            errors.append('- {} references {}, not in the fixture'.format(
+                _label(model_class), ', '.join(map(_label, missing))))
+        if not errors:
+            return
+
+        message = 'Cannot order the models:\n{}'.format('\n'.join(errors))
+        if not force:
+            raise RuntimeError(message)
+        debug('== Force: %s ==', message)
+
+    def describe(self, counts=None):
+        """
+        Returns the plan as text, with the number of objects of each model of
+        *counts*.
+        """
+        def name(model_class):
+            if counts is None:
+                return _label(model_class)
+            return '{} ({})'.format(_label(model_class), counts[model_class])
+
+        lines = []
+        for number, level in enumerate(self.levels, 1):
+            lines.append('Level {}: {}'.format(number, ', '.join(map(name, level))))
+        for model_class, fields in self.deferred.items():
+            lines.append('Deferred: {}'.format(', '.join(
+                '{}.{}'.format(_label(model_class), field.name) for field in fields)))
+        for cycle in self.cycles:
+            lines.append('Cycle: {}'.format(', '.join(map(_label, cycle))))
+        for model_class, missing in self.missing.items():
+            lines.append('Missing: {} for {}'.format(', '.join(map(_label, missing)), _label(model_class)))
+        return '\n'.join(lines)
+
+    def defer(self, model_class, models):
+        """
+        Sets the deferred foreign keys of the *models* of *model_class* to
+        NULL and returns the models to fill, with their values.
+        """
+        fields = self.deferred.get(model_class, [])
+        deferred = []
+        for model in models:
+            values = [(field.attname, getattr(model, field.attname)) for field in fields]
+            if any(value is not None for attname, value in values):
+                deferred.append((model, values))
+                for attname, value in values:
+                    setattr(model, attname, None)
+        return deferred
+
+    def backfill(self, model_class, deferred, batch_size=1000):
+        """
+        Fills the foreign keys of the *deferred* models returned by ``defer``
+        with bulk updates.
+        """
+        if not deferred:
+            return
+
+        fields = self.deferred[model_class]
+        debug('Filling %s of %s %s', ', '.join(field.name for field in fields), len(deferred), model_class.__name__)
+        for model, values in deferred:
+            for attname, value in values:
+                setattr(model, attname, value)
+
+        manager = model_class._base_manager
+        for batch in batches(deferred, batch_size):
+            if hasattr(manager, 'bulk_update'):
+                manager.bulk_update([model for model, values in batch], [field.name for field in fields])
+            else:
+                for model, values in batch:
+                    manager.filter(pk=model.pk).update(**dict(values))
@@ -0,0 +1,117 @@
+/*
+ * r.js build worker used by sett.requirejs.RJSWorkerPool.
+ *
+ * Reads one JSON request per line on stdin: {"id": 1, "args": ["name=app", ...]}
+ * where args are the name=value options given to r.js -o, runs the build with
+ * requirejs.optimize and writes one JSON response per line on stdout:
+ * {"id": 1, "ok": true, "output": "<r.js build output>"} or
+ * {"id": 1, "ok": false, "error": "<message>"}.
+ *
+ * The logs of r.js are redirected to stderr to keep stdout for the protocol.
+ */
+'use strict';
+
+var readline = require('readline');
+
+console.log = console.error;
+console.info = console.error;
+console.warn = console.error;
+
+var requirejs = require('requirejs');
+
+// Same conversion as r.js command line arguments
+var NEED_ARRAY = {
+    'include': true,
+    'exclude': true,
+    'excludeShallow': true,
+    'insertRequire': true,
+    'stubModules': true,
+    'deps': true,
+    'mainConfigFile': true,
+    'wrap.startFile': true,
+    'wrap.endFile': true
+};
+
+function convertArgs(args) {
+    var config = {};
+    args.forEach(function (arg) {
+        var index = arg.indexOf('='),
+            prop,
+            value,
+            parts,
+            obj;
+
+        if (index === -1) {
+            throw new Error('Malformed name/value pair: [' + arg + ']. Format should be name=value');
+        }
+
+        prop = arg.substring(0, index);
+        value = arg.substring(index + 1);
+        if (value === 'true') {
+            value = true;
+        } else if (value === 'false') {
+            value = false;
+        }
+
+        if (NEED_ARRAY[prop]) {
+            value = value.split(',');
+        }
+
+        parts = prop.split('.');
+        obj = config;
+        while (parts.length > 1) {
+            prop = parts.shift();
+            obj = obj[prop] = obj[prop] || {};
+        }
+        obj[parts[0]] = value;
+    });
+    return config;
+}
+
+function reply(response) {
+    process.stdout.write(JSON.stringify(response) + '\n');
+}
+
+var queue = [];
+var busy = false;
+
+function next() {
+    var request, config;
+
+    if (busy || !queue.length) {
+        return;
+    }
+
+    request = queue.shift();
+    busy = true;
+
+    function done(response) {
+        response.id = request.id;
+        reply(response);
+        busy = false;
+        next();
+    }
+
+    try {
+        config = convertArgs(request.args);
+    } catch (e) {
+        done({ok: false, error: String(e)});
+        return;
+    }
+
+    requirejs.optimize(config, function (output) {
+        done({ok: true, output: output});
+    }, function (err) {
+        done({ok: false, error: String(err)});
+    });
+}
+
+readline.createInterface({input: process.stdin, terminal: false}).on('line', function (line) {
+    if (!line) {
+        return;
+    }
+    queue.push(JSON.parse(line));
+    next();
+}).on('close', function () {
+    process.exitCode = 0;
+});
@@ -1,8 +1,10 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import pickle
 import threading
 import collections
+import multiprocessing
 try:
     import Queue as queue
 except ImportError:
@@ -10,26 +12,295 @@ except ImportError:
 
 from sett import defaults
 from paver.easy import debug
+from paver.deps.six import PY3
 
 
 def parallel(fn=None, **kw):
+    """
+    Decorates *fn* to run it in parallel. The keyword *backend* selects the
+    implementation amongst ``threaded``, ``process`` and ``linear`` and
+    defaults to ``defaults.PARALLEL_BACKEND``. The keyword *n* is the number
+    of workers, ``'auto'`` sizes the pool from the number of CPUs and defaults
+    to ``defaults.PARALLEL_JOBS``.
+
+    >>> @parallel(backend='process', n='auto')
+    ... def compile(filename):
+    ...     pass
+    """
     def inner_parallel(fn):
-        debug('Running %s %s ', 'parallel' if defaults.USE_THREADING else 'linear', fn)
-        if not defaults.USE_THREADING or kw.get('n') == 1:
-            return Linear(fn, **kw)
-        return Threaded(fn, **kw)
+        options = dict(kw)
+        options.setdefault('n', defaults.PARALLEL_JOBS)
+        backend = options.pop('backend', None) or defaults.PARALLEL_BACKEND
+        if not defaults.USE_THREADING or pool_size(options['n']) == 1:
+            backend = 'linear'
+
+        if backend not in BACKENDS:
+            raise ValueError('Unknown parallel backend {}, expected one of {}'.format(
+                backend, ', '.join(sorted(BACKENDS))))
+
+        debug('Running %s %s ', backend, fn)
+        return BACKENDS[backend](fn, **options)
 
     if fn is None:
         return inner_parallel
     return inner_parallel(fn)
 
 
-class Linear(object):
-    def __init__(self, fn, n=1):
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def pool_size(n, jobs=None):
+    """
+    Returns the number of workers for *n*. When *n* is ``'auto'``, it's the
+    number of CPUs, but not more than the number of *jobs* if it's known.
+    """
+    if n != 'auto':
+        return int(n)
+
+    n = cpu_count()
+    if jobs is not None:
+        n = min(n, jobs)
+    return max(n, 1)
+
+
+class Cancelled(Exception):
+    """Raised when getting the result of a call that has been cancelled"""
+
+
+class Future(object):
+    """
+    The handle on a call of a parallel function. It gives access to the result
+    or the exception of the call once it's done.
+
+    >>> result = render(template)
+    >>> result.result()  # Blocks until render returns
+    """
+    PENDING, RUNNING, FINISHED, CANCELLED = range(4)
+
+    def __init__(self, args=(), kw=None):
+        self.args = args
+        self.kw = kw or {}
+        self.state = Future.PENDING
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+
+    def __repr__(self):
+        return 'Future({}, {})'.format(Failure(self.args, self.kw, None).call, self.state)
+
+    def done(self):
+        return self._event.is_set()
+
+    def cancelled(self):
+        return self.state == Future.CANCELLED
+
+    def successful(self):
+        return self.done() and not self.cancelled() and self._exception is None
+
+    def wait(self, timeout=None):
+        """Waits for the call to be done, returns False on timeout"""
+        self._event.wait(timeout)
+        return self.done()
+
+    def result(self, timeout=None):
+        """
+        Returns the value returned by the call or raises its exception. It
+        raises ``Cancelled`` if the call has been cancelled.
+        """
+        if not self.wait(timeout):
+            raise RuntimeError('{!r} is not done'.format(self))
+        if self.cancelled():
+            raise Cancelled('{!r} has been cancelled'.format(self))
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self.wait(timeout):
+            raise RuntimeError('{!r} is not done'.format(self))
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """Calls *fn* with the future when it's done or now if it's already done"""
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def set_running(self):
+        """Returns False if the call has been cancelled and must not run"""
+        with self._lock:
+            if self.state != Future.PENDING:
+                return False
+            self.state = Future.RUNNING
+            return True
+
+    def cancel(self):
+        """Cancels the call if it's not running yet and returns if it succeeded"""
+        with self._lock:
+            if self.state != Future.PENDING:
+                return False
+            self.state = Future.CANCELLED
+        self._finish()
+        return True
+
+    def set_result(self, result):
+        with self._lock:
+            self._result = result
+            self.state = Future.FINISHED
+        self._finish()
+
+    def set_exception(self, exception):
+        with self._lock:
+            self._exception = exception
+            self.state = Future.FINISHED
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+class BaseParallel(object):
+    """
+    The calls to a parallel function return a ``Future``. The results can
+    also be consumed with ``map`` and ``imap_unordered``. When *fail_fast* is
+    set, the first failure cancels the calls that are not started yet.
+    """
+    INITIAL, STARTED, ENDING, ENDED = range(4)
+
+    def __init__(self, fn, n=4, fail_fast=False):
         self._fn = fn
+        self._n = n
+        self._fail_fast = fail_fast
+        self._futures = []
+        self._cancelling = False
+        self.status = BaseParallel.INITIAL
+        self.failed_tasks = []
+
+    def for_each(self, iterable):
+        try:
+            self._submit_all(iterable)
+        finally:
+            self.wait()
+
+    def map(self, iterable):
+        """
+        Calls the function with each item of *iterable* and yields the results
+        in the order of *iterable*. The failed calls are skipped and are
+        reported by ``wait`` once all calls are done.
+        """
+        futures = self._submit_all(iterable)
+        try:
+            for future in futures:
+                future.wait()
+                if future.successful():
+                    yield future.result()
+        finally:
+            self.wait()
+
+    def imap_unordered(self, iterable):
+        """
+        Calls the function with each item of *iterable* and yields the results
+        as soon as each call is done. The failed calls are skipped and are
+        reported by ``wait`` once all calls are done.
+
+        >>> for bundle in build.imap_unordered(apps):
+        ...     upload(bundle)
+        """
+        done = queue.Queue()
+        futures = self._submit_all(iterable)
+        for future in futures:
+            future.add_done_callback(done.put)
+
+        try:
+            for x in range(len(futures)):
+                future = done.get()
+                if future.successful():
+                    yield future.result()
+        finally:
+            self.wait()
+
+    def _submit_all(self, iterable):
+        if self.status == BaseParallel.INITIAL and hasattr(iterable, '__len__'):
+            self.start(len(iterable))
+        return [self(i) for i in iterable]
+
+    def _submit(self, args, kw):
+        future = Future(args, kw)
+        self._futures.append(future)
+        if self._cancelling:
+            future.cancel()
+        return future
+
+    def _run(self, future):
+        """Runs the call of the future, returns False if it failed"""
+        if not future.set_running():
+            return True
+
+        try:
+            future.set_result(self._fn(*future.args, **future.kw))
+        except Exception as e:
+            self._failed(future, e)
+            return False
+        return True
+
+    def _failed(self, future, e):
+        self.failed_tasks.append(Failure(future.args, future.kw, e))
+        future.set_exception(e)
+        if self._fail_fast:
+            self.cancel()
+
+    def cancel(self):
+        """Cancels all the calls that are not started"""
+        self._cancelling = True
+        cancelled = sum(1 for future in list(self._futures) if future.cancel())
+        debug('Cancelled %s calls of %s', cancelled, self._fn)
+
+    def start(self, jobs=None):
+        raise NotImplementedError()
+
+    def _raise_failures(self):
+        if self.failed_tasks:
+            raise RuntimeError('Those tasks failed: {}'.format(
+                '\n--\n'.join('{}{!r}'.format(self._fn, ft) for ft in self.failed_tasks)
+            ))
+
+
+class Linear(BaseParallel):
+    """
+    Runs the calls one after the other when they're made. Exceptions are
+    raised immediately.
+    """
+    def __init__(self, fn, n=1, fail_fast=True):
+        super(Linear, self).__init__(fn, 1, fail_fast)
+
+    def __repr__(self):
+        return 'Linear<{!r}>'.format(self._fn)
+
+    def start(self, jobs=None):
+        pass
 
     def __call__(self, *args, **kw):
-        return self._fn(*args, **kw)
+        future = Future(args, kw)
+        future.set_running()
+        try:
+            result = self._fn(*args, **kw)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        future.set_result(result)
+        return future
 
     def wait(self):
         return True
@@ -38,29 +309,25 @@ class Linear(object):
         for i in iterable:
             self(i)
 
+    def map(self, iterable):
+        for i in iterable:
+            yield self(i).result()
 
-class Threaded(object):
-    INITIAL, STARTED, ENDING, ENDED = range(4)
+    imap_unordered = map
 
-    def __init__(self, fn, n=4):
-        self._fn = fn
+
+class Threaded(BaseParallel):
+    def __init__(self, fn, n=4, fail_fast=False):
+        super(Threaded, self).__init__(fn, n, fail_fast)
         self._queue = queue.Queue()
-        self._threads = [threading.Thread(target=self._worker(x)) for x in range(n)]
-        self.status = Threaded.INITIAL
-        self.failed_tasks = []
+        self._threads = []
 
     def __repr__(self):
-        return 'Threaded({}, {})<{!r}>'.format(len(self._threads), self.status, self._fn)
-
-    def for_each(self, iterable):
-        try:
-            for i in iterable:
-                self(i)
-        finally:
-            self.wait()
+        return 'Threaded({}, {})<{!r}>'.format(self._n, self.status, self._fn)
 
-    def start(self):
+    def start(self, jobs=None):
         assert self.status == Threaded.INITIAL
+        self._threads = [threading.Thread(target=self._worker(x)) for x in range(pool_size(self._n, jobs))]
         debug('Starting %s threads', len(self._threads))
         for t in self._threads:
             t.start()
@@ -69,15 +336,13 @@ class Threaded(object):
     def _worker(self, n):
         def worker():
             while True:
+                future = self._queue.get()
                 try:
-                    args, kw = self._queue.get()
-                    if args is None:
+                    if future is None:
                         debug('%s: I see the light at the end of the tunnel', n)
                         break
                     debug('%s: Got a task', n)
-                    self._fn(*args, **kw)
-                except Exception as e:
-                    self.failed_tasks.append(Failure(args, kw, e))
+                    self._run(future)
                 finally:
                     debug('%s: Finishing a task', n)
                     self._queue.task_done()
@@ -90,7 +355,10 @@ class Threaded(object):
             self.start()
 
         assert self.status == Threaded.STARTED
-        self._queue.put((args, kw))
+        future = self._submit(args, kw)
+        if not future.done():
+            self._queue.put(future)
+        return future
 
     def wait(self):
         if self.status == Threaded.INITIAL:
@@ -102,25 +370,163 @@ class Threaded(object):
         self._queue.join()
 
         for t in self._threads:
-            self._queue.put((None, None))
+            self._queue.put(None)
 
         debug('Waiting threads')
         for t in self._threads:
             t.join()
 
         self.status = Threaded.ENDED
-        if self.failed_tasks:
-            raise RuntimeError('Those tasks failed: {}'.format(
-                '\n--\n'.join('{}{!r}'.format(self._fn, ft) for ft in self.failed_tasks)
-            ))
+        self._raise_failures()
         return True
 
 
-class Failure(collections.namedtuple('_Failure', ['args', 'kw', 'e'])):
+_process_fn = None
+
+
+def _process_init(fn):
+    global _process_fn
+    _process_fn = fn
+
+
+def _process_call(args, kw):
+    try:
+        result = _process_fn(*args, **kw)
+    except Exception as e:
+        try:
+            pickle.dumps(e)
+        except Exception:
+            e = RuntimeError('{}: {}'.format(e.__class__.__name__, e))
+        return False, e
+
+    if not PY3:
+        # The pool of Python 2 never calls back when it cannot send a result
+        try:
+            pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            return False, RuntimeError('Cannot send the result: {}'.format(e))
+    return True, result
+
+
+class Process(BaseParallel):
+    """
+    Runs the function in a pool of processes. It suits CPU bound functions
+    that do not release the GIL.
+
+    The function is given to the workers when they start, so it does not need
+    to be picklable on platforms that fork, but the arguments, the return
+    values and the exceptions do, else the call fails with a RuntimeError.
+
+    The calls are handed to the pool as soon as a worker is available, the
+    other calls wait in the parent process, so that they can be cancelled.
+    """
+    def __init__(self, fn, n=4, fail_fast=False):
+        super(Process, self).__init__(fn, n, fail_fast)
+        self._pool = None
+        self._size = None
+        self._pending = collections.deque()
+        self._running = 0
+        self._lock = threading.Lock()
+
     def __repr__(self):
-        return '({args}{comma}{kwargs})\n => {e.__class__.__name__}({e})'.format(
+        return 'Process({}, {})<{!r}>'.format(self._n, self.status, self._fn)
+
+    def start(self, jobs=None):
+        assert self.status == Process.INITIAL
+        self._size = pool_size(self._n, jobs)
+        debug('Starting %s processes', self._size)
+        self._pool = multiprocessing.Pool(self._size, initializer=_process_init, initargs=(self._fn, ))
+        self.status = Process.STARTED
+
+    def __call__(self, *args, **kw):
+        if self.status == Process.INITIAL:
+            self.start()
+
+        assert self.status == Process.STARTED
+        future = self._submit(args, kw)
+        if not PY3 and not future.done():
+            # Nor when it cannot send the arguments
+            try:
+                pickle.dumps((args, kw), pickle.HIGHEST_PROTOCOL)
+            except Exception as e:
+                future.set_running()
+                self._failed(future, RuntimeError('Cannot send the arguments: {}'.format(e)))
+        if not future.done():
+            with self._lock:
+                self._pending.append(future)
+            self._dispatch()
+        return future
+
+    def _dispatch(self):
+        with self._lock:
+            while self._pending and self._running < self._size:
+                future = self._pending.popleft()
+                if not future.set_running():
+                    continue
+                self._running += 1
+
+                callback = self._callback(future)
+                options = {'callback': callback}
+                if PY3:
+                    # Errors of the pool itself, like an unpicklable result
+                    options['error_callback'] = lambda e: callback((False, e))
+                self._pool.apply_async(_process_call, (future.args, future.kw), **options)
+
+    def _callback(self, future):
+        def callback(result):
+            with self._lock:
+                self._running -= 1
+
+            success, value = result
+            if success:
+                future.set_result(value)
+            else:
+                self._failed(future, value)
+            self._dispatch()
+        return callback
+
+    def wait(self):
+        if self.status == Process.INITIAL:
+            return
+
+        assert self.status == Process.STARTED
+        self.status = Process.ENDING
+
+        try:
+            for future in list(self._futures):
+                future.wait()
+        except BaseException:
+            self._pool.terminate()
+            raise
+        else:
+            self._pool.close()
+        finally:
+            debug('Waiting processes')
+            self._pool.join()
+
+        self.status = Process.ENDED
+        self._raise_failures()
+        return True
+
+
+class Failure(collections.namedtuple('_Failure', ['args', 'kw', 'e'])):
+    @property
+    def call(self):
+        return '({args}{comma}{kwargs})'.format(
             comma=',' if self.args and self.kw else '',
             args=', '.join(repr(a) for a in self.args),
             kwargs=', '.join('{}={!r}'.format(k, v) for k, v in self.kw.items()),
+        )
+
+    def __repr__(self):
+        return '{call}\n => {e.__class__.__name__}({e})'.format(
+            call=self.call,
             e=self.e
         )
+
+
+BACKENDS = {
+    'linear': Linear,
+    'threaded': Threaded,
+    'process': Process,
+}
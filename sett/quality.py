@@ -1,10 +1,50 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+"""
+Quality
+=======
+
+The *quality* task runs flake8 on the python files of the top-level packages.
+
+The files are split in shards linted concurrently by
+``defaults.QUALITY_JOBS`` flake8 processes. The report of each file is kept
+in the cache directory with the hash of the file and of the flake8
+configuration, only the files modified since the last run are linted again.
+
+    $ paver quality
+    $ paver quality --force  # lints all the files
+
+The report is parsed line by line into violations written as they come in
+each of the requested formats: text (``--output``, the flake8 format), JSON
+(``--json``), checkstyle (``--checkstyle``) and JUnit (``--junit``) XML.
+
+    $ paver quality -o flake8.log --checkstyle checkstyle.xml --junit flake8.xml
+
+With ``--since``, only the python files of the packages changed since a git
+ref, including the changes not committed, are linted and with
+``--importers``, the files importing their modules too.
+
+    $ paver quality --since origin/master --importers
+"""
+
+import re
+import os
+import ast
 import sys
+import json
+import math
+import time
+import hashlib
+import subprocess
+import collections
+from xml.sax.saxutils import escape, quoteattr
 
-from paver.easy import task, needs, cmdopts, sh, error, options, debug
-from sett import which
+from paver.easy import task, needs, cmdopts, error, options, debug, info, path, BuildFailure
+from sett import which, defaults, parallel, ROOT
+from sett.parallel import pool_size
+from sett.git import changed_files
+from sett.utils.fs import atomic_write, file_hash
 
 
 # Errors codes:
@@ -34,63 +74,375 @@ WARNING_CODES = {
 
 
 class CodesSet(object):
+    """
+    A set of codes and prefixes of codes: E1 contains E101 and E12. The values
+    are compiled in a single regular expression matching the codes starting
+    with one of them.
+    """
     def __init__(self, values):
         self.values = frozenset(values)
+        prefixes = sorted((value for value in self.values if value), key=lambda value: (-len(value), value))
+        if prefixes:
+            self._match = re.compile('|'.join(re.escape(prefix) for prefix in prefixes)).match
+        else:
+            self._match = lambda code: None
 
     def __repr__(self):
         return 'CodesSet({{{}}})'.format(', '.join(repr(x) for x in self.values))
 
     def __contains__(self, code):
-        return any(code[0:x + 1] in self.values
-                   for x in range(len(code)))
+        return self._match(code) is not None
+
+
+class Violation(collections.namedtuple('_Violation', ['filename', 'line', 'column', 'code', 'message'])):
+    """
+    A line of the flake8 report. The lines that are not in the format of
+    flake8 have no filename and the first word as code.
+    """
+    LINE_RE = re.compile(r'^(?P<filename>.+?):(?P<line>\d+):(?:(?P<column>\d+):)?\s*(?P<code>\S+)\s?(?P<message>.*)$')
+
+    @classmethod
+    def parse(cls, line):
+        line = line.rstrip('\r\n')
+        match = cls.LINE_RE.match(line)
+        if match is None:
+            return cls(None, None, None, (line.split() or [''])[0], line)
+        return cls(
+            match.group('filename'),
+            int(match.group('line')),
+            int(match.group('column') or 0),
+            match.group('code'),
+            match.group('message'),
+        )
+
+    def __str__(self):
+        if self.filename is None:
+            return self.message
+        return '{}:{}:{}: {} {}'.format(self.filename, self.line, self.column, self.code, self.message)
+
+
+def module_name(filename):
+    """
+    Returns the dotted name of the module of the python file *filename*,
+    relative to the current directory.
+    """
+    parts = os.path.normpath(os.path.splitext(filename)[0]).split(os.sep)
+    if parts[-1] == '__init__':
+        parts.pop()
+    return '.'.join(parts)
+
+
+def imported_modules(filename):
+    """
+    Returns the names of the modules imported by the python file *filename*,
+    with the relative imports resolved. The names imported from a module are
+    included as they may be submodules.
+    """
+    try:
+        with open(filename, 'rb') as handle:
+            tree = ast.parse(handle.read(), filename)
+    except (IOError, OSError, SyntaxError, ValueError) as e:
+        debug('Cannot parse %s: %s', filename, e)
+        return set()
+
+    package = module_name(filename).split('.')
+    if os.path.basename(filename) != '__init__.py':
+        package.pop()
+
+    modules = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            if node.level:
+                parts = package[:len(package) - node.level + 1]
+                if node.module:
+                    parts.append(node.module)
+                module = '.'.join(parts)
+            else:
+                module = node.module
+            modules.add(module)
+            modules.update('{}.{}'.format(module, alias.name) for alias in node.names)
+    return modules
+
+
+class ReportCache(object):
+    """
+    The flake8 report of each file and the key of the run that wrote it, kept
+    in *cache_file*.
+    """
+    def __init__(self, cache_file=None):
+        self.cache_file = cache_file
+        self._entries = {}
+
+    def load(self):
+        if not self.cache_file:
+            return
+
+        try:
+            with open(self.cache_file, 'r') as cache_file:
+                self._entries = json.load(cache_file)
+        except (IOError, OSError, ValueError) as e:
+            debug('Cannot read %s: %s', self.cache_file, e)
+
+    def save(self):
+        if self.cache_file:
+            atomic_write(self.cache_file, json.dumps(self._entries).encode('utf-8'))
+
+    def get(self, filename, key):
+        """
+        Returns the lines of the report of *filename* written by the run
+        *key*, or None.
+        """
+        cached = self._entries.get(filename)
+        if not cached or cached['key'] != key:
+            return None
+        return cached['report']
+
+    def set(self, filename, key, report):
+        self._entries[filename] = {'key': key, 'report': report}
 
 
 class QualityChecker(object):
-    def __init__(self, warning_codes=None, error_codes=None):
-        self.warning_codes = CodesSet(warning_codes) or frozenset()
-        self.error_codes = CodesSet(error_codes) or frozenset()
+    """
+    Runs flake8 on the python files of the packages and classifies the codes
+    of the report.
+
+    The files are linted by shards by *jobs* concurrent flake8 processes. The
+    report of each file is kept in *cache_file* with the hash of the file and
+    of the flake8 configuration and the files that did not change are not
+    linted again, unless *force* is set.
+    """
+    CONFIG_FILES = ['setup.cfg', 'tox.ini', '.flake8']
 
-    def __call__(self):
+    def __init__(self, warning_codes=None, error_codes=None, jobs=1, cache_file=None, force=False):
+        self.warning_codes = CodesSet(warning_codes or ())
+        self.error_codes = CodesSet(error_codes or ())
+        self.jobs = jobs
+        self.force = force
+        self.cache = ReportCache(cache_file)
+        self.stats = collections.Counter()
+        self._config_hash = None
+        self._levels = {}
+
+    @classmethod
+    def default(cls, force=False):
+        return cls(
+            WARNING_CODES,
+            ERROR_CODES,
+            jobs=defaults.QUALITY_JOBS,
+            cache_file=ROOT.joinpath(defaults.CACHE_DIR, 'flake8.json'),
+            force=force,
+        )
+
+    def __call__(self, writers=(), since=None, importers=False):
+        """
+        Lints the packages, or their files changed since the git ref *since*,
+        writes each violation with the *writers* and returns the
+        QualityReport.
+        """
         packages = [package for package in options.setup['packages'] if '.' not in package]
-        report = self.call_flake8(packages)
-        codes = self.get_codes(report)
-        return QualityReport(report,
-                             has_errors=any(c in self.error_codes for c in codes),
-                             has_failures=any(c not in self.warning_codes for c in codes),
-                             has_warnings=any(c in self.warning_codes for c in codes),
-                             )
-
-    def call_flake8(self, packages):
-        flake8_command = [which.flake8, '--exit-zero']
-        flake8_command.extend(packages)
-        return sh(flake8_command, capture=True)
-
-    def get_codes(self, report):
-        codes = set()
-        for line in report.split('\n'):
-            if not line:
+        files = self.discover(packages)
+        if since:
+            files = self.changed(files, since, importers)
+
+        report = QualityReport()
+        for line in self.lint(files):
+            if not line.strip():
                 continue
-            code = line.split(':', 3)[-1].strip().split()[0]
-            codes.add(code)
-        return codes
+            violation = Violation.parse(line)
+            level = self.classify(violation.code)
+            report.add(level)
+            for writer in writers:
+                writer.write(violation, level)
+        return report
+
+    def discover(self, packages):
+        """
+        Returns the python files of the *packages*
+        """
+        files = []
+        for package in packages:
+            if os.path.isdir(package):
+                files.extend(sorted(path(package).walkfiles('*.py')))
+            elif os.path.isfile(package + '.py'):
+                files.append(path(package + '.py'))
+        return [os.path.normpath(filename) for filename in files]
+
+    def changed(self, files, since, importers=False):
+        """
+        Returns the *files* changed since the git ref *since* and, with
+        *importers*, the *files* importing the modules of the changed files.
+        """
+        changed = set(changed_files(since, ['*.py'])).intersection(files)
+        selected = set(changed)
+        if importers and changed:
+            modules = set(module_name(filename) for filename in changed)
+            selected.update(filename for filename in files
+                            if filename not in changed and imported_modules(filename) & modules)
+
+        info('Linting %s files changed since %s and %s files importing them',
+             len(changed), since, len(selected) - len(changed))
+        return [filename for filename in files if filename in selected]
+
+    def config_hash(self):
+        """
+        Returns the hash of the flake8 executable and of its configuration
+        files.
+        """
+        if self._config_hash is None:
+            digest = hashlib.sha1(which.flake8.encode('utf-8'))
+            for config_file in self.CONFIG_FILES:
+                if os.path.isfile(config_file):
+                    digest.update(config_file.encode('utf-8'))
+                    digest.update(file_hash(config_file).encode('utf-8'))
+            self._config_hash = digest.hexdigest()
+        return self._config_hash
+
+    def key(self, filename):
+        return [file_hash(filename), self.config_hash()]
+
+    def call_flake8(self, files):
+        """
+        Yields the lines of the report of flake8 on the *files* as they are
+        written.
+        """
+        # The concurrency is given by the shards
+        flake8_command = [which.flake8, '--exit-zero', '--jobs', '1']
+        flake8_command.extend(files)
+        debug('Running %s', ' '.join(flake8_command))
+
+        process = subprocess.Popen(flake8_command, stdout=subprocess.PIPE, universal_newlines=True)
+        try:
+            for line in process.stdout:
+                yield line
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+
+        if returncode:
+            raise BuildFailure('flake8 failed with code {}'.format(returncode))
+
+    def _lint_shard(self, shard):
+        """
+        Lints the *shard*, a list of filenames and keys, and returns the
+        lines of the report of each file and the lines of no file.
+        """
+        reports = collections.OrderedDict((filename, []) for filename, key in shard)
+        others = []
+        for line in self.call_flake8(list(reports)):
+            filename = os.path.normpath(line.split(':', 1)[0]) if line.strip() else None
+            if filename in reports:
+                reports[filename].append(line)
+            elif line.strip():
+                others.append(line)
+        return [(filename, key, reports[filename]) for filename, key in shard], others
+
+    def lint(self, files):
+        """
+        Yields the lines of the flake8 report of the *files*, in the order of
+        the files. The cached reports are yielded as their file is reached,
+        the stale files are linted concurrently by contiguous shards and only
+        the shards finished before the file they start with is reached are
+        kept.
+        """
+        self.cache.load()
+
+        keys = collections.OrderedDict()
+        stale = []
+        for filename in files:
+            if filename in keys:
+                continue
+            key = keys[filename] = self.key(filename)
+            if self.force or self.cache.get(filename, key) is None:
+                stale.append((filename, key))
+        self.stats['hits'] += len(keys) - len(stale)
+        self.stats['misses'] += len(stale)
+
+        shard_of = {}
+        results = iter(())
+        if stale:
+            start = time.time()
+            n = min(pool_size(self.jobs, len(stale)), len(stale))
+            size = int(math.ceil(len(stale) / float(n)))
+            shards = [stale[i:i + size] for i in range(0, len(stale), size)]
+            for index, shard in enumerate(shards):
+                shard_of.update((filename, index) for filename, key in shard)
+            linter = parallel(self._lint_shard, backend='threaded', n=len(shards))
+            results = linter.imap_unordered(shards)
+
+        done = {}
+        others = []
+        try:
+            for filename, key in keys.items():
+                if filename not in shard_of:
+                    report = self.cache.get(filename, key)
+                else:
+                    while shard_of[filename] not in done:
+                        shard_reports, shard_others = next(results)
+                        for report_filename, report_key, report in shard_reports:
+                            if not shard_others:
+                                self.cache.set(report_filename, report_key, report)
+                        done[shard_of[shard_reports[0][0]]] = dict(
+                            (report_filename, report) for report_filename, report_key, report in shard_reports)
+                        others.extend(shard_others)
+                    report = done[shard_of[filename]].pop(filename)
+
+                for line in report:
+                    yield line
+        finally:
+            if stale:
+                self.cache.save()
+
+        if stale:
+            info('Linted %s files in %.2fs, %s up to date', len(stale), time.time() - start, self.stats['hits'])
+        for line in others:
+            yield line
+
+    def classify(self, code):
+        """
+        Returns the level of the *code*: error, warning or failure
+        """
+        level = self._levels.get(code)
+        if level is None:
+            if code in self.error_codes:
+                level = 'error'
+            elif code in self.warning_codes:
+                level = 'warning'
+            else:
+                level = 'failure'
+            self._levels[code] = level
+        return level
 
 
 class QualityReport(object):
     """
-    Quality Report contains the raw result of the report from flake8 and
-    boolean values corresponding to the level of failure.
+    Quality Report counts the violations of the report from flake8 by level
+    of failure.
 
-    The report is falsy if it does not contains any error. Then warning,
+    The report is falsy if it does not contains any violation. Then warning,
     failure, and errors respectively show if the report contains simple
     *warnings* that should not invalidate the quality, substantial *failures*
     that should invalidate the quality but still let the tests run and critical
     *errors* that prevent the process from continuing.
     """
-    def __init__(self, text_report, has_errors, has_warnings, has_failures):
-        self.text_report = text_report
-        self.has_warnings = has_warnings
-        self.has_errors = has_errors
-        self.has_failures = has_failures
+    def __init__(self):
+        self.counts = collections.Counter()
+
+    def add(self, level):
+        self.counts[level] += 1
+
+    @property
+    def has_errors(self):
+        return bool(self.counts['error'])
+
+    @property
+    def has_failures(self):
+        return bool(self.counts['failure'] or self.counts['error'])
+
+    @property
+    def has_warnings(self):
+        return bool(self.counts['warning'])
 
     @property
     def level(self):
@@ -104,13 +456,10 @@ class QualityReport(object):
             return 1
 
     def __bool__(self):
-        return bool(self.text_report)
+        return any(self.counts.values())
 
     __nonzero__ = __bool__
 
-    def write(self, outfile):
-        outfile.write(self.text_report)
-
     def __repr__(self):
         if not self:
             return '<Report good>'
@@ -122,28 +471,163 @@ class QualityReport(object):
             return '<Report warning>'
 
 
+class TextWriter(object):
+    """
+    Writes the violations in the format of flake8
+    """
+    def __init__(self, outfile):
+        self.outfile = outfile
+
+    def write(self, violation, level):
+        self.outfile.write('{}\n'.format(violation))
+
+    def close(self):
+        pass
+
+
+class JSONWriter(object):
+    """
+    Writes the violations in a JSON list of objects
+    """
+    def __init__(self, outfile):
+        self.outfile = outfile
+        self.outfile.write('[')
+        self._separator = '\n'
+
+    def write(self, violation, level):
+        data = violation._asdict()
+        data['level'] = level
+        self.outfile.write(self._separator + json.dumps(data, sort_keys=True))
+        self._separator = ',\n'
+
+    def close(self):
+        self.outfile.write('\n]\n')
+
+
+class XMLWriter(object):
+    """
+    Writes the violations grouped by file in XML, the violations of a file
+    are expected to follow each other.
+    """
+    def __init__(self, outfile):
+        self.outfile = outfile
+        self.outfile.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        self.outfile.write(self.header)
+        self._filename = self._group = None
+
+    def write(self, violation, level):
+        filename = violation.filename or 'flake8'
+        if filename != self._filename:
+            self._close_group()
+            self._filename, self._group = filename, []
+        self._group.append((violation, level))
+
+    def _close_group(self):
+        if self._group:
+            self.write_group(self._filename, self._group)
+        self._group = None
+
+    def close(self):
+        self._close_group()
+        self.outfile.write(self.footer)
+
+
+class CheckstyleWriter(XMLWriter):
+    """
+    Writes the violations in the checkstyle XML format. The errors and
+    failures have the error severity.
+    """
+    header = '<checkstyle version="4.3">\n'
+    footer = '</checkstyle>\n'
+
+    def write_group(self, filename, violations):
+        self.outfile.write('  <file name={}>\n'.format(quoteattr(filename)))
+        for violation, level in violations:
+            self.outfile.write('    <error line="{}" column="{}" severity="{}" message={} source={}/>\n'.format(
+                violation.line or 0,
+                violation.column or 0,
+                'warning' if level == 'warning' else 'error',
+                quoteattr(violation.message),
+                quoteattr('flake8.{}'.format(violation.code)),
+            ))
+        self.outfile.write('  </file>\n')
+
+
+class JUnitWriter(XMLWriter):
+    """
+    Writes the violations in the JUnit XML format, a failed test case by
+    file. The counts of the test suite are not written as they are not known
+    until the end.
+    """
+    header = '<testsuite name="flake8">\n'
+    footer = '</testsuite>\n'
+
+    def __init__(self, outfile):
+        super(JUnitWriter, self).__init__(outfile)
+        self._files = 0
+
+    def write_group(self, filename, violations):
+        self._files += 1
+        self.outfile.write('  <testcase classname="flake8" name={}>\n'.format(quoteattr(filename)))
+        self.outfile.write('    <failure message={}>{}</failure>\n'.format(
+            quoteattr('{} violations'.format(len(violations))),
+            escape('\n'.join(str(violation) for violation, level in violations)),
+        ))
+        self.outfile.write('  </testcase>\n')
+
+    def close(self):
+        self._close_group()
+        if not self._files:
+            self.outfile.write('  <testcase classname="flake8" name="flake8"/>\n')
+        self.outfile.write(self.footer)
+
+
+WRITERS = collections.OrderedDict([
+    ('output', TextWriter),
+    ('json', JSONWriter),
+    ('checkstyle', CheckstyleWriter),
+    ('junit', JUnitWriter),
+])
+
+
 @task
 @needs(['setup_options'])
 @cmdopts([
     ('output=', 'o', 'Output of the flake8 report'),
+    ('json=', None, 'Output of the report in JSON'),
+    ('checkstyle=', None, 'Output of the report in checkstyle XML'),
+    ('junit=', None, 'Output of the report in JUnit XML'),
     ('stricness', 's', 'Strictness of the report, 1=warning, [2=failures], 3=errors'),
+    ('force', 'f', 'Lint all the files, ignoring the cache'),
+    ('since=', None, 'Only lint the python files changed since this git ref'),
+    ('importers', None, 'With --since, also lint the files importing the changed modules'),
 ])
 def quality(options):
     """Enforces PEP8"""
-    qc = QualityChecker(WARNING_CODES, ERROR_CODES)
-    report = qc()
-    debug('Report is %s', report)
-
-    out = getattr(options, 'output', '-')
-    if out == '-':
-        outfile = sys.stdout
-    else:
-        outfile = open(out, 'w')
+    qc = QualityChecker.default(force=bool(getattr(options, 'force', False)))
+
+    outputs = {'output': '-'}
+    outputs.update((name, getattr(options, name)) for name in WRITERS if getattr(options, name, None))
+    outfiles = []
+    writers = []
     try:
-        report.write(outfile)
+        for name, out in outputs.items():
+            outfile = sys.stdout if out == '-' else open(out, 'w')
+            outfiles.append(outfile)
+            writers.append(WRITERS[name](outfile))
+
+        report = qc(
+            writers,
+            since=getattr(options, 'since', None),
+            importers=bool(getattr(options, 'importers', False)),
+        )
+        debug('Report is %s', report)
+        for writer in writers:
+            writer.close()
     finally:
-        if outfile is not sys.stdout:
-            outfile.close()
+        for outfile in outfiles:
+            if outfile is not sys.stdout:
+                outfile.close()
 
     if not report:
         return False
@@ -24,12 +24,18 @@ the baseUrl.
 Build step
 ----------
 
-When invoked, **rjs** will create a temp dir, call *virtual_static* on it and
+When invoked, **rjs** will call *virtual_static* on the static dir and
 instanciate a RJSBuilder. The RJSBuilder will either get a list of apps to
 build or will have to autodiscover it. If it exists, it will check againt a
-.files that contains the files that have been used to build the previous
-version for update since the last build. When no such update have been found,
-it will skip the build.
+manifest that contains the files that have been used to build the previous
+version and a hash of their content. When none of them changed, it will skip
+the build. When the hash matches an output built before and kept in the cache
+directory (defaults.CACHE_DIR), the output is restored instead of rebuilt.
+
+The static dir is kept between the runs in defaults.CACHE_DIR, under
+defaults.VIRTUAL_STATIC_DIR. The default *virtual_static* only creates and
+removes the links to the static files that changed since the previous run.
+When defaults.VIRTUAL_STATIC_DIR is empty, a new temp dir is used each time.
 
 The RJSBuilder takes a *params* dict. This options customize the building of
 the module and the arguments passed to r.js Those options may be intercepted by
@@ -42,20 +48,55 @@ or with ``-o``in the CLI or by settings defaults.RJS_PARAMS
 >>> call_task('rjs', options={'rjs_params': {'preserveLicenseComments': 'false'}})
 
     $ paver rjs -o preserveLicenseComments=false
+
+Worker pool
+-----------
+
+By default each module is built by a new node process running r.js. The
+*PooledRJSBuild* and *PooledAlmondRJSBuild* build classes send the builds to
+long lived node workers instead, saving the startup of node and r.js for each
+module. They require the npm package requirejs.
+
+    $ paver rjs -C sett.requirejs.PooledAlmondRJSBuild
+
+Shared modules
+--------------
+
+The *SharedRJSBuilder* builds the modules used by several apps once, in a
+common bundle with almond, and the apps in slim bundles without them.
+
+    $ paver rjs -B sett.requirejs.SharedRJSBuilder
 """
 
 from __future__ import absolute_import
 
+import io
 import os
+import json
+import time
+import fnmatch
+import atexit
+import itertools
+import collections
+import contextlib
+import threading
+import shutil
+import hashlib
+import tempfile
 import subprocess
 import optparse
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
 from paver.easy import (task, no_help, consume_args, consume_nargs, call_task,
-                        info, needs, path, debug, error, sh, cmdopts)
+                        info, needs, path, debug, error, sh, cmdopts, BuildFailure)
 from paver.deps.six import text_type, string_types
 
 from sett import ROOT, which, defaults, parallel
-from sett.utils import Tempdir, import_string
+from sett.utils import Tempdir, import_string, file_hash
+from sett.utils.fs import OutputCache, makedirs
 from sett.npm import NODE_MODULES
 
 
@@ -66,9 +107,10 @@ class RJSBuild(object):
     *params* for the r.js command.
 
     A list of the file used to build is written in a file name
-    ``.*name*.files`` next to the file generated in *out*. This list of files
-    is checked by ``should_build`` to avoid regenerating the build file if no
-    script have been touched since the last generation.
+    ``.*name*.files`` next to the file generated in *out*. The *cache* checks
+    this list of files in ``should_build`` to avoid regenerating the build
+    file if no script have been touched since the last generation, or
+    restores the build file from a previous generation.
 
     **Note**: The file loaded by the plugins are not checked.
     """
@@ -104,12 +146,12 @@ class RJSBuild(object):
         return c
 
     def should_build(self):
-        return self.cache.is_up_to_date()
+        return self.cache.is_up_to_date() and not self.cache.restore()
 
     def build(self):
         """
         Invoke the r.js command. It checks the output of the r.js process to
-        write the list of files in ``cache_file``.
+        write the list of files in ``cache_file`` and returns this list.
 
         If the r.js process returns with anything else than 0, it raises a
         ``RuntimeError``.
@@ -122,6 +164,18 @@ class RJSBuild(object):
             out=self.out,
             **self.params
         )
+        files = self.run(command)
+
+        # The config file is not added by requirejs as the list of files
+        files.append(self.config_js)
+        self.cache.write(files)
+        return files
+
+    def run(self, command):
+        """
+        Runs the r.js *command* in a new node process and returns the list of
+        files used by the build.
+        """
         debug('Running: %s', ' '.join(command))
         rjs_process = subprocess.Popen(
             command,
@@ -134,10 +188,7 @@ class RJSBuild(object):
 
         if rc != 0:
             raise RuntimeError('r.js returned with {}'.format(rc))
-
-        # The config file is not added by requirejs as the list of files
-        files.append(self.config_js)
-        self.cache.write(files)
+        return files
 
     def parse_output(self, stdout):
         """
@@ -182,6 +233,173 @@ class AlmondRJSBuild(RJSBuild):
         return super(AlmondRJSBuild, self).get_command(**kw)
 
 
+class SlimRJSBuild(RJSBuild):
+    """
+    Builds the app without almond. The modules given by the *exclude* param
+    are expected to be loaded by the page before, in a common bundle.
+    """
+    def get_command(self, **kw):
+        kw.pop('almond', None)
+        kw.update(
+            name=self.name,
+            insertRequire=self.name,
+        )
+        return super(SlimRJSBuild, self).get_command(**kw)
+
+
+class CommonRJSBuild(AlmondRJSBuild):
+    """
+    Builds almond and the modules given by the *include* param in a common
+    bundle, without requiring any of them.
+
+    The *wrap* params are ignored: almond has to define ``define`` and
+    ``require`` in the global scope for the app bundles.
+    """
+    def get_command(self, **kw):
+        for key in list(kw):
+            if key == 'wrap' or key.startswith('wrap.'):
+                del kw[key]
+        kw['name'] = kw.pop('almond', None) or self.get_almond_path()
+        return super(AlmondRJSBuild, self).get_command(**kw)
+
+
+class RJSWorkerPool(object):
+    """
+    A pool of long lived node processes running the r.js optimizer. It saves
+    the startup of node and the parsing of r.js for each module.
+
+    The workers run ``sett/node/rjs_worker.js``. They read a JSON request by
+    line on their stdin containing the r.js options, and write a JSON response
+    by line on their stdout containing the output of the build, the same
+    output as ``r.js -o``.
+
+    A worker is spawned when no idle worker is available, so there are as many
+    workers as concurrent builds. The workers are stopped at exit.
+
+    >>> RJSWorkerPool.get().build(['name=app/app', 'out=build/app.js'])
+        'Tracing dependencies for: app/app...'
+    """
+    WORKER = path(__file__).dirname().joinpath('node', 'rjs_worker.js')
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        self._idle = queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+        self._id = itertools.count()
+
+    @classmethod
+    def get(cls):
+        """
+        Returns the shared pool
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+                atexit.register(cls._instance.close)
+            return cls._instance
+
+    def get_command(self):
+        return [which.node, self.WORKER]
+
+    def spawn(self):
+        """
+        Starts a new worker
+        """
+        env = dict(os.environ)
+        env['NODE_PATH'] = os.pathsep.join(filter(None, [NODE_MODULES, env.get('NODE_PATH')]))
+        command = self.get_command()
+        debug('Starting r.js worker: %s', ' '.join(command))
+        worker = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=env,
+        )
+        with self._lock:
+            self._workers.append(worker)
+        return worker
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self.spawn()
+
+    def _discard(self, worker):
+        with self._lock:
+            if worker in self._workers:
+                self._workers.remove(worker)
+        try:
+            worker.stdin.close()
+        except (IOError, OSError):
+            pass
+        worker.wait()
+
+    def build(self, args):
+        """
+        Runs a build with the r.js options *args*, a list of ``name=value``,
+        and returns the output of r.js. It raises a ``RuntimeError`` if the
+        build fails.
+        """
+        worker = self._acquire()
+        request = {'id': next(self._id), 'args': [text_type(arg) for arg in args]}
+        try:
+            worker.stdin.write(json.dumps(request, sort_keys=True).encode('utf-8') + b'\n')
+            worker.stdin.flush()
+            line = worker.stdout.readline()
+            if not line:
+                raise RuntimeError('r.js worker exited with {}'.format(worker.wait()))
+            response = json.loads(line.decode('utf-8'))
+        except Exception:
+            self._discard(worker)
+            raise
+
+        self._idle.put(worker)
+        if not response.get('ok'):
+            raise RuntimeError('r.js failed: {}'.format(response.get('error')))
+        return response['output']
+
+    def close(self):
+        """
+        Stops all the workers
+        """
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for worker in workers:
+            self._discard(worker)
+
+
+class PooledBuildMixin(object):
+    """
+    A mixin for ``RJSBuild`` running the builds in the workers of a
+    ``RJSWorkerPool`` instead of a new node process.
+    """
+    def get_pool(self):
+        return RJSWorkerPool.get()
+
+    def run(self, command):
+        # Skip node, r.js and -o
+        args = command[3:]
+        debug('Building in worker: %s', ' '.join(args))
+        output = self.get_pool().build(args)
+        return self.parse_output(io.BytesIO(output.encode('utf-8')))
+
+
+class PooledRJSBuild(PooledBuildMixin, RJSBuild):
+    """
+    ``RJSBuild`` running in a r.js worker
+    """
+
+
+class PooledAlmondRJSBuild(PooledBuildMixin, AlmondRJSBuild):
+    """
+    ``AlmondRJSBuild`` running in a r.js worker
+    """
+
+
 class FilesListComparator(object):
     """
     Keeps a file containing a list of path to files.
@@ -223,6 +441,12 @@ class FilesListComparator(object):
         # Return should_write = True when the last dependency was written after
         return dep_write_time > out_build_time
 
+    def restore(self):
+        """
+        This cache does not keep previous outputs
+        """
+        return False
+
     def write(self, files_list):
         """
         Write the cache file
@@ -234,6 +458,144 @@ class FilesListComparator(object):
                 out_file.write(u'\n')
 
 
+class ContentHashComparator(FilesListComparator):
+    """
+    A content addressed cache of r.js builds. The key of a build is a hash of
+    the module *name*, the r.js *params* and the content of every file used by
+    the previous build (including config.js). The list of the files and the
+    key of the last build of each output are kept in a manifest in
+    *cache_dir*, which defaults to ``defaults.CACHE_DIR/rjs``. The outputs
+    (the built file and its source map) are stored in the cache dir by key.
+
+    The build is up to date when the key and the content of the output match
+    the manifest. If the key does not match the manifest but has been built
+    before, the output is restored from the cache dir instead of rebuilt.
+
+    The paths are stored relative to ROOT, so that the cache dir can be shared
+    between checkouts.
+    """
+
+    def __init__(self, out, name, params=(), cache_dir=None):
+        super(ContentHashComparator, self).__init__(out)
+        self.name = name
+        self.params = dict(params)
+        self.cache_dir = path(cache_dir or ROOT.joinpath(defaults.CACHE_DIR, 'rjs'))
+        out_id = hashlib.sha1(text_type(self._relative(self.out)).encode('utf-8')).hexdigest()
+        self.manifest_file = self.cache_dir.joinpath('manifests', out_id + '.json')
+        self._key = None
+
+    def __repr__(self):
+        return 'ContentHashComparator({})'.format(self.out)
+
+    def _relative(self, filename):
+        filename = path(filename).realpath()
+        if filename.startswith(ROOT.realpath().joinpath('')):
+            return ROOT.realpath().relpathto(filename)
+        return filename
+
+    def _outputs(self):
+        return [f for f in [self.out, self.out + '.map'] if f.isfile()]
+
+    def key(self, files_list):
+        """
+        Computes the key of the build from the list of files
+        """
+        key = {
+            'name': self.name,
+            'params': sorted((k, text_type(v)) for k, v in self.params.items()),
+            'files': [(text_type(f), file_hash(ROOT.joinpath(f))) for f in files_list],
+        }
+        return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def read_manifest(self):
+        try:
+            with open(self.manifest_file, 'r') as manifest:
+                return json.load(manifest)
+        except (IOError, OSError, ValueError) as e:
+            debug('Cannot read %s: %s', self.manifest_file, e)
+            return None
+
+    def write_manifest(self, files_list, key):
+        manifest = {
+            'files': [text_type(f) for f in files_list],
+            'key': key,
+            'out': file_hash(self.out),
+        }
+        self.manifest_file.dirname().makedirs_p()
+        with open(self.manifest_file, 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+
+    def is_up_to_date(self):
+        """
+        Determines if the module should be built. It should be built if there
+        is no manifest, if a file used by the previous build is missing, or if
+        the key or the output changed.
+        """
+        self._key = None
+        manifest = self.read_manifest()
+        if manifest is None:
+            return True
+
+        try:
+            self._key = self.key(manifest['files'])
+        except (IOError, OSError) as e:
+            debug('Cannot hash the files of %s: %s', self.out, e)
+            return True
+
+        try:
+            out_hash = file_hash(self.out)
+        except (IOError, OSError):
+            out_hash = None
+
+        debug('%s key is %s, was %s', self.out, self._key, manifest['key'])
+        return self._key != manifest['key'] or out_hash != manifest['out']
+
+    def restore(self):
+        """
+        Restores the output from the cache dir. Returns False if the build is
+        not in the cache.
+        """
+        if self._key is None:
+            return False
+
+        bundle = self.cache_dir.joinpath('bundles', self._key)
+        if not bundle.isdir():
+            debug('%s is not in the cache', self._key)
+            return False
+
+        info('Restoring %s from %s', self.out, bundle)
+        self.out.dirname().makedirs_p()
+        for cached in bundle.files():
+            shutil.copyfile(cached, self.out.dirname().joinpath(cached.basename()))
+
+        manifest = self.read_manifest()
+        self.write_manifest(manifest['files'], self._key)
+        return True
+
+    def write(self, files_list):
+        """
+        Writes the list of files, the manifest and stores the output in the
+        cache dir.
+        """
+        super(ContentHashComparator, self).write(files_list)
+
+        files_list = [self._relative(f) for f in files_list if '!' not in f]
+        key = self.key(files_list)
+        bundle = self.cache_dir.joinpath('bundles', key)
+        if not bundle.isdir():
+            bundle.dirname().makedirs_p()
+            tempdir = path(tempfile.mkdtemp(dir=bundle.dirname()))
+            for output in self._outputs():
+                shutil.copyfile(output, tempdir.joinpath(output.basename()))
+            try:
+                os.rename(tempdir, bundle)
+            except OSError:
+                # Stored by another build meanwhile
+                tempdir.rmtree()
+
+        self.write_manifest(files_list, key)
+
+
 class RJSBuilder(object):
     """
     A builder for a set of r.js modules.
@@ -256,7 +618,7 @@ class RJSBuilder(object):
 
     def _build(self, rjs_build):
         if self.force or rjs_build.should_build():
-            rjs_build.build()
+            return rjs_build.build()
 
     def autodiscover(self, tempdir, appdir):
         """
@@ -280,9 +642,15 @@ class RJSBuilder(object):
 
         for name in args:
             out = ROOT.joinpath(self.outdir, name + '.js')
-            cache = FilesListComparator(out)
+            cache = self.get_cache(name, out, params)
             yield self.build_class(name, source, out, params, cache)
 
+    def get_cache(self, name, out, params):
+        """
+        Returns the object that decides if *out* has to be built.
+        """
+        return ContentHashComparator(out, name, params)
+
     def __call__(self, tempdir, args):
         if not args:
             # Auto discover
@@ -299,6 +667,155 @@ class RJSBuilder(object):
         builder.for_each(build_list)
 
 
+class SharedRJSBuilder(RJSBuilder):
+    """
+    A builder that puts the modules shared by several apps in a common
+    bundle, with almond, and builds each app without almond nor the shared
+    modules. The page loads the common bundle then the app bundle.
+
+        $ paver rjs -B sett.requirejs.SharedRJSBuilder
+
+    The dependencies of each app are kept in a plan, ``.shared.json`` in the
+    out dir. The apps missing from the plan are first built stand-alone with
+    *build_class* in a temporary directory to get their list of files. A
+    module is shared when at least *shared_min_apps* apps (2 by default)
+    depend on it. The common bundle is named after the *common* param
+    (``common`` by default) and the *shared* param adds a comma separated
+    list of modules to the common bundle.
+
+    The modules are named after their path relative to the source dir. The
+    modules mapped by the ``paths`` of config.js cannot be found from the
+    list of files and have to be given by the *shared* param. Remove the
+    plan to compute it again when an app no longer depends on a shared
+    module.
+    """
+    common_class = CommonRJSBuild
+    app_class = SlimRJSBuild
+
+    def __init__(self, outdir, force=False, build_class=AlmondRJSBuild, params=()):
+        super(SharedRJSBuilder, self).__init__(outdir, force=force, build_class=build_class, params=params)
+        self.common = self.params.pop('common', 'common')
+        self.min_apps = int(self.params.pop('shared_min_apps', 2))
+        self.shared = [x for x in self.params.pop('shared', '').split(',') if x]
+        self.plan_file = ROOT.joinpath(self.outdir, '.shared.json')
+
+    def read_plan(self):
+        """
+        Returns the modules used by each app in the previous builds
+        """
+        try:
+            with open(self.plan_file, 'r') as plan_file:
+                return dict((name, set(modules)) for name, modules in json.load(plan_file).items())
+        except (IOError, OSError, ValueError) as e:
+            debug('Cannot read %s: %s', self.plan_file, e)
+            return {}
+
+    def write_plan(self, plan):
+        debug('Writing %s', self.plan_file)
+        with open(self.plan_file, 'w') as plan_file:
+            json.dump(dict((name, sorted(modules)) for name, modules in plan.items()),
+                      plan_file, indent=2, sort_keys=True)
+
+    def get_modules(self, rjs_build, files):
+        """
+        Returns the names of the modules from a list of *files* returned by
+        *rjs_build*. The plugins, the config file and the files outside the
+        source dir are ignored.
+        """
+        modules = set()
+        for filename in files:
+            filename = path(filename)
+            if '!' in filename or filename == rjs_build.config_js:
+                continue
+            module = rjs_build.source.relpathto(filename)
+            if module.startswith('..') or module.ext != '.js':
+                continue
+            modules.add(text_type(module.stripext()))
+        return modules
+
+    def analyse(self, source, names):
+        """
+        Builds stand-alone the apps *names* and returns their modules
+        """
+        info('Analysing the dependencies of %s', ', '.join(names))
+        params = dict(self.params)
+        params.pop('appdir', None)
+
+        with Tempdir() as tempdir:
+            build_list = []
+            for name in names:
+                out = tempdir.joinpath(name + '.js')
+                build_list.append(self.build_class(name, source, out, params, FilesListComparator(out)))
+
+            builder = parallel(self._build, n=min(4, len(build_list)))
+            return dict(
+                (rjs_build.name, self.get_modules(rjs_build, files))
+                for rjs_build, files in builder.map(build_list)
+            )
+
+    def get_shared(self, plan):
+        """
+        Returns the sorted list of the modules used by at least
+        ``min_apps`` apps of the *plan*.
+        """
+        counts = collections.Counter()
+        for modules in plan.values():
+            counts.update(modules)
+        shared = set(module for module, count in counts.items() if count >= self.min_apps)
+        shared.update(self.shared)
+        shared.difference_update(plan)
+        return sorted(shared)
+
+    def _build(self, rjs_build):
+        return rjs_build, super(SharedRJSBuilder, self)._build(rjs_build)
+
+    def __call__(self, tempdir, args):
+        if not args:
+            args = self.autodiscover(tempdir, self.params.get('appdir', 'app'))
+
+        if not args:
+            info('No file to optimize')
+            return
+
+        plan = self.read_plan()
+        missing = [name for name in args if name not in plan]
+        if missing:
+            plan.update(self.analyse(tempdir, missing))
+
+        shared = self.get_shared(dict((name, plan[name]) for name in args))
+        if not shared:
+            info('No module is shared between %s', ', '.join(args))
+            self.write_plan(plan)
+            return super(SharedRJSBuilder, self).__call__(tempdir, args)
+
+        info('Sharing %s', ', '.join(shared))
+        params = dict(self.params)
+        params.pop('appdir', None)
+
+        common_params = dict(params, include=','.join(shared))
+        common_out = ROOT.joinpath(self.outdir, self.common + '.js')
+        build_list = [self.common_class(
+            self.common, tempdir, common_out, common_params,
+            self.get_cache(self.common, common_out, common_params),
+        )]
+
+        app_params = dict(params, exclude=','.join(shared))
+        for name in args:
+            out = ROOT.joinpath(self.outdir, name + '.js')
+            cache = self.get_cache(name, out, app_params)
+            build_list.append(self.app_class(name, tempdir, out, app_params, cache))
+
+        builder = parallel(self._build, n=min(4, len(build_list)))
+        try:
+            for rjs_build, files in builder.map(build_list):
+                if files is None or rjs_build.name not in plan:
+                    continue
+                # The shared modules are excluded from the build
+                plan[rjs_build.name] = self.get_modules(rjs_build, files) | (plan[rjs_build.name] & set(shared))
+        finally:
+            self.write_plan(plan)
+
+
 def _cls(options, key, default):
     cls_def = options.get(key) or getattr(defaults, 'RJS_{}'.format(key.upper()), None) or default
 
@@ -310,6 +827,109 @@ def _cls(options, key, default):
     return cls_def
 
 
+class VirtualStatic(object):
+    """
+    A tree of symbolic links to the static files in *root*, like the one
+    made by ``collectstatic --link``. The links are listed in a manifest,
+    ``.virtual_static.json`` in *root*, so that ``sync`` only creates the
+    links that are new or point to another file and removes the links to
+    the files that are gone since the previous sync.
+    """
+    MANIFEST = '.virtual_static.json'
+
+    def __init__(self, root):
+        self.root = path(root)
+        self.manifest_file = self.root.joinpath(self.MANIFEST)
+
+    def __repr__(self):
+        return 'VirtualStatic({})'.format(self.root)
+
+    def read_manifest(self):
+        try:
+            with open(self.manifest_file, 'r') as manifest:
+                return json.load(manifest)
+        except (IOError, OSError, ValueError) as e:
+            debug('Cannot read %s: %s', self.manifest_file, e)
+            return {}
+
+    def write_manifest(self, links):
+        temp = tempfile.NamedTemporaryFile('w', dir=self.root, prefix=self.MANIFEST, delete=False)
+        with temp:
+            json.dump(links, temp)
+        os.rename(temp.name, self.manifest_file)
+
+    def collect(self):
+        """
+        Returns a dict of the relative path in the static root to the source
+        of each static file found by the finders of django. Like
+        collectstatic, the first finder that finds a path wins.
+        """
+        from django.apps import apps
+        from django.contrib.staticfiles.finders import get_finders
+
+        ignore_patterns = list(apps.get_app_config('staticfiles').ignore_patterns)
+        found = {}
+        for finder in get_finders():
+            for name, storage in finder.list(ignore_patterns):
+                prefix = getattr(storage, 'prefix', None)
+                target = os.path.join(prefix, name) if prefix else name
+                if target not in found:
+                    found[target] = storage.path(name)
+        return found
+
+    def sync(self, files):
+        """
+        Updates the links to match *files*, a dict of the relative path of
+        the link to the source. Returns the number of links created and
+        removed.
+        """
+        if not self.root.isdir():
+            os.makedirs(self.root)
+        previous = self.read_manifest()
+
+        # The links are handled with os to avoid logging each of them
+        removed = 0
+        for name in set(previous).difference(files):
+            link = self.root.joinpath(name)
+            if link.islink():
+                os.unlink(link)
+                removed += 1
+                try:
+                    os.removedirs(link.dirname())
+                except OSError:
+                    pass
+
+        created = 0
+        for name, source in files.items():
+            link = self.root.joinpath(name)
+            if previous.get(name) == source and link.islink():
+                continue
+            if os.path.lexists(link):
+                os.unlink(link)
+            elif not link.dirname().isdir():
+                os.makedirs(link.dirname())
+            os.symlink(source, link)
+            created += 1
+
+        self.write_manifest(files)
+        debug('%s: %s links created, %s removed', self, created, removed)
+        return created, removed
+
+
+@contextlib.contextmanager
+def static_dir():
+    """
+    Yields the directory of static files given to *virtual_static*, either
+    the one kept in the cache dir or a temp dir.
+    """
+    if not defaults.VIRTUAL_STATIC_DIR:
+        with Tempdir() as tempdir:
+            yield tempdir
+        return
+
+    yield ROOT.joinpath(defaults.CACHE_DIR, defaults.VIRTUAL_STATIC_DIR)
+
+
 @task
 @cmdopts([
     optparse.make_option(
@@ -343,9 +963,10 @@ def rjs(options):
 Build a requirejs app.
 
 Rjs will call the virtual_static class (the default implementation is
-sett.requirejs.virtual_static). This task should copy or link in the temp dir
-given as the first arg all the static files required for the compilation as if
-it was the static root.
+sett.requirejs.virtual_static). This task should copy or link in the dir given
+as the first arg all the static files required for the compilation as if it
+was the static root. The dir is kept between the runs, see
+defaults.VIRTUAL_STATIC_DIR.
 
 Rjs requires npm apps requirejs. It will instanciate a builder class from the
 class loaded from builder_class_path (sett.requirejs.RJSBuilder by default) and
@@ -377,9 +998,9 @@ their namespace. This behavior can be configured in a new builder class.
         params=rjs_params,
     )
 
-    with Tempdir() as tempdir:
-        call_task('virtual_static', args=[tempdir])
-        buidler(tempdir.joinpath('js'), options.get('paths', []))
+    with static_dir() as static:
+        call_task('virtual_static', args=[static])
+        buidler(static.joinpath('js'), options.get('paths', []))
 
 
 @task
@@ -388,15 +1009,14 @@ their namespace. This behavior can be configured in a new builder class.
 @consume_nargs(1)
 def virtual_static(args):
     """
-    Collect the static in the directory given in argument
+    Links the static files in the directory given in argument
     """
-    tempdir, = args
-    args = ['collectstatic', '--verbosity', '0', '--noinput', '--link']
+    static, = args
 
     from django.conf import settings
     from django.test.utils import override_settings, modify_settings
 
-    with override_settings(STATIC_ROOT=tempdir):
+    with override_settings(STATIC_ROOT=static):
         with modify_settings(STATICFILES_DIRS={
             'append': getattr(settings, 'STATICFILES_DIRS_DEV', []),
             'remove': [
@@ -405,7 +1025,9 @@ def virtual_static(args):
                 ROOT.joinpath(defaults.RJS_BUILD_DIR).normpath().parent.joinpath(''),
             ]
         }):
-            call_task('django', args=args)
+            virtual_static = VirtualStatic(static)
+            created, removed = virtual_static.sync(virtual_static.collect())
+            info('Linked static files in %s: %s created, %s removed', static, created, removed)
 
 
 @task
@@ -414,30 +1036,140 @@ def madge(args):
     """
     Runs a madge dependency analysis
     """
-    with Tempdir() as tempdir:
-        call_task('virtual_static', args=[tempdir])
+    with static_dir() as static:
+        call_task('virtual_static', args=[static])
         command = [
             which.madge,
             '-f', 'amd',
-            '-R', tempdir.joinpath('js/config.js'),
-            tempdir.joinpath('js'),
+            '-R', static.joinpath('js/config.js'),
+            static.joinpath('js'),
         ]
         command.extend(args)
         sh(command)
 
 
-@task
-@consume_args
-def uglify(args):
-    for name in args:
-        input = ROOT.joinpath('scripts/js/', name + '.js')
-        output = ROOT.joinpath('static/js/', name + '.js')
+class Uglify(object):
+    """
+    Minifies the scripts of the *src* directory in *outdir* with uglifyjs and
+    the *options*, with a source map next to each script.
+
+    The scripts are minified concurrently by *jobs* uglifyjs processes. The
+    key of the minification of each output, the hash of the input and the
+    options, is kept in *cache_file* and the scripts whose key did not change
+    and whose output was not modified are skipped, unless *force* is set.
+    """
+    def __init__(self, src, outdir, options=(), cache_file=None, force=False, jobs='auto'):
+        self.src = path(src)
+        self.outdir = path(outdir)
+        self.options = list(options)
+        self.force = force
+        self.jobs = jobs
+        self.cache = OutputCache(cache_file)
+        self.stats = collections.Counter()
+
+    @classmethod
+    def default(cls, force=False):
+        return cls(
+            ROOT.joinpath(defaults.UGLIFY_SRC_DIR),
+            ROOT.joinpath(defaults.UGLIFY_BUILD_DIR),
+            options=defaults.UGLIFY_OPTIONS,
+            cache_file=ROOT.joinpath(defaults.CACHE_DIR, 'uglify.json'),
+            force=force,
+            jobs=defaults.UGLIFY_JOBS,
+        )
 
+    def __repr__(self):
+        return 'Uglify({}, {})'.format(self.src, self.outdir)
+
+    def discover(self, patterns=()):
+        """
+        Returns the names of the scripts of the source directory, without the
+        .js extension, matching one of the glob *patterns*, or all of them.
+        """
+        names = sorted(self.src.relpathto(script).stripext() for script in self.src.walkfiles('*.js'))
+        if not patterns:
+            return names
+
+        selected = []
+        for pattern in patterns:
+            matching = fnmatch.filter(names, pattern)
+            if not matching:
+                raise BuildFailure('No script matching {} in {}'.format(pattern, self.src))
+            selected.extend(name for name in matching if name not in selected)
+        return selected
+
+    def input(self, name):
+        return self.src.joinpath(name + '.js')
+
+    def output(self, name):
+        return self.outdir.joinpath(name + '.js')
+
+    def key(self, name):
+        return [file_hash(self.input(name)), self.options]
+
+    def _uglify(self, job):
+        name, key = job
+        output = self.output(name)
+        makedirs(output.parent)
+
+        start = time.time()
         sh([
             which.node,
             which.uglifyjs,
-            input, '-o', output,
+            self.input(name), '-o', output,
             '--source-map', output + '.map',
-            '--source-map-url', name + '.js.map',
-            '--compress', '--mangle',
-        ])
+            '--source-map-url', output.basename() + '.map',
+        ] + self.options, capture=True)
+        return name, key, file_hash(output), time.time() - start
+
+    def __call__(self, names):
+        self.cache.load()
+
+        jobs = []
+        for name in names:
+            key = self.key(name)
+            if not self.force and self.cache.is_fresh(self.output(name), key):
+                self.stats['hits'] += 1
+            else:
+                jobs.append((name, key))
+        self.stats['misses'] += len(jobs)
+
+        if not jobs:
+            info('%s scripts up to date', len(names))
+            return
+
+        start = time.time()
+        timings = []
+        uglifier = parallel(self._uglify, backend='threaded', n=self.jobs)
+        try:
+            for name, key, out_hash, duration in uglifier.imap_unordered(jobs):
+                self.cache.set(self.output(name), key, out_hash)
+                timings.append((duration, name))
+        finally:
+            self.cache.save()
+
+        info('Minified %s scripts in %.2fs (%.2fs of uglifyjs), %s up to date',
+             len(timings), time.time() - start, sum(duration for duration, name in timings), self.stats['hits'])
+
+
+@task
+@cmdopts([
+    optparse.make_option(
+        '-f', '--force',
+        action='store_true',
+        default=False,
+    ),
+])
+@consume_args
+def uglify(options, args):
+    """Usage: uglify [-f|--force] [name|pattern...]
+Minify the scripts of defaults.UGLIFY_SRC_DIR in defaults.UGLIFY_BUILD_DIR.
+
+The names are the paths of the scripts relative to the source directory
+without the .js extension, or glob patterns of those. All the scripts are
+minified when no name is given. The scripts are minified concurrently by
+defaults.UGLIFY_JOBS uglifyjs and the unchanged scripts are skipped, unless
+--force is given.
+"""
+    uglifier = Uglify.default(force=options.get('force', False))
+    uglifier(uglifier.discover(args))
@@ -1,8 +1,13 @@
 # -*- coding: utf-8 -*-
 
-import heapq
+import os
 import re
+import json
+import heapq
+import tempfile
 import collections
+
+from paver.easy import debug, path
 from paver.tasks import Task
 
 
@@ -19,7 +24,7 @@ class TaskAlternativeTaskFinder(object):
         return list(self.ta)
 
     def get_task(self, name):
-        self.loader.get_tasks()
+        self.loader.find(name)
         if name not in self.ta:
             return None
         return self.ta[name]
@@ -53,6 +58,15 @@ class TaskAlternative(object):
         weight, fn = best[0]
         return fn
 
+    def items(self):
+        """
+        Iterates over the name, the weight and the task of all the registered
+        alternatives.
+        """
+        for name, alts in self._alternatives.items():
+            for weight, fn in alts:
+                yield name, weight, fn
+
     def __call__(self, weight, name=None):
         def decorator(fn):
             if not isinstance(fn, Task):
@@ -75,3 +89,115 @@ class RegexpTaskLoader(object):
         if matching is None:
             return None
         return self.task_factory(*matching.groups(), task_name=task_name)
+
+
+class TaskIndex(object):
+    """
+    An on-disk index of the tasks defined by a set of modules. For each task
+    name, it keeps the modules that define a task or a task alternative with
+    this name, the weight of the alternatives and the summary of the task doc.
+
+    The index is written as JSON in *index_file* with the *signature* of the
+    indexed modules. The index is out of date if the signature recorded in the
+    file differs from the current one.
+
+    The *signature* maps each module name to the mtime and the size of its
+    source. The modules of a task name are looked up by ``modules``, choosing
+    amongst their tasks is left to the caller.
+
+    >>> index = TaskIndex('var/cache/sett/tasks.json', {'pip': [1459433045.0, 410]})
+    >>> index.load()
+    False
+    >>> index.update({'pip': [sett.pip.pip]})
+    >>> index.modules('pip')
+    ['pip']
+    >>> index.modules('unknown')
+    []
+    >>> TaskIndex('var/cache/sett/tasks.json', {'pip': [1459433045.0, 410]}).load()
+    True
+    """
+    VERSION = 1
+
+    def __init__(self, index_file, signature):
+        self.index_file = path(index_file)
+        self.signature = signature
+        self._index = None
+
+    def __repr__(self):
+        return 'TaskIndex({})'.format(self.index_file)
+
+    def is_loaded(self):
+        return self._index is not None
+
+    def load(self):
+        """
+        Reads the index file. Returns False if the file does not exist or is
+        out of date.
+        """
+        if self.is_loaded():
+            return True
+
+        try:
+            with open(self.index_file, 'r') as index_file:
+                index = json.load(index_file)
+        except (IOError, OSError, ValueError) as e:
+            debug('Cannot read the task index %s: %s', self.index_file, e)
+            return False
+
+        if index.get('version') != self.VERSION or index.get('signature') != self.signature:
+            debug('Task index %s is out of date', self.index_file)
+            return False
+
+        self._index = index
+        return True
+
+    def update(self, modules, alternatives=(), eager=()):
+        """
+        Builds the index from *modules*, a mapping of module names to the list
+        of tasks they define, and *alternatives*, an iterable of tuples of the
+        name, the weight and the module name of the task alternatives. The
+        *eager* modules are modules that have to be imported before looking for
+        any task, like the modules adding task finders.
+
+        The index is written in the index file.
+        """
+        tasks = collections.defaultdict(list)
+        for module, module_tasks in modules.items():
+            for task in module_tasks:
+                tasks[task.shortname].append([module, task.description])
+
+        alternatives_index = collections.defaultdict(list)
+        for name, weight, module in alternatives:
+            alternatives_index[name].append([weight, module])
+
+        self._index = {
+            'version': self.VERSION,
+            'signature': self.signature,
+            'tasks': tasks,
+            'alternatives': alternatives_index,
+            'eager': sorted(eager),
+        }
+        self.write()
+
+    def write(self):
+        index_dir = self.index_file.dirname()
+        debug('Writing the task index in %s', self.index_file)
+        try:
+            if not index_dir.isdir():
+                os.makedirs(index_dir)
+            with tempfile.NamedTemporaryFile('w', dir=index_dir, delete=False) as index_file:
+                json.dump(self._index, index_file, indent=1, sort_keys=True)
+            os.rename(index_file.name, self.index_file)
+        except (IOError, OSError) as e:
+            debug('Cannot write the task index %s: %s', self.index_file, e)
+
+    def eager_modules(self):
+        return list(self._index['eager'])
+
+    def modules(self, name):
+        """
+        Returns the modules defining a task or an alternative named *name*
+        """
+        modules = set(module for module, description in self._index['tasks'].get(name, []))
+        modules.update(module for weight, module in self._index['alternatives'].get(name, []))
+        return sorted(modules)
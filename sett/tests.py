@@ -2,15 +2,23 @@
 # -*- coding: utf-8 -*-
 
 
+import re
 import sys
 import os
+import json
+import heapq
 import optparse
 import itertools
 import importlib
+import threading
+import subprocess
+import collections
+from xml.etree import ElementTree
 
-from paver.easy import task, needs, cmdopts, call_task, path, sh, debug, environment
+from paver.easy import task, needs, cmdopts, call_task, path, sh, debug, info, environment, BuildFailure
 from paver.deps.six import string_types
-from sett import which, defaults, task_alternative
+from sett import which, defaults, task_alternative, parallel, ROOT
+from sett.utils.fs import Tempdir, atomic_write
 from sett.utils.loading import import_string
 
 
@@ -255,6 +263,248 @@ class NosetestsCoverageOptions(NosetestsOptions):
         }
 
 
+# The default testMatch of nose
+TEST_MATCH = r'(?:^|[\b_\./-])[Tt]est'
+
+
+class ShardedNosetests(object):
+    """
+    Runs the nosetests *options* in *processes* nosetests processes.
+
+    The tests are split by module, or by the given test when it's not a
+    package, in shards balanced by the durations of the previous runs kept in
+    *durations_file*. The xunit files of the shards are merged in the xunit
+    file of the options, and with coverage, the data of the shards are
+    combined before the report.
+    """
+    def __init__(self, options, processes, durations_file=None):
+        self.options = dict(options)
+        self.processes = processes
+        self.durations_file = durations_file
+        self.durations = {}
+        self._output_lock = threading.Lock()
+
+    @classmethod
+    def default(cls, options, processes):
+        return cls(options, processes, ROOT.joinpath(defaults.CACHE_DIR, 'test_durations.json'))
+
+    def load_durations(self):
+        if not self.durations_file:
+            return
+        try:
+            with open(self.durations_file, 'r') as durations_file:
+                self.durations = json.load(durations_file)
+        except (IOError, OSError, ValueError) as e:
+            debug('Cannot read %s: %s', self.durations_file, e)
+
+    def save_durations(self):
+        if self.durations_file:
+            atomic_write(self.durations_file, json.dumps(self.durations, sort_keys=True).encode('utf-8'))
+
+    def test_match(self):
+        """
+        Returns the regex of nose selecting the test modules and directories
+        """
+        return re.compile(self.options.get('match') or os.environ.get('NOSE_TESTMATCH') or TEST_MATCH)
+
+    def discover(self, tests):
+        """
+        Returns the test modules of the packages of *tests* and the other
+        *tests*. The modules are selected like nose does: the python files
+        matching the test match regex, not starting with _ or . and not
+        executable. The directories that are not packages but match the regex
+        are returned as a whole.
+        """
+        match = self.test_match()
+        units = []
+        for test in tests:
+            directory = path(test.replace('.', os.sep))
+            if ':' in test or not directory.joinpath('__init__.py').isfile():
+                units.append(test)
+                continue
+
+            for dirpath, dirnames, filenames in os.walk(directory):
+                packages = []
+                for dirname in sorted(dirnames):
+                    subdirectory = os.path.join(dirpath, dirname)
+                    if os.path.isfile(os.path.join(subdirectory, '__init__.py')):
+                        packages.append(dirname)
+                    elif match.search(dirname) and not dirname.startswith('.'):
+                        units.append(os.path.relpath(subdirectory))
+                dirnames[:] = packages
+
+                package = os.path.relpath(dirpath).replace(os.sep, '.')
+                units.extend('{}.{}'.format(package, filename[:-3]) for filename in sorted(filenames)
+                             if self._is_test_module(dirpath, filename, match))
+        return units
+
+    @staticmethod
+    def _is_test_module(dirpath, filename, match):
+        if not filename.endswith('.py') or filename.startswith(('_', '.')) or filename == 'setup.py':
+            return False
+        return bool(match.search(filename)) and not os.access(os.path.join(dirpath, filename), os.X_OK)
+
+    def balance(self, units):
+        """
+        Returns the *units* split in shards of close durations. The units are
+        given the longest first to the shortest shard, the units without
+        duration last the average duration.
+        """
+        known = [self.durations[unit] for unit in units if unit in self.durations]
+        default = float(sum(known)) / len(known) if known else 1.0
+
+        shards = [(0.0, i, []) for i in range(min(self.processes, len(units)))]
+        for unit in sorted(units, key=lambda unit: (-self.durations.get(unit, default), unit)):
+            total, i, shard = heapq.heappop(shards)
+            shard.append(unit)
+            heapq.heappush(shards, (total + self.durations.get(unit, default), i, shard))
+        return [shard for total, i, shard in sorted(shards, key=lambda item: item[1])]
+
+    def arguments(self, options, tests):
+        arguments = []
+        for key, value in sorted(options.items()):
+            if value is True:
+                arguments.append('--{}'.format(key))
+            elif isinstance(value, (list, tuple)):
+                arguments.extend('--{}={}'.format(key, item) for item in value)
+            elif value not in (None, False):
+                arguments.append('--{}={}'.format(key, value))
+        return arguments + list(tests)
+
+    @property
+    def with_coverage(self):
+        return bool(self.options.get('with-coverage') or self.options.get('with-xcoverage'))
+
+    def shard_options(self, xunit_file):
+        options = dict(self.options)
+        for key in ['tests', 'with-xcoverage', 'xcoverage-file', 'xcoverage-to-stdout', 'cover-erase']:
+            options.pop(key, None)
+        if self.with_coverage:
+            options['with-coverage'] = True
+        options.update({
+            'with-xunit': True,
+            'xunit-file': xunit_file,
+        })
+        return options
+
+    def _run_shard(self, job):
+        number, tests, xunit_file = job
+        env = dict(os.environ)
+        env['COVERAGE_FILE'] = '.coverage.sett-shard-{}'.format(number)
+        command = [sys.executable, '-m', 'nose'] + self.arguments(self.shard_options(xunit_file), tests)
+        debug('Running shard %s: %s', number, command)
+
+        process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output, _ = process.communicate()
+        with self._output_lock:
+            info('Shard %s: %s', number, ' '.join(tests))
+            sys.stdout.write(output.decode('utf-8', 'replace'))
+            sys.stdout.flush()
+        return number, process.returncode
+
+    def merge_xunit(self, xunit_files, units):
+        """
+        Returns the test suite merging the test suites of the *xunit_files*
+        and the files that cannot be read, and updates the durations of the
+        *units*.
+        """
+        index = dict((unit.replace(':', '.'), unit) for unit in units)
+        durations = collections.Counter()
+        merged = ElementTree.Element('testsuite', name='nosetests')
+        counts = collections.Counter()
+        unreadable = []
+
+        for xunit_file in xunit_files:
+            try:
+                suite = ElementTree.parse(xunit_file).getroot()
+            except (IOError, OSError, ElementTree.ParseError) as e:
+                debug('Cannot read %s: %s', xunit_file, e)
+                unreadable.append(xunit_file)
+                continue
+
+            for key in ['tests', 'errors', 'failures', 'skip']:
+                counts[key] += int(suite.get(key, 0))
+            for testcase in suite:
+                merged.append(testcase)
+                name = testcase.get('classname', '')
+                while name and name not in index:
+                    name = name.rpartition('.')[0]
+                if name:
+                    durations[index[name]] += float(testcase.get('time', 0))
+
+        for key in ['tests', 'errors', 'failures', 'skip']:
+            merged.set(key, str(counts[key]))
+        self.durations.update((unit, round(duration, 3)) for unit, duration in durations.items())
+        return ElementTree.ElementTree(merged), unreadable
+
+    def combine_coverage(self):
+        packages = self.options.get('cover-package') or []
+        if isinstance(packages, string_types):
+            packages = packages.split(',')
+        include = ['--include={}'.format(','.join(
+            os.path.join(package.replace('.', os.sep), '*') for package in packages))] if packages else []
+
+        sh([which.coverage, 'combine'])
+        if self.options.get('with-xcoverage'):
+            sh([which.coverage, 'xml', '-o', self.options.get('xcoverage-file', 'coverage.xml')] + include)
+        else:
+            sh([which.coverage, 'report'] + include)
+
+    def __call__(self):
+        tests = self.options.get('tests')
+        if not tests:
+            raise BuildFailure('The tests to shard are not given, set defaults.TESTS_ROOT or --test')
+
+        self.load_durations()
+        units = self.discover(tests)
+        if not units:
+            raise BuildFailure('No test module found in {}'.format(', '.join(tests)))
+        shards = self.balance(units)
+        info('Running %s test modules in %s processes', len(units), len(shards))
+
+        if self.with_coverage:
+            sh([which.coverage, 'erase'])
+
+        with Tempdir() as tempdir:
+            jobs = [(number, shard, tempdir.joinpath('shard-{}.xml'.format(number)))
+                    for number, shard in enumerate(shards, 1)]
+            runner = parallel(self._run_shard, backend='threaded', n=len(jobs))
+            failed = sorted(number for number, returncode in runner.map(jobs) if returncode)
+
+            report, unreadable = self.merge_xunit([xunit_file for number, shard, xunit_file in jobs], units)
+            self.save_durations()
+            if self.options.get('xunit-file'):
+                report.write(self.options['xunit-file'], encoding='utf-8', xml_declaration=True)
+
+        if self.with_coverage:
+            self.combine_coverage()
+
+        suite = report.getroot()
+        info('Ran %s tests: %s errors, %s failures, %s skipped',
+             suite.get('tests'), suite.get('errors'), suite.get('failures'), suite.get('skip'))
+        if failed:
+            raise BuildFailure('Tests failed in the shards {}'.format(', '.join(map(str, failed))))
+        if unreadable:
+            raise BuildFailure('The shards {} did not report their tests'.format(', '.join(
+                str(number) for number, shard, xunit_file in jobs if xunit_file in unreadable)))
+        if not int(suite.get('tests')):
+            raise BuildFailure('No test ran in {} test modules'.format(len(units)))
+
+
+PROCESSES_OPTION = optparse.make_option(
+    '-p', '--processes',
+    type='int',
+    help='Run the tests in N processes, defaults to defaults.TESTS_PROCESSES',
+)
+
+
+def _with_processes(runner_options, options):
+    processes = int(options.get('processes') or defaults.TESTS_PROCESSES or 1)
+    if processes > 1:
+        runner_options['processes'] = processes
+    return runner_options
+
+
 @task
 @needs(['setup_options'])
 @cmdopts([
@@ -268,11 +518,12 @@ class NosetestsCoverageOptions(NosetestsOptions):
     optparse.make_option('-x', '--xunit',
                          metavar='COVERAGE_XML_FILE',
                          help='Export a xunit file'),
+    PROCESSES_OPTION,
 ])
 def test(options):
     """Runs the tests"""
     nto = NosetestsOptions()
-    return call_task('test_runner', options=nto(options.test))
+    return call_task('test_runner', options=_with_processes(nto(options.test), options.test))
 
 
 @task
@@ -294,17 +545,27 @@ def test(options):
     optparse.make_option('-g', '--xcoverage',
                          metavar='COVERAGE_XML_FILE',
                          help='Export a cobertura file'),
+    PROCESSES_OPTION,
 ])
 def coverage(options):
     """Runs the unit tests and compute the coverage"""
     nto = NosetestsCoverageOptions()
-    return call_task('test_runner', options=nto(options.coverage))
+    return call_task('test_runner', options=_with_processes(nto(options.coverage), options.coverage))
 
 
 @task_alternative(100)
 def test_runner(options):
     debug('options are %s', options.test_runner)
-    call_task('nosetests', options=options.test_runner)
+    runner_options = dict(options.test_runner)
+    processes = runner_options.pop('processes', 1)
+    if processes > 1 and not runner_options.get('tests'):
+        info('No tests given to shard, running nose in one process')
+        processes = 1
+
+    if processes > 1:
+        ShardedNosetests.default(runner_options, processes)()
+    else:
+        call_task('nosetests', options=runner_options)
 
 
 @task
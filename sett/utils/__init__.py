@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 
 from sett.utils.loading import optional_import, import_string
-from sett.utils.fs import Tempdir, LineReplacer
+from sett.utils.fs import Tempdir, LineReplacer, file_hash
 from sett.utils.install import BaseInstalledPackages, GitInstall
 from sett.utils.task import task_name
 
@@ -11,6 +11,7 @@ __all__ = [
     'import_string',
     'Tempdir',
     'LineReplacer',
+    'file_hash',
     'BaseInstalledPackages',
     'GitInstall',
     'task_name',
@@ -1,10 +1,91 @@
 # -*- coding: utf-8 -*-
 
 
+import os
+import json
+import errno
+import hashlib
 import tempfile
+from paver.easy import debug
 from paver.path import path
 
 
+def file_hash(filename):
+    """
+    Returns the sha1 hex digest of the content of *filename*
+    """
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as file:
+        for chunk in iter(lambda: file.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def makedirs(dirname):
+    """
+    Creates the directory *dirname* and its parents, when another thread or
+    process did not create it first.
+    """
+    try:
+        os.makedirs(dirname)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(dirname):
+            raise
+
+
+def atomic_write(filename, content):
+    """
+    Writes the bytes *content* in a temp file renamed to *filename*, so that
+    *filename* is never partially written.
+    """
+    dirname = os.path.dirname(filename)
+    makedirs(dirname)
+    temp = tempfile.NamedTemporaryFile('wb', dir=dirname, delete=False)
+    with temp:
+        temp.write(content)
+    os.rename(temp.name, filename)
+
+
+class OutputCache(object):
+    """
+    The key of the compilation that wrote each output file and the hash of
+    its content, kept in *cache_file*.
+    """
+    def __init__(self, cache_file=None):
+        self.cache_file = cache_file
+        self._entries = {}
+
+    def load(self):
+        if not self.cache_file:
+            return
+
+        try:
+            with open(self.cache_file, 'r') as cache_file:
+                self._entries = json.load(cache_file)
+        except (IOError, OSError, ValueError) as e:
+            debug('Cannot read %s: %s', self.cache_file, e)
+
+    def save(self):
+        if self.cache_file:
+            atomic_write(self.cache_file, json.dumps(self._entries).encode('utf-8'))
+
+    def is_fresh(self, outfile, key):
+        """
+        Returns True if *outfile* has been written by the compilation *key*
+        and not modified since.
+        """
+        cached = self._entries.get(outfile)
+        if not cached or cached['key'] != key:
+            return False
+        try:
+            return file_hash(outfile) == cached['out']
+        except (IOError, OSError):
+            return False
+
+    def set(self, outfile, key, out_hash):
+        self._entries[outfile] = {'key': key, 'out': out_hash}
+
+
 class Tempdir(object):
     """Context manager for a temporary directory"""
 
@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+
+"""
+File watcher
+============
+
+A Watcher calls a handler with the files modified under a set of directories.
+The events of the file system are coalesced: the files created, modified,
+moved or deleted close in time are given together to the handler, once.
+
+>>> def build(paths):
+...     print('Modified', paths)
+>>> with Watcher(['src/'], build, patterns=['*.scss']):
+...     call_task('runserver')
+
+The events are collected by a backend. The *inotify* backend uses the inotify
+API of Linux directly, the *watchdog* backend requires watchdog. The backend
+is chosen by defaults.WATCH_BACKEND, *auto* selects inotify on Linux and
+watchdog elsewhere.
+
+Debounce
+--------
+
+The batch of paths starts with the first event and ends when no event came
+for a quiet period. The quiet period starts at DEBOUNCE_MIN and grows to twice
+the longest gap between two events of the batch, so that slow sequences of
+writes (editors saving in several steps, git checkouts) end up in the same
+batch. A batch never lasts more than DEBOUNCE_MAX.
+"""
+
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import fnmatch
+import threading
+import traceback
+import ctypes
+import ctypes.util
+
+from paver.easy import debug, info
+from paver.deps.six import moves, text_type
+
+from sett import defaults, optional_import
+
+observers = optional_import('watchdog.observers')
+events = optional_import('watchdog.events')
+
+
+# Quiet period after an event ending a batch, in seconds
+DEBOUNCE_MIN = 0.050
+# Maximum duration of a batch, in seconds
+DEBOUNCE_MAX = 1.0
+
+
+class BaseBackend(object):
+    """
+    A source of file system events. The *callback* is called with the path
+    of each file created, modified, moved or deleted under the watched
+    directories, from another thread. It's called with None when events have
+    been lost.
+    """
+    def __init__(self, callback):
+        self.callback = callback
+
+    def watch(self, path):
+        """Watches *path* recursively"""
+        raise NotImplementedError()
+
+    def start(self):
+        raise NotImplementedError()
+
+    def stop(self):
+        raise NotImplementedError()
+
+
+class InotifyBackend(BaseBackend):
+    """
+    A backend using the inotify API of Linux through ctypes. A watch is added
+    on each directory, including the directories created later.
+    """
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0o2000000
+
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+    EVENT = struct.Struct('iIII')
+
+    _libc = None
+
+    @classmethod
+    def libc(cls):
+        if cls._libc is None:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            cls._libc = libc
+        return cls._libc
+
+    @classmethod
+    def available(cls):
+        if not sys.platform.startswith('linux'):
+            return False
+        try:
+            return hasattr(cls.libc(), 'inotify_init1')
+        except OSError:
+            return False
+
+    def __init__(self, callback):
+        super(InotifyBackend, self).__init__(callback)
+        self._fd = self.libc().inotify_init1(self.IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._watches = {}
+        self._thread = None
+        self._stop_r, self._stop_w = os.pipe()
+
+    def __repr__(self):
+        return 'InotifyBackend({} watches)'.format(len(self._watches))
+
+    def _add_watch(self, directory):
+        encoded = directory
+        if isinstance(encoded, text_type):
+            encoded = encoded.encode(sys.getfilesystemencoding())
+        wd = self.libc().inotify_add_watch(self._fd, encoded, self.MASK | self.IN_ONLYDIR)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                return
+            raise OSError(err, 'Cannot watch {}: {}'.format(directory, os.strerror(err)))
+        self._watches[wd] = directory
+
+    def watch(self, path, report=False):
+        """
+        Watches *path* and its sub directories. When *report* is set, the
+        files already there are reported, for the directories created after
+        the watch started.
+        """
+        for dirpath, dirnames, filenames in os.walk(path):
+            self._add_watch(dirpath)
+            if report:
+                for filename in filenames:
+                    self.callback(os.path.join(dirpath, filename))
+
+    def start(self):
+        assert self._thread is None
+        self._thread = threading.Thread(target=self._run, name='inotify')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        os.write(self._stop_w, b'x')
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for fd in (self._fd, self._stop_r, self._stop_w):
+            os.close(fd)
+
+    def _run(self):
+        while True:
+            readable, _, _ = select.select([self._fd, self._stop_r], [], [])
+            if self._stop_r in readable:
+                return
+            try:
+                data = os.read(self._fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            self._dispatch(data)
+
+    def _dispatch(self, data):
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & self.IN_Q_OVERFLOW:
+                debug('inotify queue overflow')
+                self.callback(None)
+                continue
+
+            if mask & self.IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+
+            directory = self._watches.get(wd)
+            if directory is None or not name:
+                continue
+
+            path = os.path.join(directory, name.decode(sys.getfilesystemencoding()))
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    self.watch(path, report=True)
+                continue
+
+            self.callback(path)
+
+
+class WatchdogBackend(BaseBackend):
+    """
+    A backend using watchdog.
+    """
+    def __init__(self, callback):
+        super(WatchdogBackend, self).__init__(callback)
+        self.observer = observers.Observer()
+
+    def __repr__(self):
+        return 'WatchdogBackend()'
+
+    def watch(self, path):
+        self.observer.schedule(self, path, recursive=True)
+
+    def dispatch(self, event):
+        if event.is_directory:
+            return
+        self.callback(event.src_path)
+        if isinstance(event, events.FileMovedEvent):
+            self.callback(event.dest_path)
+
+    def start(self):
+        self.observer.start()
+
+    def stop(self):
+        self.observer.stop()
+        self.observer.join()
+
+
+BACKENDS = {
+    'inotify': InotifyBackend,
+    'watchdog': WatchdogBackend,
+}
+
+
+def get_backend(name=None):
+    """
+    Returns the backend class *name*, defaulting to defaults.WATCH_BACKEND.
+    The name *auto* selects inotify when it's available, else watchdog.
+    """
+    name = name or defaults.WATCH_BACKEND
+    if name == 'auto':
+        name = 'inotify' if InotifyBackend.available() else 'watchdog'
+    try:
+        return BACKENDS[name]
+    except KeyError:
+        raise ValueError('Unknown watch backend {}, expected one of {}'.format(
+            name, ', '.join(sorted(BACKENDS))))
+
+
+class Watcher(object):
+    """
+    Calls *handler* with the list of paths modified under *paths* matching
+    one of the glob *patterns*, or all paths when *patterns* is not given.
+    The patterns are matched against the full path and the name of the file.
+
+    When events have been lost, *on_overflow* is called instead, or
+    *handler* with the watched paths.
+
+    It can be called in the same thread or started in another thread.
+
+    >>> w = Watcher(['src/'], build)
+    >>> w()  # Blocks until it's stopped
+    """
+    def __init__(self, paths, handler, patterns=None, backend=None, on_overflow=None):
+        self.paths = list(paths)
+        self.handler = handler
+        self.patterns = list(patterns) if patterns else None
+        self.on_overflow = on_overflow
+        self.queue = moves.queue.Queue()
+        self._thread = None
+        self._stop = object()
+        self._overflow = object()
+
+        self.backend = get_backend(backend)(self._on_event)
+        for filepath in self.paths:
+            debug('Watching %s', filepath)
+            self.backend.watch(filepath)
+
+    def __repr__(self):
+        return 'Watcher({}, {!r})'.format(', '.join(self.paths), self.backend)
+
+    def match(self, path):
+        if self.patterns is None:
+            return True
+        name = os.path.basename(path)
+        return any(fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(name, pattern)
+                   for pattern in self.patterns)
+
+    def _on_event(self, path):
+        if path is None:
+            self.queue.put(self._overflow)
+        elif self.match(path):
+            self.queue.put(path)
+
+    def start(self):
+        self.start_observer()
+        assert self._thread is None
+        self._thread = threading.Thread(target=self.run)
+        self._thread.start()
+
+    def stop(self):
+        self.stop_observer()
+        self.queue.put(self._stop)
+        self._thread.join()
+        self._thread = None
+
+    def __call__(self):
+        self.start_observer()
+        debug('Processing loop')
+        try:
+            self.run()
+        finally:
+            self.stop_observer()
+
+    def collect(self, first):
+        """
+        Returns the set of paths of the batch started by *first*
+        """
+        paths = {first}
+        quiet = DEBOUNCE_MIN
+        last = start = time.time()
+        while True:
+            timeout = min(last + quiet, start + DEBOUNCE_MAX) - time.time()
+            if timeout <= 0:
+                break
+            try:
+                path = self.queue.get(timeout=timeout)
+            except moves.queue.Empty:
+                break
+
+            now = time.time()
+            quiet = min(max(quiet, 2 * (now - last)), DEBOUNCE_MAX)
+            last = now
+            paths.add(path)
+        debug('Collected %s events in %.3fs', len(paths), time.time() - start)
+        return paths
+
+    def run(self):
+        while True:
+            path = self.queue.get()
+            if path is self._stop:
+                break
+
+            paths = self.collect(path)
+            if self._stop in paths:
+                break
+
+            try:
+                if self._overflow in paths:
+                    info('Events have been lost, building everything')
+                    if self.on_overflow:
+                        self.on_overflow()
+                    else:
+                        self.handler(sorted(self.paths))
+                else:
+                    self.handler(sorted(paths))
+            except Exception:
+                traceback.print_exc()
+
+    def start_observer(self):
+        debug('Start observer')
+        self.backend.start()
+
+    def stop_observer(self):
+        debug('Stop observer')
+        self.backend.stop()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_value, exc_type, tb):
+        self.stop()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Watch
+=====
+
+The *watch_assets* task watches the sources of the assets and runs the tasks that
+build them, in a single process and with a single watcher.
+
+Each rule of defaults.WATCH_RULES maps a glob pattern, relative to ROOT, to a
+task. The globs match in a single directory and ``**`` matches any number of
+directories. The rule may give a template formatted with each modified file:
+``{path}`` the absolute path, ``{relpath}`` the path relative to ROOT,
+``{name}`` the name of the file without extension and ``{relname}`` the path
+without extension relative to the directory of the rule. The values are
+passed to the task in its args, or in the option named by the rule for the
+tasks taking options.
+
+    WATCH_RULES = [
+        # pattern, task, template, option
+        ('compass/scss/**/*.scss', 'sassc_compile'),
+        ('static/js/app/*.js', 'rjs', 'app/{name}', 'paths'),
+        ('scripts/js/**/*.js', 'uglify', '{relname}'),
+    ]
+
+The files modified together are grouped, each task is run once by group with
+the values of all the files and the tasks of a group run concurrently, but the
+tasks receiving args, kept by paver in a global, one after another.
+
+    $ paver watch_assets
+    $ paver watch_assets uglify  # only the rules of uglify
+"""
+
+import os
+import fnmatch
+import collections
+
+from paver.easy import task, consume_args, info, debug, environment, BuildFailure
+
+from sett import ROOT, defaults, parallel
+from sett.utils.watch import Watcher
+
+
+class WatchRule(collections.namedtuple('_WatchRule', ['pattern', 'task', 'template', 'option'])):
+    """
+    A *pattern* relative to ROOT, the *task* to run, and optionally the
+    *template* of the values given to the task and the *option* in which they
+    are given.
+    """
+    GLOB_CHARS = set('*?[')
+
+    @classmethod
+    def from_tuple(cls, rule):
+        rule = tuple(rule)
+        return cls(*(rule + (None, ) * (4 - len(rule))))
+
+    @property
+    def directory(self):
+        """
+        The directory to watch, the part of the pattern before the first glob
+        """
+        parts = []
+        for part in self.pattern.split('/'):
+            if self.GLOB_CHARS.intersection(part):
+                break
+            parts.append(part)
+        return ROOT.joinpath(*parts)
+
+    def match(self, relpath):
+        return self._match(self.pattern.split('/'), relpath.replace(os.sep, '/').split('/'))
+
+    @classmethod
+    def _match(cls, parts, names):
+        if not parts:
+            return not names
+        if parts[0] == '**':
+            return any(cls._match(parts[1:], names[i:]) for i in range(len(names) + 1))
+        return bool(names) and fnmatch.fnmatch(names[0], parts[0]) and cls._match(parts[1:], names[1:])
+
+    @property
+    def takes_args(self):
+        return bool(self.template and not self.option)
+
+    def format(self, path):
+        relpath = ROOT.relpathto(path)
+        return self.template.format(
+            path=path,
+            relpath=relpath,
+            name=os.path.splitext(os.path.basename(path))[0],
+            relname=os.path.splitext(self.directory.relpathto(path))[0].replace(os.sep, '/'),
+        )
+
+
+class TaskWatcher(Watcher):
+    """
+    A watcher running the tasks of the *rules* matching the modified files.
+    """
+    def __init__(self, rules, backend=None):
+        self.rules = rules
+        directories = sorted(set(rule.directory for rule in rules))
+        missing = [d for d in directories if not d.isdir()]
+        if missing:
+            info('Not watching missing directories: %s', ', '.join(missing))
+        directories = [d for d in directories if d not in missing]
+        if not directories:
+            raise BuildFailure('No directory to watch')
+
+        super(TaskWatcher, self).__init__(directories, self.build, backend=backend)
+
+    def match(self, path):
+        relpath = ROOT.relpathto(path)
+        return any(rule.match(relpath) for rule in self.rules)
+
+    def plan(self, paths):
+        """
+        Returns the tasks to call for the modified *paths*, in a dict of the
+        rule to the values passed to the task.
+        """
+        calls = collections.OrderedDict()
+        for path in paths:
+            relpath = ROOT.relpathto(path)
+            for rule in self.rules:
+                if not rule.match(relpath):
+                    continue
+                values = calls.setdefault(rule, [])
+                if rule.template:
+                    value = rule.format(path)
+                    if value not in values:
+                        values.append(value)
+        return calls
+
+    def call(self, rule, values):
+        debug('Calling %s with %s', rule.task, values)
+        if not rule.template:
+            environment.call_task(rule.task)
+        elif rule.option:
+            environment.call_task(rule.task, options={rule.option: values})
+        else:
+            environment.call_task(rule.task, args=values)
+
+    def call_all(self, calls):
+        for rule, values in calls:
+            self.call(rule, values)
+
+    def build(self, paths):
+        calls = self.plan(paths)
+        if not calls:
+            return
+
+        info('Modified %s, running %s', ', '.join(ROOT.relpathto(p) for p in paths),
+             ', '.join(rule.task for rule in calls))
+        # The args of the tasks are kept in environment.args
+        jobs = [[call] for call in calls.items() if not call[0].takes_args]
+        args_calls = [call for call in calls.items() if call[0].takes_args]
+        if args_calls:
+            jobs.append(args_calls)
+        runner = parallel(self.call_all, backend='threaded', n=len(jobs))
+        runner.for_each(jobs)
+
+
+@task
+@consume_args
+def watch_assets(args):
+    """Usage: watch_assets [task...]
+Watch the files matching the rules of defaults.WATCH_RULES and run their
+tasks. When tasks are given, only their rules are used.
+"""
+    rules = [WatchRule.from_tuple(rule) for rule in defaults.WATCH_RULES]
+    if args:
+        rules = [rule for rule in rules if rule.task in args]
+    if not rules:
+        raise BuildFailure('No watch rule')
+
+    watcher = TaskWatcher(rules)
+    info('Watching %s', ', '.join(ROOT.relpathto(p) for p in watcher.paths))
+    try:
+        watcher()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+from django.db import models
+
+
+class Category(models.Model):
+    name = models.CharField(max_length=100)
+    parent = models.ForeignKey('self', null=True, on_delete=models.CASCADE)
+
+
+class Author(models.Model):
+    name = models.CharField(max_length=100)
+    best_book = models.ForeignKey('Book', null=True, related_name='+', on_delete=models.SET_NULL)
+
+
+class Book(models.Model):
+    title = models.CharField(max_length=100)
+    author = models.ForeignKey(Author, null=True, on_delete=models.CASCADE)
+
+
+class Publisher(models.Model):
+    name = models.CharField(max_length=100)
+
+
+class Series(models.Model):
+    name = models.CharField(max_length=100)
+    publisher = models.ForeignKey(Publisher, on_delete=models.CASCADE)
+
+
+class Magazine(models.Model):
+    name = models.CharField(max_length=100)
+    publisher = models.ForeignKey(Publisher, on_delete=models.CASCADE)
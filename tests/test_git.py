@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from sett.git import changed_files
+
+
+class TestChangedFiles(unittest.TestCase):
+    def setUp(self):
+        mock.patch('sett.git.which', git='git').start()
+        self.sh = mock.patch('sett.git.sh').start()
+
+    def tearDown(self):
+        mock.patch.stopall()
+
+    def test_changed_files(self):
+        self.sh.side_effect = ['sett/a.py\nsett/b.py\n', 'sett/b.py\nsett/new.py\n']
+        self.assertEqual(changed_files('origin/master', ['*.py']), ['sett/a.py', 'sett/b.py', 'sett/new.py'])
+        self.sh.assert_has_calls([
+            mock.call(['git', 'diff', '--name-only', '--relative', '--diff-filter=ACMR', 'origin/master', '--', '*.py'],
+                      capture=True),
+            mock.call(['git', 'ls-files', '--others', '--exclude-standard', '--', '*.py'], capture=True),
+        ])
+
+    def test_nothing_changed(self):
+        self.sh.side_effect = ['', '']
+        self.assertEqual(changed_files('HEAD'), [])
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from paver.easy import BuildFailure
+from sett.graph import TaskGraph, GraphRunner
+
+
+class FakeTask(object):
+    def __init__(self, name, needs=(), fail=False):
+        self.name = name
+        self.needs = list(needs)
+        self.called = False
+        self.fail = fail
+
+    def __call__(self):
+        if self.fail:
+            raise ValueError(self.name)
+        self.called = True
+
+
+class FakeEnvironment(object):
+    def __init__(self, *tasks):
+        self.tasks = dict((t.name, t) for t in tasks)
+
+    def get_task(self, name):
+        return self.tasks.get(name)
+
+
+class TestTaskGraph(unittest.TestCase):
+    def setUp(self):
+        self.env = FakeEnvironment(
+            FakeTask('a'),
+            FakeTask('b'),
+            FakeTask('c', ['a', 'b']),
+            FakeTask('d', ['c']),
+        )
+        self.graph = TaskGraph(self.env)
+
+    def test_add(self):
+        self.graph.add('d')
+        self.assertEqual(set(self.graph), {'a', 'b', 'c', 'd'})
+        self.assertEqual(self.graph.needs['c'], {'a', 'b'})
+
+    def test_unknown(self):
+        with self.assertRaises(BuildFailure):
+            self.graph.add('e')
+
+    def test_topological_order(self):
+        self.graph.add('d')
+        self.assertEqual(self.graph.topological_order(), ['a', 'b', 'c', 'd'])
+
+    def test_cycle(self):
+        self.env.tasks['a'].needs.append('d')
+        self.graph.add('d')
+        with self.assertRaises(BuildFailure):
+            self.graph.topological_order()
+
+
+class TestGraphRunner(unittest.TestCase):
+    def setUp(self):
+        self.env = FakeEnvironment(
+            FakeTask('a'),
+            FakeTask('b'),
+            FakeTask('c', ['a', 'b']),
+            FakeTask('d', ['a']),
+        )
+        self.graph = TaskGraph(self.env)
+
+    def test_run(self):
+        self.graph.add('c')
+        self.graph.add('d')
+        runner = GraphRunner(self.graph, jobs=2)
+        runner()
+        assert all(t.called for t in self.env.tasks.values())
+
+        for name, needs in self.graph.needs.items():
+            for required in needs:
+                assert runner.timings[required][1] <= runner.timings[name][0]
+
+    def test_failure(self):
+        self.env.tasks['a'].fail = True
+        self.graph.add('c')
+        runner = GraphRunner(self.graph, jobs=2)
+        with self.assertRaises(RuntimeError):
+            runner()
+        assert not self.env.tasks['c'].called
+
+    def test_critical_path(self):
+        self.graph.add('c')
+        self.graph.add('d')
+        runner = GraphRunner(self.graph)
+        runner.timings = {
+            'a': (0, 1),
+            'b': (0, 3),
+            'c': (3, 4),
+            'd': (1, 2),
+        }
+        self.assertEqual(runner.critical_path(), (['b', 'c'], 4))
+
+    def test_summary(self):
+        self.graph.add('d')
+        runner = GraphRunner(self.graph)
+        runner.timings = {
+            'a': (0, 1),
+            'd': (1, 3),
+        }
+        self.assertEqual(runner.summary(), [
+            'Ran 2 tasks in 3.00s (3.00s of tasks time)',
+            'Critical path 3.00s: a (1.00s) -> d (2.00s)',
+        ])
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+
+import importlib
+import unittest
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+from paver.path import path
+
+from sett.libsass import BaseSass, DependencyTracker, DependencyGraph, Watcher
+from sett.utils import Tempdir
+from sett.utils.loading import FakeModule
+
+libsass = importlib.import_module('sett.libsass').libsass
+
+
+class TestBaseSass(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = Tempdir().open()
+        self.src = self.tempdir.joinpath('scss')
+        self.dest = self.tempdir.joinpath('css')
+        self.src.joinpath('pages').makedirs()
+        self.src.joinpath('_colors.scss').write_text(u'$main: #123456;\n')
+        self.src.joinpath('_fonts.scss').write_text(u'$font: serif;\n')
+        self.src.joinpath('main.scss').write_text(u'@import "colors";\na { color: $main; }\n')
+        self.src.joinpath('pages/page.scss').write_text(u'@import "fonts";\np { font-family: $font; }\n')
+        self.sass = BaseSass(self.src, self.dest, [], [])
+
+        self.compile = mock.patch('sett.libsass.libsass').start().compile
+        self.compile.side_effect = self.fake_compile
+        mock.patch('sett.libsass.defaults.SASS_PARALLEL_BACKEND', 'threaded').start()
+        mock.patch('sett.libsass.defaults.SASS_JOBS', 2).start()
+
+    def tearDown(self):
+        mock.patch.stopall()
+        self.tempdir.rmtree()
+
+    def fake_compile(self, filename, importers, **kw):
+        imports = {
+            'main.scss': [('colors', filename)],
+            'page.scss': [('fonts', filename)],
+            'nested.scss': [('components/buttons', filename),
+                            ('mixins', self.src.joinpath('components/_buttons.scss'))],
+            'missing.scss': [('colors', filename), ('plugin', filename), ('print.css', filename)],
+        }
+        for import_name, prev in imports[path(filename).basename()]:
+            for priority, importer in importers:
+                importer(import_name, prev)
+        css = u'/* {} */'.format(path(filename).basename())
+        if 'source_map_filename' in kw:
+            return css, u'{{"file": "{}"}}'.format(kw['output_filename_hint'])
+        return css
+
+    def test_build_all(self):
+        self.sass()
+
+        self.assertEqual(self.compile.call_count, 2)
+        self.assertEqual(self.dest.joinpath('main.css').text(), u'/* main.scss */')
+        self.assertEqual(self.dest.joinpath('pages/page.css').text(), u'/* page.scss */')
+        self.assertIn('colors', self.sass._deps[self.src.joinpath('main.scss')])
+
+    def test_rebuild_partial(self):
+        self.sass()
+        self.compile.reset_mock()
+
+        self.src.joinpath('_colors.scss').write_text(u'$main: #654321;\n')
+        self.sass.rebuild([self.src.joinpath('_colors.scss')])
+        self.compile.assert_called_once_with(filename=self.src.joinpath('main.scss'), importers=mock.ANY,
+                                             output_style=mock.ANY, custom_functions=[], include_paths=mock.ANY)
+
+    def test_rebuild_partial_without_deps(self):
+        self.sass.rebuild([self.src.joinpath('_colors.scss')])
+        self.assertEqual(self.compile.call_count, 2)
+
+    def test_rebuild_files(self):
+        self.sass()
+        self.compile.reset_mock()
+
+        self.src.joinpath('_colors.scss').write_text(u'$main: #654321;\n')
+        self.src.joinpath('pages/page.scss').write_text(u'@import "fonts";\n')
+
+        self.sass.rebuild([
+            self.src.joinpath('_colors.scss'),
+            self.src.joinpath('main.scss'),
+            self.src.joinpath('pages/page.scss'),
+        ])
+        self.assertEqual(self.compile.call_count, 2)
+
+    def test_rebuild_unknown_entries(self):
+        self.sass()
+        self.sass._deps.discard(self.src.joinpath('pages/page.scss'))
+        self.compile.reset_mock()
+
+        self.src.joinpath('_colors.scss').write_text(u'$main: #654321;\n')
+
+        self.sass.rebuild([self.src.joinpath('_colors.scss')])
+        self.assertEqual(self.compile.call_count, 2)
+
+    def test_persisted_graph(self):
+        cache_dir = self.tempdir.joinpath('cache')
+        BaseSass(self.src, self.dest, [], [], cache_dir=cache_dir)()
+        self.compile.reset_mock()
+
+        self.src.joinpath('_fonts.scss').write_text(u'$font: sans-serif;\n')
+        sass = BaseSass(self.src, self.dest, [], [], cache_dir=cache_dir)
+        sass.rebuild([self.src.joinpath('_fonts.scss')])
+        self.compile.assert_called_once_with(filename=self.src.joinpath('pages/page.scss'), importers=mock.ANY,
+                                             output_style=mock.ANY, custom_functions=[], include_paths=mock.ANY)
+
+    def test_persisted_graph_changed(self):
+        cache_dir = self.tempdir.joinpath('cache')
+        BaseSass(self.src, self.dest, [], [], cache_dir=cache_dir)()
+        self.src.joinpath('_colors.scss').write_text(u'$main: #654321;\n')
+
+        sass = BaseSass(self.src, self.dest, [], [], cache_dir=cache_dir)
+        self.assertNotIn(self.src.joinpath('main.scss'), sass._deps)
+        self.assertIn(self.src.joinpath('pages/page.scss'), sass._deps)
+
+    def add_nested(self):
+        self.src.joinpath('components').makedirs()
+        self.src.joinpath('components/_buttons.scss').write_text(u'@import "mixins";\n')
+        self.src.joinpath('components/_mixins.scss').write_text(u'$c: red;\n')
+        self.src.joinpath('nested.scss').write_text(u'@import "components/buttons";\n')
+
+    def test_nested_partial(self):
+        self.add_nested()
+        self.sass()
+        nested = self.src.joinpath('nested.scss')
+        self.assertIn(self.src.joinpath('components/_mixins.scss'), self.sass._deps.files(nested))
+
+        self.src.joinpath('components/_mixins.scss').write_text(u'$c: blue;\n')
+        self.compile.reset_mock()
+        self.sass()
+        self.compile.assert_called_once_with(filename=nested, importers=mock.ANY,
+                                             output_style=mock.ANY, custom_functions=[], include_paths=mock.ANY)
+
+    def test_rebuild_nested_partial(self):
+        self.add_nested()
+        self.sass()
+        self.compile.reset_mock()
+
+        self.src.joinpath('components/_mixins.scss').write_text(u'$c: blue;\n')
+        self.sass.rebuild([self.src.joinpath('components/_mixins.scss')])
+        self.compile.assert_called_once_with(filename=self.src.joinpath('nested.scss'), importers=mock.ANY,
+                                             output_style=mock.ANY, custom_functions=[], include_paths=mock.ANY)
+
+    def test_import_not_found(self):
+        self.src.joinpath('missing.scss').write_text(u'@import "plugin";\n')
+        self.sass()
+        self.assertIsNone(self.sass._deps.files(self.src.joinpath('missing.scss')))
+
+        self.compile.reset_mock()
+        self.sass()
+        self.compile.assert_called_once_with(filename=self.src.joinpath('missing.scss'), importers=mock.ANY,
+                                             output_style=mock.ANY, custom_functions=[], include_paths=mock.ANY)
+
+    def test_up_to_date(self):
+        self.sass()
+        self.compile.reset_mock()
+
+        with mock.patch('sett.libsass.atomic_write') as atomic_write:
+            self.sass()
+        self.assertFalse(self.compile.called)
+        self.assertFalse(atomic_write.called)
+        self.assertEqual(self.sass.format_stats(), 'Sass cache: 2 hits, 2 misses, 2 written, 0 unchanged')
+
+    def test_up_to_date_persisted(self):
+        cache_dir = self.tempdir.joinpath('cache')
+        BaseSass(self.src, self.dest, [], [], cache_dir=cache_dir)()
+        self.compile.reset_mock()
+
+        BaseSass(self.src, self.dest, [], [], cache_dir=cache_dir)()
+        self.assertFalse(self.compile.called)
+
+    def test_same_output(self):
+        self.sass()
+        self.src.joinpath('_colors.scss').write_text(u'$main: #654321;\n')
+
+        with mock.patch('sett.libsass.atomic_write') as atomic_write:
+            self.sass()
+        self.assertFalse(atomic_write.called)
+        self.assertEqual(self.sass.stats['unchanged'], 1)
+
+    def test_output_style_changed(self):
+        self.sass()
+        self.compile.reset_mock()
+
+        with mock.patch('sett.libsass.defaults.SASS_OUTPUT_STYLE', 'compressed'):
+            self.sass()
+        self.assertEqual(self.compile.call_count, 2)
+
+    def test_output_modified(self):
+        self.sass()
+        self.compile.reset_mock()
+
+        self.dest.joinpath('main.css').write_text(u'a {}')
+        self.sass()
+        self.assertEqual(self.compile.call_count, 1)
+        self.assertEqual(self.dest.joinpath('main.css').text(), u'/* main.scss */')
+
+    def test_outputs(self):
+        outputs = [('compressed', '.css', True), ('expanded', '.debug.css', False)]
+        with mock.patch('sett.libsass.defaults.SASS_OUTPUTS', outputs):
+            self.sass()
+
+        self.assertEqual(self.compile.call_count, 4)
+        self.compile.assert_any_call(filename=self.src.joinpath('main.scss'), importers=mock.ANY,
+                                     output_style='compressed', custom_functions=[], include_paths=mock.ANY,
+                                     source_map_filename=self.dest.joinpath('main.css.map'),
+                                     output_filename_hint=self.dest.joinpath('main.css'))
+        self.compile.assert_any_call(filename=self.src.joinpath('main.scss'), importers=mock.ANY,
+                                     output_style='expanded', custom_functions=[], include_paths=mock.ANY)
+        self.assertEqual(sorted(f.basename() for f in self.dest.files()),
+                         ['main.css', 'main.css.map', 'main.debug.css'])
+
+    def test_outputs_map_modified(self):
+        outputs = [('compressed', '.css', True)]
+        with mock.patch('sett.libsass.defaults.SASS_OUTPUTS', outputs):
+            self.sass()
+            self.compile.reset_mock()
+
+            self.dest.joinpath('main.css.map').write_text(u'{}')
+            self.sass()
+        self.assertEqual(self.compile.call_count, 1)
+
+    def test_report(self):
+        with mock.patch('sett.libsass.info') as info:
+            self.sass()
+        info.assert_any_call('Built %s files in %.2fs (%.2fs of compilation)', 2, mock.ANY, mock.ANY)
+        info.assert_any_call('%6.2fs %s', mock.ANY, 'main.scss')
+
+    def test_failure(self):
+        self.compile.side_effect = ValueError('Invalid CSS')
+        with mock.patch('sett.libsass.error'):
+            with self.assertRaises(RuntimeError):
+                self.sass()
+
+
+class TestWatcher(unittest.TestCase):
+    def test_rebuild(self):
+        builder = mock.Mock(paths=['/src/'])
+        with mock.patch.dict('sett.utils.watch.BACKENDS', {'fake': mock.Mock()}):
+            watcher = Watcher(builder, backend='fake')
+
+        with mock.patch('os.path.exists', side_effect=lambda p: p != '/src/deleted.scss'):
+            watcher.rebuild(['/src/_colors.scss', '/src/deleted.scss', '/src/main.scss'])
+        builder.rebuild.assert_called_once_with(['/src/_colors.scss', '/src/main.scss'])
+
+    def test_patterns(self):
+        with mock.patch.dict('sett.utils.watch.BACKENDS', {'fake': mock.Mock()}):
+            watcher = Watcher(mock.Mock(paths=['/src/']), backend='fake')
+        self.assertTrue(watcher.match('/src/main.scss'))
+        self.assertFalse(watcher.match('/src/.main.scss.swp'))
+
+
+class TestDependencyGraph(unittest.TestCase):
+    def setUp(self):
+        self.graph = DependencyGraph()
+        self.graph.add('a.scss', DependencyTracker(['colors', 'fonts']), {})
+        self.graph.add('b.scss', DependencyTracker(['colors']), {})
+
+    def test_importers(self):
+        self.assertEqual(self.graph.importers(['colors']), {'a.scss', 'b.scss'})
+        self.assertEqual(self.graph.importers(['fonts', 'other']), {'a.scss'})
+
+    def test_add_again(self):
+        self.graph.add('a.scss', DependencyTracker(['fonts']), {})
+        self.assertEqual(self.graph.importers(['colors']), {'b.scss'})
+
+    def test_discard(self):
+        self.graph.discard('a.scss')
+        self.assertEqual(self.graph.importers(['fonts']), set())
+        self.assertEqual(len(self.graph), 1)
+
+
+@unittest.skipIf(isinstance(libsass, FakeModule), 'libsass is not installed')
+class TestBaseSassProcess(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = Tempdir().open()
+        self.src = self.tempdir.joinpath('scss')
+        self.dest = self.tempdir.joinpath('css')
+        self.src.makedirs()
+        self.src.joinpath('_colors.scss').write_text(u'$main: #123456;\n')
+        for name in ['a', 'b', 'c']:
+            self.src.joinpath(name + '.scss').write_text(u'@import "colors";\n.{} {{ color: $main; }}\n'.format(name))
+
+    def tearDown(self):
+        self.tempdir.rmtree()
+
+    def test_build_all(self):
+        sass = BaseSass(self.src, self.dest, [], [])
+        with mock.patch('sett.libsass.defaults.SASS_PARALLEL_BACKEND', 'process'):
+            with mock.patch('sett.libsass.defaults.SASS_JOBS', 2):
+                sass()
+
+        self.assertIn('#123456', self.dest.joinpath('b.css').text())
+        self.assertIsInstance(sass._deps[self.src.joinpath('a.scss')], DependencyTracker)
+        self.assertIn('colors', sass._deps[self.src.joinpath('c.scss')])
+
+    def test_nested_partial(self):
+        self.src.joinpath('components').makedirs()
+        self.src.joinpath('components/_buttons.scss').write_text(u'@import "mixins";\n.btn { color: $c; }\n')
+        self.src.joinpath('components/_mixins.scss').write_text(u'$c: red;\n')
+        self.src.joinpath('buttons.scss').write_text(u'@import "components/buttons";\n')
+        cache_dir = self.tempdir.joinpath('cache')
+        BaseSass(self.src, self.dest, [], [], cache_dir=cache_dir)()
+
+        self.src.joinpath('components/_mixins.scss').write_text(u'$c: blue;\n')
+        sass = BaseSass(self.src, self.dest, [], [], cache_dir=cache_dir)
+        sass()
+        self.assertIn(u'color: blue', self.dest.joinpath('buttons.css').text())
+        self.assertEqual(sass.stats['misses'], 1)
+
+    def test_outputs(self):
+        sass = BaseSass(self.src, self.dest, [], [])
+        outputs = [('compressed', '.css', True), ('expanded', '.debug.css', False)]
+        with mock.patch('sett.libsass.defaults.SASS_OUTPUTS', outputs):
+            with mock.patch('sett.libsass.defaults.SASS_JOBS', 2):
+                sass()
+
+        self.assertEqual(self.dest.joinpath('a.css').text().splitlines()[0], u'.a{color:#123456}')
+        self.assertIn(u'sourceMappingURL=a.css.map', self.dest.joinpath('a.css').text())
+        self.assertIn(u'"sources"', self.dest.joinpath('a.css.map').text())
+        self.assertIn(u'.a {\n  color: #123456;\n}', self.dest.joinpath('a.debug.css').text())
@@ -0,0 +1,521 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import json
+import atexit
+import tempfile
+import collections
+import unittest
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+try:
+    from django.db.utils import IntegrityError
+except ImportError:
+    IntegrityError = None
+
+from paver.easy import BuildFailure
+from paver.options import Bunch
+from paver.deps.six import text_type
+
+from sett.loaddata import (
+    iter_json_array,
+    SpillStore,
+    batches,
+    Inserter,
+    RelatedInserter,
+    LoadPlan,
+    StreamLoader,
+    _load,
+    strongly_connected_components,
+    FixtureWriter,
+    open_fixture,
+    fixture_format,
+    read_fixture,
+    lzma,
+    yaml,
+)
+from sett.utils import Tempdir
+
+
+class TestIterJSONArray(unittest.TestCase):
+    def iter(self, text, chunk_size=4):
+        return list(iter_json_array(io.StringIO(text), chunk_size=chunk_size))
+
+    def test_items(self):
+        items = [
+            {'model': 'app.model', 'pk': 1, 'fields': {'name': u'a, ]'}},
+            {'model': 'app.model', 'pk': 2, 'fields': {'name': u'b'}},
+        ]
+        text = u' [\n{"model": "app.model", "pk": 1, "fields": {"name": "a, ]"}},\n' \
+               u'{"model": "app.model", "pk": 2, "fields": {"name": "b"}}\n]\n'
+        self.assertEqual(self.iter(text), items)
+        self.assertEqual(self.iter(text, chunk_size=65536), items)
+
+    def test_numbers(self):
+        self.assertEqual(self.iter(u'[12345, 678]', chunk_size=3), [12345, 678])
+
+    def test_empty(self):
+        self.assertEqual(self.iter(u'[ ]'), [])
+
+    def test_not_array(self):
+        with self.assertRaises(ValueError):
+            self.iter(u'{"model": "app.model"}')
+
+    def test_unterminated(self):
+        with self.assertRaises(ValueError):
+            self.iter(u'[{"pk": 1}, {"pk": ')
+
+
+class TestSpillStore(unittest.TestCase):
+    def test_memory(self):
+        store = SpillStore()
+        store.append(1)
+        store.append(2)
+        self.assertEqual(len(store), 2)
+        self.assertEqual(list(store.drain()), [1, 2])
+        self.assertEqual(len(store), 0)
+
+    def test_spill(self):
+        store = SpillStore()
+        store.append({'pk': 1})
+        store.append({'pk': 2})
+        self.assertEqual(store.spill(), 2)
+        store.append({'pk': 3})
+
+        self.assertEqual(len(store), 3)
+        self.assertEqual(store.in_memory, 1)
+        self.assertEqual(list(store.drain()), [{'pk': 1}, {'pk': 2}, {'pk': 3}])
+        self.assertEqual(len(store), 0)
+
+        store.append({'pk': 4})
+        self.assertEqual(list(store.drain()), [{'pk': 4}])
+
+
+def test_batches():
+    assert list(batches(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(batches([], 2)) == []
+
+
+class FakeModel(object):
+    class _meta:
+        label = 'app.Model'
+
+    def __init__(self, pk, bad=False):
+        self.pk = pk
+        self.bad = bad
+
+    def __repr__(self):
+        return 'FakeModel({})'.format(self.pk)
+
+
+@unittest.skipIf(IntegrityError is None, 'Django is not installed')
+class TestInserter(unittest.TestCase):
+    def setUp(self):
+        mock.patch('django.db.transaction.atomic').start()
+        mock.patch('django.db.connection').start().features.can_defer_constraint_checks = False
+        self.model_class = mock.Mock(__name__='Model')
+        self.model_class.objects.bulk_create.side_effect = self.bulk_create
+        self.inserted = []
+
+    def tearDown(self):
+        mock.patch.stopall()
+
+    def bulk_create(self, models, **kw):
+        if any(model.bad for model in models):
+            raise IntegrityError('duplicate key {}'.format([m.pk for m in models if m.bad]))
+        self.inserted.extend(models)
+
+    def test_insert(self):
+        inserter = Inserter()
+        models = [FakeModel(i) for i in range(10)]
+        inserter(self.model_class, models)
+        self.assertEqual(self.inserted, models)
+        self.assertEqual(inserter.queries, 1)
+        self.assertFalse(inserter.rejected)
+
+    def test_bisect(self):
+        inserter = Inserter()
+        models = [FakeModel(i, bad=i in (3, 100)) for i in range(128)]
+        inserter(self.model_class, models)
+
+        self.assertEqual(self.inserted, [m for m in models if not m.bad])
+        self.assertEqual(inserter.rejected, {'app.Model': 2})
+        self.assertLess(inserter.queries, 2 * 2 * 7 + 1)
+
+    def test_report(self):
+        with Tempdir() as tempdir:
+            report = tempdir.joinpath('rejected.jsonl')
+            inserter = Inserter(report=report)
+
+            def serialize(format, models):
+                return json.dumps([{'model': 'app.model', 'pk': models[0].pk}])
+
+            with mock.patch('django.core.serializers.serialize', side_effect=serialize):
+                inserter(self.model_class, [FakeModel(1), FakeModel(2, bad=True)])
+            inserter.close()
+
+            self.assertEqual([json.loads(line) for line in report.lines()], [
+                {'model': 'app.model', 'pk': 2, 'error': 'duplicate key [2]'},
+            ])
+
+    def test_ignore_conflicts(self):
+        inserter = Inserter(ignore_conflicts=True)
+        models = [FakeModel(1), FakeModel(2)]
+        with mock.patch('django.db.connection') as connection:
+            connection.features.supports_ignore_conflicts = True
+            inserter(self.model_class, models)
+        self.model_class.objects.bulk_create.assert_called_once_with(models, ignore_conflicts=True)
+
+    def test_ignore_conflicts_not_supported(self):
+        inserter = Inserter(ignore_conflicts=True)
+        models = [FakeModel(1), FakeModel(2, bad=True)]
+        with mock.patch('django.db.connection') as connection:
+            connection.features.can_defer_constraint_checks = False
+            connection.features.supports_ignore_conflicts = False
+            inserter(self.model_class, models)
+        self.assertEqual(self.inserted, models[:1])
+        self.assertEqual(inserter.rejected, {'app.Model': 1})
+
+
+class FakeThrough(object):
+    class _meta:
+        auto_created = True
+
+        @staticmethod
+        def get_field(name):
+            return mock.Mock(attname=name + '_id')
+
+    def __init__(self, **kw):
+        self.kw = kw
+
+    def __eq__(self, other):
+        return self.kw == other.kw
+
+    def __repr__(self):
+        return 'FakeThrough({})'.format(self.kw)
+
+
+class TestRelatedInserter(unittest.TestCase):
+    def setUp(self):
+        self.inserter = mock.Mock()
+        self.model_class = mock.Mock(__name__='Book')
+        field = self.model_class._meta.get_field.return_value
+        field.remote_field.through = FakeThrough
+        field.m2m_field_name.return_value = 'book'
+        field.m2m_reverse_field_name.return_value = 'tag'
+        self.related = RelatedInserter(self.inserter, batch_size=3)
+
+    def test_add(self):
+        self.related.add(self.model_class, 1, 'tags', [1, 2, 1])
+        self.assertFalse(self.inserter.called)
+        self.related.add(self.model_class, 2, 'tags', [3])
+        self.inserter.assert_called_once_with(FakeThrough, [
+            FakeThrough(book_id=1, tag_id=1),
+            FakeThrough(book_id=1, tag_id=2),
+            FakeThrough(book_id=2, tag_id=3),
+        ])
+
+        self.inserter.reset_mock()
+        self.related.add(self.model_class, 3, 'tags', [1])
+        self.related.flush()
+        self.inserter.assert_called_once_with(FakeThrough, [FakeThrough(book_id=3, tag_id=1)])
+        self.model_class._meta.get_field.assert_called_once_with('tags')
+
+    def test_custom_through(self):
+        through = self.model_class._meta.get_field.return_value.remote_field.through = mock.Mock()
+        through._meta.auto_created = False
+        self.related.add(self.model_class, 1, 'tags', [1, 2])
+        self.model_class.return_value.tags.add.assert_called_once_with(1, 2)
+        self.model_class.assert_called_once_with(pk=1)
+        self.related.flush()
+        self.assertFalse(self.inserter.called)
+
+
+def test_strongly_connected_components():
+    graph = collections.OrderedDict([
+        ('a', ['b']),
+        ('b', ['c', 'd']),
+        ('c', ['b']),
+        ('d', []),
+        ('e', ['e']),
+    ])
+    assert [sorted(c) for c in strongly_connected_components(graph)] == [['d'], ['b', 'c'], ['a'], ['e']]
+
+
+def test_strongly_connected_components_long_chain():
+    graph = dict((i, [i + 1]) for i in range(5000))
+    graph[5000] = [0]
+    assert len(strongly_connected_components(graph)) == 1
+
+
+Field = collections.namedtuple('Field', ['name', 'attname', 'null'])
+
+
+def fake_model(label):
+    return type(str(label.replace('.', '_')), (object, ), {'_meta': mock.Mock(label=label)})
+
+
+class TestLoadPlan(unittest.TestCase):
+    def setUp(self):
+        self.author = fake_model('app.Author')
+        self.book = fake_model('app.Book')
+        self.tag = fake_model('app.Tag')
+        self.category = fake_model('app.Category')
+
+        self.best_book = Field('best_book', 'best_book_id', True)
+        self.parent = Field('parent', 'parent_id', True)
+        self.foreign_keys = {
+            self.tag: [],
+            self.author: [(self.best_book, self.book)],
+            self.book: [(Field('author', 'author_id', False), self.author), (Field('tag', 'tag_id', False), self.tag)],
+            self.category: [(self.parent, self.category)],
+        }
+
+    def test_plan(self):
+        plan = LoadPlan(self.foreign_keys)
+        self.assertEqual(plan.levels, [[self.author, self.category, self.tag], [self.book]])
+        self.assertEqual(plan.deferred, {self.author: [self.best_book], self.category: [self.parent]})
+        self.assertEqual(plan.cycles, [])
+        self.assertEqual(plan.missing, {})
+        plan.check()
+
+    def test_acyclic(self):
+        plan = LoadPlan({self.tag: [], self.book: [(Field('tag', 'tag_id', True), self.tag)]})
+        self.assertEqual(plan.levels, [[self.tag], [self.book]])
+        self.assertEqual(plan.deferred, {})
+
+    def test_cycle(self):
+        self.foreign_keys[self.author] = [(Field('best_book', 'best_book_id', False), self.book)]
+        plan = LoadPlan(self.foreign_keys)
+        self.assertEqual(plan.cycles, [[self.author, self.book]])
+        self.assertEqual(plan.levels, [[self.category, self.tag], [self.author, self.book]])
+        with self.assertRaises(RuntimeError):
+            plan.check()
+        plan.check(force=True)
+
+    def test_missing(self):
+        del self.foreign_keys[self.tag]
+        plan = LoadPlan(self.foreign_keys)
+        self.assertEqual(plan.missing, {self.book: [self.tag]})
+        with self.assertRaises(RuntimeError):
+            plan.check()
+
+    def test_describe(self):
+        plan = LoadPlan(self.foreign_keys)
+        self.assertEqual(plan.describe({self.author: 2, self.book: 3, self.category: 0, self.tag: 1}).splitlines(), [
+            'Level 1: app.Author (2), app.Category (0), app.Tag (1)',
+            'Level 2: app.Book (3)',
+            'Deferred: app.Author.best_book',
+            'Deferred: app.Category.parent',
+        ])
+
+    def test_defer_backfill(self):
+        plan = LoadPlan(self.foreign_keys)
+        root, child = mock.Mock(pk=1, parent_id=None), mock.Mock(pk=2, parent_id=1)
+        deferred = plan.defer(self.category, [root, child])
+        self.assertEqual(deferred, [(child, [('parent_id', 1)])])
+        self.assertIsNone(child.parent_id)
+
+        self.category._base_manager = manager = mock.Mock()
+        plan.backfill(self.category, deferred)
+        self.assertEqual(child.parent_id, 1)
+        manager.bulk_update.assert_called_once_with([child], ['parent'])
+
+
+def setup_django():
+    import django
+    from django.conf import settings
+    from django.core.management import call_command
+
+    if not settings.configured:
+        # A file, shared by the connections of the threads of --jobs
+        database = tempfile.NamedTemporaryFile(suffix='.sqlite3', delete=False)
+        database.close()
+        atexit.register(os.unlink, database.name)
+        settings.configure(
+            INSTALLED_APPS=['tests.loaddata_app'],
+            DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': database.name}},
+        )
+        django.setup()
+        call_command('migrate', run_syncdb=True, verbosity=0)
+
+
+@unittest.skipIf(IntegrityError is None, 'Django is not installed')
+class TestStreamLoader(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        setup_django()
+
+    def setUp(self):
+        from django.db import transaction
+        self.atomic = transaction.atomic()
+        self.atomic.__enter__()
+
+    def tearDown(self):
+        from django.db import transaction
+        transaction.set_rollback(True)
+        self.atomic.__exit__(None, None, None)
+
+    def load(self, objects, **kw):
+        loader = StreamLoader(batch_size=1, **kw)
+        loader.load(objects)
+        loader.finish()
+        return loader
+
+    def test_self_reference(self):
+        from tests.loaddata_app.models import Category
+
+        self.load([
+            {'model': 'loaddata_app.category', 'pk': 2, 'fields': {'name': u'child', 'parent': 1}},
+            {'model': 'loaddata_app.category', 'pk': 1, 'fields': {'name': u'root', 'parent': None}},
+        ])
+        self.assertEqual(list(Category.objects.order_by('pk').values_list('pk', 'parent')), [(1, None), (2, 1)])
+
+    def test_nullable_cycle(self):
+        from tests.loaddata_app.models import Author, Book
+
+        self.load([
+            {'model': 'loaddata_app.author', 'pk': 1, 'fields': {'name': u'A', 'best_book': 2}},
+            {'model': 'loaddata_app.book', 'pk': 1, 'fields': {'title': u'B1', 'author': 1}},
+            {'model': 'loaddata_app.book', 'pk': 2, 'fields': {'title': u'B2', 'author': 1}},
+        ])
+        self.assertEqual(list(Author.objects.values_list('pk', 'best_book')), [(1, 2)])
+        self.assertEqual(list(Book.objects.order_by('pk').values_list('pk', 'author')), [(1, 1), (2, 1)])
+
+
+@unittest.skipIf(IntegrityError is None, 'Django is not installed')
+class TestInserterDatabase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        setup_django()
+
+    def setUp(self):
+        from django.db import transaction
+        self.atomic = transaction.atomic()
+        self.atomic.__enter__()
+
+    def tearDown(self):
+        from django.db import transaction
+        transaction.set_rollback(True)
+        self.atomic.__exit__(None, None, None)
+
+    def test_dangling_foreign_key(self):
+        from django.db import connection
+        from tests.loaddata_app.models import Author, Book
+
+        author = Author.objects.create(pk=1, name=u'A')
+        inserter = Inserter()
+        inserter(Book, [Book(pk=1, title=u'B1', author=author), Book(pk=2, title=u'B2', author_id=999)])
+
+        self.assertEqual(inserter.rejected, {'loaddata_app.Book': 1})
+        self.assertEqual(list(Book.objects.values_list('pk', flat=True)), [1])
+        connection.check_constraints()
+
+
+@unittest.skipIf(IntegrityError is None, 'Django is not installed')
+class TestLoadJobs(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        setup_django()
+
+    def setUp(self):
+        self.tempdir = Tempdir().open()
+        self.fixture = self.tempdir.joinpath('fixture.json')
+        self.fixture.write_text(text_type(json.dumps([
+            {'model': 'loaddata_app.series', 'pk': 1, 'fields': {'name': 'S', 'publisher': 1}},
+            {'model': 'loaddata_app.magazine', 'pk': 1, 'fields': {'name': 'M', 'publisher': 1}},
+            {'model': 'loaddata_app.magazine', 'pk': 2, 'fields': {'name': 'N', 'publisher': 2}},
+            {'model': 'loaddata_app.publisher', 'pk': 1, 'fields': {'name': 'P1'}},
+            {'model': 'loaddata_app.publisher', 'pk': 2, 'fields': {'name': 'P2'}},
+        ])))
+
+    def tearDown(self):
+        from tests.loaddata_app.models import Publisher
+        Publisher.objects.all().delete()
+        self.tempdir.rmtree()
+
+    def test_jobs(self):
+        from django.db import connection
+        from tests.loaddata_app.models import Publisher, Series, Magazine
+
+        options = Bunch(jobs=2, force=False, batch_size=1000)
+        inserter = Inserter()
+        plan = LoadPlan.from_models([Publisher, Series, Magazine])
+        self.assertEqual(plan.levels, [[Publisher], [Magazine, Series]])
+
+        with mock.patch('sett.loaddata.info') as info:
+            _load(self.fixture, options, inserter)
+        info.assert_called_with('Checked %s models', 3)
+
+        self.assertFalse(connection.in_atomic_block)
+        self.assertEqual(Publisher.objects.count(), 2)
+        self.assertEqual(list(Magazine.objects.order_by('pk').values_list('publisher', flat=True)), [1, 2])
+        self.assertEqual(Series.objects.get().publisher_id, 1)
+
+    def test_jobs_in_transaction(self):
+        from django.db import transaction
+
+        with transaction.atomic():
+            with self.assertRaises(BuildFailure):
+                _load(self.fixture, Bunch(jobs=2, force=False, batch_size=1000), Inserter())
+
+
+class TestFixtureFormats(unittest.TestCase):
+    OBJECTS = [
+        {'model': 'app.model', 'pk': 1, 'fields': {'name': u'\xe9t\xe9', 'tags': [1, 2]}},
+        {'model': 'app.model', 'pk': 2, 'fields': {'name': u'b', 'tags': []}},
+    ]
+
+    def setUp(self):
+        self.tempdir = Tempdir().__enter__()
+
+    def tearDown(self):
+        self.tempdir.rmtree()
+
+    def round_trip(self, name):
+        filepath = self.tempdir.joinpath(name)
+        with FixtureWriter(filepath) as writer:
+            writer.write(self.OBJECTS[:1])
+            writer.write([])
+            writer.write(self.OBJECTS[1:])
+        return self.read(filepath)
+
+    def read(self, filepath):
+        with open_fixture(filepath) as handle:
+            return list(read_fixture(handle, fixture_format(filepath, handle)))
+
+    def test_pickle(self):
+        for name in ['dump.pickle', 'dump.pickle.gz', 'dump.pickle.bz2']:
+            self.assertEqual(self.round_trip(name), self.OBJECTS, name)
+
+    @unittest.skipUnless(lzma, 'lzma is not available')
+    def test_xz(self):
+        self.assertEqual(self.round_trip('dump.pickle.xz'), self.OBJECTS)
+
+    @unittest.skipIf(IntegrityError is None, 'Django is not installed')
+    def test_json(self):
+        for name in ['dump.json', 'dump.json.gz', 'dump.jsonl', 'dump.jsonl.bz2']:
+            self.assertEqual(self.round_trip(name), self.OBJECTS, name)
+
+    @unittest.skipIf(IntegrityError is None or not yaml, 'Django or PyYAML is not installed')
+    def test_yaml(self):
+        for name in ['dump.yaml', 'dump.yml.gz']:
+            self.assertEqual(self.round_trip(name), self.OBJECTS, name)
+
+    def test_detect_format(self):
+        filepath = self.tempdir.joinpath('dump.pickle.gz')
+        with FixtureWriter(filepath) as writer:
+            writer.write(self.OBJECTS)
+        filepath.rename(self.tempdir.joinpath('dump'))
+        self.assertEqual(self.read(self.tempdir.joinpath('dump')), self.OBJECTS)
+
+        self.tempdir.joinpath('fixture').write_text(u' [{"model": "app.model", "pk": 1, "fields": {}}]')
+        self.assertEqual(self.read(self.tempdir.joinpath('fixture')), [{'model': 'app.model', 'pk': 1, 'fields': {}}])
+
+    def test_unknown_extension(self):
+        with self.assertRaises(BuildFailure):
+            FixtureWriter(self.tempdir.joinpath('dump.xml'))
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import importlib
+import threading
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+from sett.parallel import (
+    parallel,
+    pool_size,
+    Linear,
+    Threaded,
+    Process,
+    Future,
+    Cancelled,
+)
+
+# sett.parallel is shadowed by the parallel function in sett
+parallel_module = importlib.import_module('sett.parallel')
+
+
+def square(x):
+    if x < 0:
+        raise ValueError('negative')
+    return x * x
+
+
+def lock(x):
+    return threading.Lock()
+
+
+class TestParallel(unittest.TestCase):
+    def test_default_backend(self):
+        with mock.patch.object(parallel_module, 'defaults') as defaults:
+            defaults.PARALLEL_BACKEND = 'threaded'
+            defaults.PARALLEL_JOBS = 4
+            self.assertIsInstance(parallel(square), Threaded)
+
+    def test_backend(self):
+        self.assertIsInstance(parallel(square, backend='process'), Process)
+
+    def test_linear(self):
+        with mock.patch.object(parallel_module, 'defaults') as defaults:
+            defaults.USE_THREADING = False
+            self.assertIsInstance(parallel(square, backend='process'), Linear)
+
+    def test_single_worker(self):
+        self.assertIsInstance(parallel(square, n=1), Linear)
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            parallel(square, backend='fibers')
+
+
+class TestPoolSize(unittest.TestCase):
+    def test_fixed(self):
+        self.assertEqual(pool_size(3), 3)
+        self.assertEqual(pool_size('3', jobs=1), 3)
+
+    def test_auto(self):
+        with mock.patch.object(parallel_module, 'cpu_count', return_value=8):
+            self.assertEqual(pool_size('auto'), 8)
+            self.assertEqual(pool_size('auto', jobs=3), 3)
+            self.assertEqual(pool_size('auto', jobs=0), 1)
+
+
+class TestFuture(unittest.TestCase):
+    def test_result(self):
+        f = Future()
+        assert f.set_running()
+        f.set_result(3)
+        assert f.done()
+        assert f.successful()
+        self.assertEqual(f.result(), 3)
+
+    def test_exception(self):
+        f = Future()
+        exc = ValueError()
+        f.set_exception(exc)
+        assert not f.successful()
+        assert f.exception() is exc
+        with self.assertRaises(ValueError):
+            f.result()
+
+    def test_not_done(self):
+        f = Future()
+        with self.assertRaises(RuntimeError):
+            f.result(timeout=0)
+
+    def test_cancel(self):
+        f = Future()
+        assert f.cancel()
+        assert not f.set_running()
+        with self.assertRaises(Cancelled):
+            f.result()
+
+    def test_cancel_running(self):
+        f = Future()
+        f.set_running()
+        assert not f.cancel()
+
+    def test_callback(self):
+        f = Future()
+        callback = mock.Mock()
+        f.add_done_callback(callback)
+        assert not callback.called
+        f.set_result(1)
+        callback.assert_called_once_with(f)
+
+        callback.reset_mock()
+        f.add_done_callback(callback)
+        callback.assert_called_once_with(f)
+
+
+class TestLinear(unittest.TestCase):
+    def test_call(self):
+        self.assertEqual(Linear(square)(3).result(), 9)
+
+    def test_map(self):
+        self.assertEqual(list(Linear(square).map([1, 2, 3])), [1, 4, 9])
+
+    def test_failure(self):
+        with self.assertRaises(ValueError):
+            list(Linear(square).map([1, -2, 3]))
+
+
+class TestProcess(unittest.TestCase):
+    def test_for_each(self):
+        p = Process(square, n=2)
+        assert p.for_each([1, 2, 3]) is None
+        self.assertEqual(p.status, Process.ENDED)
+        self.assertEqual(p.failed_tasks, [])
+
+    def test_failure(self):
+        p = Process(square, n='auto')
+        with self.assertRaises(RuntimeError):
+            p.for_each([1, -2, 3])
+
+        self.assertEqual(len(p.failed_tasks), 1)
+        failure, = p.failed_tasks
+        self.assertEqual(failure.args, (-2, ))
+        self.assertIsInstance(failure.e, ValueError)
+
+    def test_wait_not_started(self):
+        p = Process(square)
+        assert p.wait() is None
+
+    def test_call(self):
+        p = Process(square, n=2)
+        result = p(3)
+        p.wait()
+        self.assertEqual(result.result(), 9)
+
+    def test_map(self):
+        p = Process(square, n=2)
+        self.assertEqual(list(p.map([1, 2, 3, 4])), [1, 4, 9, 16])
+
+    def test_imap_unordered(self):
+        p = Process(square, n=2)
+        self.assertEqual(sorted(p.imap_unordered([1, 2, 3, 4])), [1, 4, 9, 16])
+
+    def test_unpicklable_result(self):
+        p = Process(lock, n=1)
+        with self.assertRaises(RuntimeError):
+            p.for_each([1, 2])
+        self.assertEqual(sorted(f.args for f in p.failed_tasks), [(1, ), (2, )])
+
+    def test_unpicklable_arguments(self):
+        p = Process(square, n=1)
+        with self.assertRaises(RuntimeError):
+            p.for_each([threading.Lock(), 2])
+        self.assertEqual(len(p.failed_tasks), 1)
+
+    def test_fail_fast(self):
+        p = Process(square, n=1, fail_fast=True)
+        futures = [p(x) for x in [-1, 2, 3]]
+        with self.assertRaises(RuntimeError):
+            p.wait()
+        self.assertEqual([f.cancelled() for f in futures], [False, True, True])
+        self.assertEqual(len(p.failed_tasks), 1)
+
+
+class TestThreaded(unittest.TestCase):
+    def test_failure(self):
+        t = Threaded(square, n='auto')
+        with self.assertRaises(RuntimeError):
+            t.for_each([1, -2, 3])
+        self.assertEqual([f.args for f in t.failed_tasks], [(-2, )])
+
+    def test_call(self):
+        t = Threaded(square, n=2)
+        results = [t(x) for x in [1, 2, 3]]
+        t.wait()
+        self.assertEqual([r.result() for r in results], [1, 4, 9])
+
+    def test_map(self):
+        t = Threaded(square, n=3)
+        self.assertEqual(list(t.map([1, 2, 3, 4])), [1, 4, 9, 16])
+
+    def test_imap_unordered(self):
+        t = Threaded(square, n=3)
+        self.assertEqual(sorted(t.imap_unordered([1, 2, 3, 4])), [1, 4, 9, 16])
+
+    def test_imap_unordered_failure(self):
+        t = Threaded(square, n=3)
+        results = []
+        with self.assertRaises(RuntimeError):
+            for result in t.imap_unordered([1, -2, 3]):
+                results.append(result)
+        self.assertEqual(sorted(results), [1, 9])
+
+    def test_fail_fast(self):
+        fn = mock.Mock(side_effect=[ValueError(), 2, 3])
+        t = Threaded(fn, n=1, fail_fast=True)
+        futures = [t(x) for x in [1, 2, 3]]
+        with self.assertRaises(RuntimeError):
+            t.wait()
+        fn.assert_called_once_with(1)
+        self.assertEqual([f.cancelled() for f in futures], [False, True, True])
@@ -4,11 +4,12 @@
 import subprocess
 from paver.path import path
 from sett import which, ROOT
+from sett.utils import Tempdir
 
 pavements = path(__file__).dirname().joinpath('pavements')
 
 
-def eval_paver(pavement, *args):
+def eval_paver(pavement, *args, **kw):
     pavement = pavements.joinpath(pavement)
     command = [which.paver, '-q', '-f', pavement]
     command.extend(args)
@@ -20,6 +21,7 @@ def eval_paver(pavement, *args):
         env={
             'LC_ALL': 'C',
             'PYTHONPATH': ROOT,
+            'SETT_CACHE_DIR': kw.get('cache_dir', '/dev/null'),
         }
     )
     out = process.stdout.read()
@@ -40,3 +42,13 @@ def test_1_t1():
 def test_init():
     evaluation = eval_paver('test_init.py', 't1', 't2')
     assert evaluation == '1\n2\n', repr(evaluation)
+
+
+def test_1_t_indexed():
+    with Tempdir() as cache_dir:
+        evaluation = eval_paver('test_1.py', 't', cache_dir=cache_dir)
+        assert cache_dir.joinpath('tasks.json').exists()
+        assert evaluation == 't1\n', repr(evaluation)
+
+        evaluation = eval_paver('test_1.py', 't', cache_dir=cache_dir)
+        assert evaluation == 't1\n', repr(evaluation)
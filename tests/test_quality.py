@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 
 
+import io
+import json
+import threading
 import unittest
+from xml.etree import ElementTree
 try:
     from unittest import mock
 except ImportError:
@@ -9,7 +13,20 @@ except ImportError:
 
 from paver.tasks import Environment, task
 from paver.options import Bunch
-from sett.quality import quality
+from sett.quality import (
+    quality,
+    QualityChecker,
+    QualityReport,
+    CodesSet,
+    Violation,
+    TextWriter,
+    JSONWriter,
+    CheckstyleWriter,
+    JUnitWriter,
+    module_name,
+    imported_modules,
+)
+from sett.utils.fs import Tempdir
 
 
 environment = Environment(__import__('tests.test_quality'))
@@ -22,26 +39,270 @@ def setup_options():
 
 @mock.patch('paver.tasks.environment', environment)
 class Test_quality(unittest.TestCase):
+    def setUp(self):
+        self.root = mock.patch('sett.quality.ROOT', Tempdir().__enter__()).start()
+        mock.patch.object(QualityChecker, 'discover', return_value=['tests/test_quality.py']).start()
+
+    def tearDown(self):
+        mock.patch.stopall()
+        self.root.rmtree()
+
     def test_quality_warning_code(self):
-        with mock.patch('sett.quality.sh') as sh:
-            sh.return_value = '''
+        with mock.patch.object(QualityChecker, 'call_flake8') as call_flake8:
+            call_flake8.return_value = io.StringIO(u'''
 test/test_quality.py:14:9: E121 this and that
 test/test_quality.py:14:9: W292 this and that
-'''
+''')
             try:
                 quality()
             except SystemExit:
                 raise AssertionError('should not have raised SystemExit')
 
     def test_quality_error_code(self):
-        with mock.patch('sett.quality.sh') as sh:
-            sh.return_value = '''
+        with mock.patch.object(QualityChecker, 'call_flake8') as call_flake8:
+            call_flake8.return_value = io.StringIO(u'''
 test/test_quality.py:14:9: E121 this and that
 test/test_quality.py:14:9: W504 this and that
-'''
+''')
             try:
                 quality()
             except SystemExit:
                 pass
             else:
                 raise AssertionError('should have raised SystemExit')
+
+
+class TestQualityChecker(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = Tempdir().__enter__()
+        self.a = self.tempdir.joinpath('pkg/a.py')
+        self.b = self.tempdir.joinpath('pkg/sub/b.py')
+        self.b.parent.makedirs()
+        self.a.write_text(u'import os\n')
+        self.b.write_text(u'x=1\n')
+        self.tempdir.joinpath('pkg/sub/data.txt').write_text(u'')
+        self.cache_file = self.tempdir.joinpath('flake8.json')
+        mock.patch('sett.quality.which', flake8='/usr/bin/flake8').start()
+
+    def tearDown(self):
+        mock.patch.stopall()
+        self.tempdir.rmtree()
+
+    def checker(self, **kw):
+        checker = QualityChecker(cache_file=self.cache_file, jobs=2, **kw)
+        checker.call_flake8 = mock.Mock(side_effect=self.flake8)
+        return checker
+
+    def flake8(self, files):
+        reports = {
+            self.a: "{}:1:1: F401 'os' imported but unused\n",
+            self.b: '{}:1:2: E225 missing whitespace around operator\n',
+        }
+        return [reports[filename].format(filename) for filename in files]
+
+    def lint(self, checker, files):
+        return ''.join(checker.lint(files))
+
+    def test_discover(self):
+        self.assertEqual(QualityChecker().discover([self.tempdir.joinpath('pkg'), self.tempdir.joinpath('pkg/a')]),
+                         [self.a, self.b, self.a])
+
+    def test_lint(self):
+        checker = self.checker()
+        report = self.lint(checker, [self.a, self.b])
+        self.assertEqual(report.splitlines(), [
+            "{}:1:1: F401 'os' imported but unused".format(self.a),
+            '{}:1:2: E225 missing whitespace around operator'.format(self.b),
+        ])
+        self.assertEqual(checker.call_flake8.call_count, 2)
+
+    def test_cache(self):
+        report = self.lint(self.checker(), [self.a, self.b])
+
+        checker = self.checker()
+        self.assertEqual(self.lint(checker, [self.a, self.b]), report)
+        self.assertFalse(checker.call_flake8.called)
+
+        self.b.write_text(u'x = 1\n')
+        checker = self.checker()
+        self.lint(checker, [self.a, self.b])
+        checker.call_flake8.assert_called_once_with([self.b])
+        self.assertEqual(checker.stats, {'hits': 1, 'misses': 1})
+
+        checker = self.checker(force=True)
+        self.lint(checker, [self.a, self.b])
+        self.assertEqual(checker.stats, {'hits': 0, 'misses': 2})
+
+    def test_stream(self):
+        self.lint(self.checker(), [self.a])
+        checker = self.checker()
+        first_line = threading.Event()
+        waited = []
+
+        def flake8(files):
+            waited.append(first_line.wait(5))
+            return self.flake8(files)
+
+        checker.call_flake8.side_effect = flake8
+        lines = checker.lint([self.a, self.b])
+        self.assertIn('F401', next(lines))
+        first_line.set()
+        self.assertIn('E225', next(lines))
+        self.assertEqual(waited, [True])
+
+    def test_other_lines(self):
+        checker = self.checker()
+        checker.call_flake8.side_effect = lambda files: ['flake8 crashed\n']
+        self.assertEqual(self.lint(checker, [self.a]), 'flake8 crashed\n')
+
+        checker = self.checker()
+        self.lint(checker, [self.a])
+        self.assertTrue(checker.call_flake8.called)
+
+    def test_call(self):
+        checker = QualityChecker(['E2'], ['F8'], cache_file=self.cache_file)
+        checker.call_flake8 = mock.Mock(side_effect=self.flake8)
+        writer = mock.Mock()
+        with mock.patch('sett.quality.options', setup={'packages': [self.tempdir.joinpath('pkg')]}):
+            report = checker([writer])
+
+        self.assertEqual(writer.write.call_args_list, [
+            mock.call(Violation(self.a, 1, 1, 'F401', "'os' imported but unused"), 'failure'),
+            mock.call(Violation(self.b, 1, 2, 'E225', 'missing whitespace around operator'), 'warning'),
+        ])
+        self.assertEqual(report.counts, {'failure': 1, 'warning': 1})
+        self.assertEqual(report.level, 2)
+
+
+class TestChanged(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = Tempdir().__enter__()
+        self.tempdir.joinpath('pkg/sub').makedirs()
+        self.files = {
+            'pkg/__init__.py': u'from .sub import helpers\n',
+            'pkg/models.py': u'import os\n',
+            'pkg/views.py': u'from pkg.models import Model\n',
+            'pkg/sub/__init__.py': u'',
+            'pkg/sub/helpers.py': u'from ..models import Model\nfrom . import other\n',
+            'pkg/broken.py': u'def (\n',
+        }
+        for filename, content in self.files.items():
+            self.tempdir.joinpath(filename).write_text(content)
+
+        self.changed_files = mock.patch('sett.quality.changed_files').start()
+        mock.patch('sett.quality.info').start()
+
+    def tearDown(self):
+        mock.patch.stopall()
+        self.tempdir.rmtree()
+
+    def test_module_name(self):
+        self.assertEqual(module_name('pkg/sub/helpers.py'), 'pkg.sub.helpers')
+        self.assertEqual(module_name('./pkg/sub/__init__.py'), 'pkg.sub')
+
+    def test_imported_modules(self):
+        with self.tempdir:
+            self.assertEqual(imported_modules('pkg/sub/helpers.py'), {
+                'pkg.models', 'pkg.models.Model', 'pkg.sub', 'pkg.sub.other'})
+            self.assertEqual(imported_modules('pkg/__init__.py'), {'pkg.sub', 'pkg.sub.helpers'})
+            self.assertEqual(imported_modules('pkg/broken.py'), set())
+
+    def test_changed(self):
+        files = sorted(self.files)
+        self.changed_files.return_value = ['pkg/models.py', 'setup.py']
+        with self.tempdir:
+            self.assertEqual(QualityChecker().changed(files, 'HEAD~1'), ['pkg/models.py'])
+            self.assertEqual(QualityChecker().changed(files, 'HEAD~1', importers=True),
+                             ['pkg/models.py', 'pkg/sub/helpers.py', 'pkg/views.py'])
+        self.changed_files.assert_called_with('HEAD~1', ['*.py'])
+
+
+class TestCodesSet(unittest.TestCase):
+    def test_contains(self):
+        codes = CodesSet(['E1', 'E12', 'W503', 'F', ''])
+        self.assertIn('E101', codes)
+        self.assertIn('E12', codes)
+        self.assertIn('F821', codes)
+        self.assertIn('W503', codes)
+        self.assertNotIn('W504', codes)
+        self.assertNotIn('E2', codes)
+        self.assertNotIn('', codes)
+
+    def test_empty(self):
+        self.assertNotIn('E101', CodesSet([]))
+
+
+class TestViolation(unittest.TestCase):
+    def test_parse(self):
+        line = "sett/a.py:12:5: F401 'os' imported but unused\n"
+        violation = Violation.parse(line)
+        self.assertEqual(violation, Violation('sett/a.py', 12, 5, 'F401', "'os' imported but unused"))
+        self.assertEqual(str(violation), line.strip())
+
+    def test_parse_other(self):
+        self.assertEqual(Violation.parse('Traceback (most recent call last):\n'),
+                         Violation(None, None, None, 'Traceback', 'Traceback (most recent call last):'))
+
+
+class TestWriters(unittest.TestCase):
+    VIOLATIONS = [
+        (Violation('a.py', 1, 1, 'F401', "'os' imported & unused"), 'failure'),
+        (Violation('a.py', 3, 80, 'E501', 'line too long (130 > 120 characters)'), 'warning'),
+        (Violation('b.py', 2, 1, 'E999', 'SyntaxError: <invalid>'), 'error'),
+    ]
+
+    def write(self, writer_class, violations):
+        outfile = io.StringIO() if str is not bytes else io.BytesIO()
+        writer = writer_class(outfile)
+        for violation, level in violations:
+            writer.write(violation, level)
+        writer.close()
+        return outfile.getvalue()
+
+    def test_text(self):
+        self.assertEqual(self.write(TextWriter, self.VIOLATIONS).splitlines(), [
+            "a.py:1:1: F401 'os' imported & unused",
+            'a.py:3:80: E501 line too long (130 > 120 characters)',
+            'b.py:2:1: E999 SyntaxError: <invalid>',
+        ])
+
+    def test_json(self):
+        data = json.loads(self.write(JSONWriter, self.VIOLATIONS))
+        self.assertEqual(data[0], {
+            'filename': 'a.py', 'line': 1, 'column': 1, 'code': 'F401',
+            'message': "'os' imported & unused", 'level': 'failure',
+        })
+        self.assertEqual(len(data), 3)
+        self.assertEqual(json.loads(self.write(JSONWriter, [])), [])
+
+    def test_checkstyle(self):
+        root = ElementTree.fromstring(self.write(CheckstyleWriter, self.VIOLATIONS))
+        self.assertEqual([f.get('name') for f in root.findall('file')], ['a.py', 'b.py'])
+        self.assertEqual([(e.get('line'), e.get('severity'), e.get('source'), e.get('message'))
+                          for e in root.findall('file/error')], [
+            ('1', 'error', 'flake8.F401', "'os' imported & unused"),
+            ('3', 'warning', 'flake8.E501', 'line too long (130 > 120 characters)'),
+            ('2', 'error', 'flake8.E999', 'SyntaxError: <invalid>'),
+        ])
+
+    def test_junit(self):
+        root = ElementTree.fromstring(self.write(JUnitWriter, self.VIOLATIONS))
+        self.assertEqual([t.get('name') for t in root.findall('testcase')], ['a.py', 'b.py'])
+        self.assertEqual(root.find('testcase/failure').get('message'), '2 violations')
+        self.assertIn("'os' imported & unused", root.find('testcase/failure').text)
+
+        root = ElementTree.fromstring(self.write(JUnitWriter, []))
+        self.assertEqual(len(root.findall('testcase')), 1)
+        self.assertIsNone(root.find('testcase/failure'))
+
+
+class TestQualityReport(unittest.TestCase):
+    def test_levels(self):
+        report = QualityReport()
+        self.assertFalse(report)
+        self.assertEqual(report.level, 0)
+        report.add('warning')
+        self.assertEqual(report.level, 1)
+        report.add('error')
+        self.assertTrue(report.has_failures)
+        self.assertEqual(report.level, 3)
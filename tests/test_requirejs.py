@@ -2,6 +2,7 @@
 
 import os
 import io
+import json
 import unittest
 
 try:
@@ -11,11 +12,22 @@ except ImportError:
 
 from sett.requirejs import (
     RJSBuilder,
+    SharedRJSBuilder,
     RJSBuild,
+    SlimRJSBuild,
+    CommonRJSBuild,
     FilesListComparator,
+    ContentHashComparator,
     AlmondRJSBuild,
+    RJSWorkerPool,
+    VirtualStatic,
+    PooledRJSBuild,
+    Uglify,
 )
+from paver.easy import BuildFailure
+from sett.utils import Tempdir
 from paver.path import path
+from paver.deps.six import text_type
 
 
 FS = path(__file__).dirname().joinpath('requirejs')
@@ -53,6 +65,90 @@ class TestRJSBuilder(unittest.TestCase):
         self.parallel.for_each.assert_called_once_with([BC.return_value])
 
 
+class TestSharedRJSBuilder(unittest.TestCase):
+    DEPS = {
+        'app/a': ['lib/jquery', 'lib/util', 'views/a', 'app/a'],
+        'app/b': ['lib/jquery', 'lib/util', 'views/b', 'app/b'],
+        'app/c': ['lib/jquery', 'views/c', 'app/c'],
+    }
+
+    def setUp(self):
+        self.outdir = Tempdir().open()
+        self.builds = []
+        self.BuildClass = mock.Mock(side_effect=self.build_class(), name='build_class')
+
+    def tearDown(self):
+        self.outdir.rmtree()
+
+    def build_class(self, Parent=RJSBuild):
+        def build(rjs_build):
+            self.builds.append(rjs_build)
+            exclude = rjs_build.params.get('exclude', '').split(',')
+            if 'include' in rjs_build.params:
+                modules = rjs_build.params['include'].split(',')
+            else:
+                modules = self.DEPS[rjs_build.name]
+            files = [rjs_build.source.joinpath(m + '.js') for m in modules if m not in exclude]
+            return files + [rjs_build.source.joinpath('text!tpl.html'), rjs_build.config_js]
+
+        def factory(*args):
+            rjs_build = Parent(*args)
+            rjs_build.should_build = lambda: True
+            rjs_build.build = lambda: build(rjs_build)
+            return rjs_build
+        return factory
+
+    def builder(self, **params):
+        builder = SharedRJSBuilder(self.outdir, build_class=self.BuildClass, params=params)
+        builder.common_class = mock.Mock(side_effect=self.build_class(CommonRJSBuild))
+        builder.app_class = mock.Mock(side_effect=self.build_class(SlimRJSBuild))
+        return builder
+
+    def test_get_modules(self):
+        rjs_build = RJSBuild('app/a', '/src', '/out/a.js', {}, mock.Mock())
+        self.assertEqual(self.builder().get_modules(rjs_build, [
+            '/src/app/a.js',
+            '/src/views/a.js',
+            '/src/text!tpl.html',
+            '/src/config.js',
+            '/node_modules/almond/almond.js',
+        ]), {'app/a', 'views/a'})
+
+    def test_first_build(self):
+        self.builder()('/src', ['app/a', 'app/b', 'app/c'])
+
+        analysed = [b.name for b in self.builds if not b.out.startswith(self.outdir)]
+        self.assertEqual(sorted(analysed), ['app/a', 'app/b', 'app/c'])
+
+        built = dict((b.name, b) for b in self.builds if b.out.startswith(self.outdir))
+        self.assertEqual(sorted(built), ['app/a', 'app/b', 'app/c', 'common'])
+        self.assertEqual(built['common'].params['include'], 'lib/jquery,lib/util')
+        self.assertEqual(built['app/c'].params['exclude'], 'lib/jquery,lib/util')
+
+        with open(self.outdir.joinpath('.shared.json')) as plan:
+            self.assertEqual(json.load(plan)['app/c'], ['app/c', 'lib/jquery', 'views/c'])
+
+    def test_planned_build(self):
+        self.builder()('/src', ['app/a', 'app/b', 'app/c'])
+        del self.builds[:]
+
+        self.builder()('/src', ['app/a', 'app/b', 'app/c'])
+        self.assertEqual(sorted(b.name for b in self.builds), ['app/a', 'app/b', 'app/c', 'common'])
+        self.assertEqual(self.BuildClass.call_count, 3)
+
+    def test_min_apps(self):
+        builder = self.builder(shared_min_apps='3', shared='views/a')
+        self.assertEqual(builder.get_shared(dict((k, set(v)) for k, v in self.DEPS.items())),
+                         ['lib/jquery', 'views/a'])
+
+    def test_nothing_shared(self):
+        self.builder(shared_min_apps='4')('/src', ['app/a', 'app/b'])
+
+        built = [b for b in self.builds if b.out.startswith(self.outdir)]
+        self.assertEqual(sorted(b.name for b in built), ['app/a', 'app/b'])
+        self.assertEqual(self.BuildClass.call_count, 4)
+
+
 class TestAlmondRJSBuild(unittest.TestCase):
     def test_almond_set(self):
         arjsb = AlmondRJSBuild('app/app', '/abc/def', '/ghi/out.js', {'abcd': 'efgh'}, mock.Mock())
@@ -76,6 +172,42 @@ class TestAlmondRJSBuild(unittest.TestCase):
             })
 
 
+class TestSharedBuilds(unittest.TestCase):
+    def test_slim(self):
+        rjsb = SlimRJSBuild('app/app', '/abc/def', '/ghi/out.js', {}, mock.Mock())
+        with mock.patch('sett.requirejs.which'):
+            command = rjsb.get_command(almond='almond', exclude='lib/jquery')
+        self.assertEqual(set(command[3:]), {
+            'name=app/app',
+            'insertRequire=app/app',
+            'exclude=lib/jquery',
+        })
+
+    def test_common(self):
+        rjsb = CommonRJSBuild('common', '/abc/def', '/ghi/common.js', {}, mock.Mock())
+        with mock.patch('sett.requirejs.which'):
+            command = rjsb.get_command(almond='almond', include='lib/jquery,lib/util')
+        self.assertEqual(set(command[3:]), {
+            'name=almond',
+            'include=lib/jquery,lib/util',
+        })
+
+    def test_common_not_wrapped(self):
+        rjsb = CommonRJSBuild('common', '/abc/def', '/ghi/common.js', {}, mock.Mock())
+        with mock.patch('sett.requirejs.which'):
+            command = rjsb.get_command(**{
+                'almond': 'almond',
+                'include': 'lib/jquery',
+                'wrap': 'true',
+                'wrap.startFile': 'start.frag',
+            })
+        self.assertNotIn('wrap=true', command)
+        self.assertEqual(set(command[3:]), {
+            'name=almond',
+            'include=lib/jquery',
+        })
+
+
 class TestRJSBuild(unittest.TestCase):
     def setUp(self):
         self.cache = mock.Mock(spec=FilesListComparator)
@@ -139,6 +271,73 @@ class TestRJSBuild(unittest.TestCase):
         process.wait.assert_called_once_with()
 
 
+class TestPooledRJSBuild(unittest.TestCase):
+    def setUp(self):
+        self.cache = mock.Mock(spec=FilesListComparator)
+        self.rjsb = PooledRJSBuild('app/app', '/abc/def', '/ghi/out.js',
+                                   {'abcd': 'efgh'}, self.cache)
+
+    def test_build(self):
+        pool = mock.Mock(spec=RJSWorkerPool)
+        pool.build.return_value = u'Tracing dependencies\n--------------\n/abc/views/view.js\n/abc/app/app.js\n'
+
+        with mock.patch.object(self.rjsb, 'get_pool', return_value=pool):
+            with mock.patch.object(self.rjsb, 'get_command') as get_command:
+                get_command.return_value = ['node', 'r.js', '-o', 'name=app/app', 'out=/ghi/out.js']
+                self.rjsb.build()
+
+        pool.build.assert_called_once_with(['name=app/app', 'out=/ghi/out.js'])
+        self.cache.write.assert_called_once_with([
+            '/abc/views/view.js',
+            '/abc/app/app.js',
+            '/abc/def/config.js',
+        ])
+
+
+class TestRJSWorkerPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = RJSWorkerPool()
+        self.worker = mock.Mock(name='worker')
+        self.spawn = mock.patch.object(self.pool, 'spawn', return_value=self.worker).start()
+
+    def tearDown(self):
+        mock.patch.stopall()
+
+    def respond(self, **response):
+        response.setdefault('id', 0)
+        self.worker.stdout.readline.return_value = json.dumps(response).encode('utf-8') + b'\n'
+
+    def test_build(self):
+        self.respond(ok=True, output='output')
+        self.assertEqual(self.pool.build(['name=app']), 'output')
+        self.worker.stdin.write.assert_called_once_with(b'{"args": ["name=app"], "id": 0}\n')
+
+    def test_reuse(self):
+        self.respond(ok=True, output='output')
+        self.pool.build(['name=app'])
+        self.pool.build(['name=app2'])
+        self.assertEqual(self.spawn.call_count, 1)
+
+    def test_error(self):
+        self.respond(ok=False, error='Error: boom')
+        with self.assertRaises(RuntimeError):
+            self.pool.build(['name=app'])
+
+        self.respond(ok=True, output='output')
+        self.pool.build(['name=app'])
+        self.assertEqual(self.spawn.call_count, 1)
+
+    def test_worker_exited(self):
+        self.worker.stdout.readline.return_value = b''
+        with self.assertRaises(RuntimeError):
+            self.pool.build(['name=app'])
+        self.worker.stdin.close.assert_called_once_with()
+
+        self.respond(ok=True, output='output')
+        self.pool.build(['name=app'])
+        self.assertEqual(self.spawn.call_count, 2)
+
+
 class TestFilesListComparator(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -199,3 +398,217 @@ class TestFilesListComparator(unittest.TestCase):
             self.flc.write(['/abc/views/view.js', '/abc/app/app.js'])
         open.assert_called_once_with(self.cache_file, 'w')
         self.assertEqual(buffer.getvalue(), '/abc/views/view.js\n/abc/app/app.js\n')
+
+
+class TestContentHashComparator(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = Tempdir()
+        self.root = self.tempdir.open()
+        self.patch_root = mock.patch('sett.requirejs.ROOT', self.root)
+        self.patch_root.start()
+
+        self.root.joinpath('src').makedirs()
+        self.app = self.root.joinpath('src/app.js')
+        self.app.write_text(u'define("app", [], 1);')
+        self.config = self.root.joinpath('src/config.js')
+        self.config.write_text(u'requirejs.config({});')
+
+        self.out = self.root.joinpath('build/app.js')
+        self.chc = self.comparator()
+
+    def tearDown(self):
+        self.patch_root.stop()
+        self.tempdir.close()
+
+    def comparator(self, params=None):
+        return ContentHashComparator(self.out, 'app', params or {'optimize': 'none'},
+                                     cache_dir=self.root.joinpath('cache'))
+
+    def build(self, content):
+        self.out.dirname().makedirs_p()
+        self.out.write_text(content)
+        path(self.out + '.map').write_text(content + u' map')
+        self.comparator().write([self.app, 'text!template.html', self.config])
+
+    def test_no_manifest(self):
+        assert self.chc.is_up_to_date() is True
+        assert self.chc.restore() is False
+
+    def test_up_to_date(self):
+        self.build(u'v1')
+        assert self.chc.is_up_to_date() is False
+
+    def test_files_list(self):
+        self.build(u'v1')
+        files = self.chc.cache_file.lines(retain=False)
+        self.assertEqual([files[0], files[-1]], [self.app.realpath(), self.config.realpath()])
+
+    def test_changed(self):
+        self.build(u'v1')
+        self.app.write_text(u'define("app", [], 2);')
+        assert self.chc.is_up_to_date() is True
+        assert self.chc.restore() is False
+
+    def test_params_changed(self):
+        self.build(u'v1')
+        chc = self.comparator({'optimize': 'uglify2'})
+        assert chc.is_up_to_date() is True
+
+    def test_missing_dependency(self):
+        self.build(u'v1')
+        self.config.remove()
+        assert self.chc.is_up_to_date() is True
+        assert self.chc.restore() is False
+
+    def test_restore(self):
+        self.build(u'v1')
+        self.app.write_text(u'define("app", [], 2);')
+        self.build(u'v2')
+        self.app.write_text(u'define("app", [], 1);')
+
+        assert self.chc.is_up_to_date() is True
+        assert self.chc.restore() is True
+        self.assertEqual(self.out.text(), u'v1')
+        self.assertEqual(path(self.out + '.map').text(), u'v1 map')
+        assert self.comparator().is_up_to_date() is False
+
+    def test_restore_output_modified(self):
+        self.build(u'v1')
+        self.out.write_text(u'modified')
+        assert self.chc.is_up_to_date() is True
+        assert self.chc.restore() is True
+        self.assertEqual(self.out.text(), u'v1')
+
+
+class TestVirtualStatic(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = Tempdir().open()
+        self.root = self.tempdir.joinpath('static')
+        self.sources = self.tempdir.joinpath('sources')
+        self.sources.joinpath('js/app').makedirs()
+        for name in ['js/config.js', 'js/app/app.js', 'js/app/other.js']:
+            self.sources.joinpath(name).write_text(u'')
+
+    def tearDown(self):
+        self.tempdir.rmtree()
+
+    def files(self, *names):
+        return dict((name, text_type(self.sources.joinpath(name))) for name in names)
+
+    def test_sync(self):
+        vs = VirtualStatic(self.root)
+        self.assertEqual(vs.sync(self.files('js/config.js', 'js/app/app.js')), (2, 0))
+        self.assertEqual(self.root.joinpath('js/app/app.js').readlink(), self.sources.joinpath('js/app/app.js'))
+        self.assertEqual(VirtualStatic(self.root).read_manifest(), self.files('js/config.js', 'js/app/app.js'))
+
+    def test_sync_incremental(self):
+        VirtualStatic(self.root).sync(self.files('js/config.js', 'js/app/app.js'))
+        with mock.patch('os.symlink', wraps=os.symlink) as symlink:
+            self.assertEqual(VirtualStatic(self.root).sync(self.files('js/config.js', 'js/app/other.js')), (1, 1))
+        symlink.assert_called_once_with(self.sources.joinpath('js/app/other.js'), self.root.joinpath('js/app/other.js'))
+        self.assertFalse(os.path.lexists(self.root.joinpath('js/app/app.js')))
+
+    def test_sync_changed_source(self):
+        VirtualStatic(self.root).sync(self.files('js/config.js'))
+        changed = {'js/config.js': self.sources.joinpath('js/app/app.js')}
+        self.assertEqual(VirtualStatic(self.root).sync(changed), (1, 0))
+        self.assertEqual(self.root.joinpath('js/config.js').readlink(), self.sources.joinpath('js/app/app.js'))
+
+    def test_sync_removes_directories(self):
+        VirtualStatic(self.root).sync(self.files('js/config.js', 'js/app/app.js'))
+        VirtualStatic(self.root).sync(self.files('js/config.js'))
+        self.assertFalse(self.root.joinpath('js/app').exists())
+        self.assertTrue(self.root.joinpath('js').isdir())
+
+
+class TestUglify(unittest.TestCase):
+    def setUp(self):
+        self.root = Tempdir().__enter__()
+        self.src = self.root.joinpath('scripts/js')
+        self.src.joinpath('lib').makedirs()
+        for name in ['main', 'admin', 'lib/utils']:
+            self.src.joinpath(name + '.js').write_text(u'var {} = 1;'.format(name.replace('/', '_')))
+
+        mock.patch('sett.requirejs.which').start()
+        self.sh = mock.patch('sett.requirejs.sh', side_effect=self.fake_sh).start()
+        self.uglify = Uglify(self.src, self.root.joinpath('static/js'), ['--compress'],
+                             cache_file=self.root.joinpath('cache/uglify.json'), jobs=2)
+
+    def tearDown(self):
+        mock.patch.stopall()
+        self.root.rmtree()
+
+    def fake_sh(self, command, capture=False):
+        input, output = command[2], command[4]
+        path(output).write_bytes(path(input).bytes().upper())
+
+    def uglified(self):
+        return sorted(call[0][0][2] for call in self.sh.call_args_list)
+
+    def test_discover(self):
+        self.assertEqual(self.uglify.discover(), ['admin', 'lib/utils', 'main'])
+        self.assertEqual(self.uglify.discover(['lib/*', 'main', 'l*']), ['lib/utils', 'main'])
+
+    def test_discover_no_match(self):
+        with self.assertRaises(BuildFailure):
+            self.uglify.discover(['missing'])
+
+    def test_uglify(self):
+        self.uglify(['main', 'lib/utils'])
+        self.assertEqual(self.uglified(), [self.src.joinpath('lib/utils.js'), self.src.joinpath('main.js')])
+        self.assertEqual(self.root.joinpath('static/js/lib/utils.js').text(), u'VAR LIB_UTILS = 1;')
+        self.sh.assert_any_call([
+            mock.ANY, mock.ANY,
+            self.src.joinpath('main.js'), '-o', self.root.joinpath('static/js/main.js'),
+            '--source-map', self.root.joinpath('static/js/main.js.map'),
+            '--source-map-url', 'main.js.map',
+            '--compress',
+        ], capture=True)
+
+    def test_skip_unchanged(self):
+        self.uglify(['main', 'admin'])
+        self.sh.reset_mock()
+
+        self.src.joinpath('main.js').write_text(u'var main = 2;')
+        self.root.joinpath('static/js/admin.js').write_text(u'modified')
+        Uglify(self.src, self.root.joinpath('static/js'), ['--compress'],
+               cache_file=self.root.joinpath('cache/uglify.json'), jobs=2)(['main', 'admin', 'lib/utils'])
+        self.assertEqual(self.uglified(), [
+            self.src.joinpath('admin.js'),
+            self.src.joinpath('lib/utils.js'),
+            self.src.joinpath('main.js'),
+        ])
+
+        self.sh.reset_mock()
+        self.uglify(['main', 'admin', 'lib/utils'])
+        self.assertEqual(self.uglified(), [])
+        self.assertEqual(self.uglify.stats['hits'], 3)
+
+    def test_options_changed(self):
+        self.uglify(['main'])
+        self.sh.reset_mock()
+        Uglify(self.src, self.root.joinpath('static/js'), ['--mangle'],
+               cache_file=self.root.joinpath('cache/uglify.json'))(['main'])
+        self.assertEqual(self.uglified(), [self.src.joinpath('main.js')])
+
+    def test_force(self):
+        self.uglify(['main'])
+        self.sh.reset_mock()
+        self.uglify.force = True
+        self.uglify(['main'])
+        self.assertEqual(self.uglified(), [self.src.joinpath('main.js')])
+
+    def test_failure(self):
+        def fake_sh(command, capture=False):
+            if command[2].endswith('admin.js'):
+                raise BuildFailure('Subprocess return code: 1')
+            self.fake_sh(command)
+
+        self.sh.side_effect = fake_sh
+        with self.assertRaises(RuntimeError):
+            self.uglify(['main', 'admin'])
+
+        self.sh.reset_mock()
+        self.sh.side_effect = self.fake_sh
+        self.uglify(['main', 'admin'])
+        self.assertEqual(self.uglified(), [self.src.joinpath('admin.js')])
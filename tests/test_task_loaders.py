@@ -6,10 +6,12 @@ try:
 except ImportError:
     import mock
 
-from paver.tasks import Environment
+from paver.tasks import Environment, Task
+from sett.utils import Tempdir
 
 from sett.task_loaders import (
     TaskAlternative,
+    TaskIndex,
     RegexpTaskLoader,
 )
 
@@ -54,3 +56,46 @@ class TestTaskAlternative(unittest.TestCase):
             pass
 
         assert self.ta['a'] is b
+
+
+class TestTaskIndex(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = Tempdir()
+        self.index_file = self.tempdir.open().joinpath('cache/tasks.json')
+        self.index = TaskIndex(self.index_file, {'git': [100.0, 20]})
+
+    def tearDown(self):
+        self.tempdir.close()
+
+    def _task(self, name):
+        def fn():
+            """Run a task. It does things"""
+        fn.__name__ = name
+        return Task(fn)
+
+    def test_load_missing(self):
+        assert self.index.load() is False
+
+    def test_update(self):
+        self.index.update({
+            'git': [self._task('git'), self._task('git_copy')],
+            'shell': [self._task('shell')],
+        }, [('shell', 20, 'shell'), ('shell', 10, 'django')], ['docker'])
+
+        self.assertEqual(self.index.modules('git'), ['git'])
+        self.assertEqual(self.index.modules('shell'), ['django', 'shell'])
+        self.assertEqual(self.index.modules('nope'), [])
+        self.assertEqual(self.index.eager_modules(), ['docker'])
+
+    def test_load(self):
+        self.index.update({'git': [self._task('git')]})
+
+        index = TaskIndex(self.index_file, {'git': [100.0, 20]})
+        assert index.load() is True
+        self.assertEqual(index.modules('git'), ['git'])
+
+    def test_load_out_of_date(self):
+        self.index.update({'git': [self._task('git')]})
+
+        index = TaskIndex(self.index_file, {'git': [101.0, 20]})
+        assert index.load() is False
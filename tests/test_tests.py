@@ -1,14 +1,24 @@
 # -*- coding: utf-8 -*-
 
 
+import json
 import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
 from sett.tests import (
     django_package_name_generator,
     django_module_name_generator,
     ignore_root_name_generator,
     standard_name_generator,
+    ShardedNosetests,
+    test_runner,
 )
+from sett.utils.fs import Tempdir
+from paver.easy import BuildFailure
+from paver.options import Bunch
 
 
 class Test_django_package_name_generator(unittest.TestCase):
@@ -81,3 +91,154 @@ class Test_standard_name_generator(unittest.TestCase):
     def test_method(self):
         self.assertEqual(standard_name_generator('auth.models.User.is_authenticated'),
                          'tests.test_auth.test_models:TestUser.test_is_authenticated')
+
+
+XUNIT = u"""<?xml version="1.0" encoding="UTF-8"?>
+<testsuite name="nosetests" tests="{tests}" errors="0" failures="{failures}" skip="0">{testcases}</testsuite>
+"""
+TESTCASE = u'<testcase classname="{}" name="{}" time="{}"></testcase>'
+
+
+class TestShardedNosetests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = Tempdir().__enter__()
+        for filename in ['tests/__init__.py', 'tests/test_a.py', 'tests/test_b.py', 'tests/helpers.py',
+                         'tests/sub/__init__.py', 'tests/sub/test_c.py', 'tests/data/test_d.py',
+                         'tests/models_test.py', 'tests/Test_e.py', 'tests/_test_f.py', 'tests/latest.py',
+                         'tests/functional_tests/test_g.py']:
+            self.tempdir.joinpath(filename).parent.makedirs_p()
+            self.tempdir.joinpath(filename).write_text(u'')
+        self.durations_file = self.tempdir.joinpath('durations.json')
+
+    def tearDown(self):
+        self.tempdir.rmtree()
+
+    def sharded(self, options=None, processes=2):
+        return ShardedNosetests(options or {'tests': ['tests']}, processes, self.durations_file)
+
+    def test_discover(self):
+        with self.tempdir:
+            self.assertEqual(self.sharded().discover(['tests', 'tests.test_a:TestA', 'other']), [
+                'tests/functional_tests', 'tests.Test_e', 'tests.models_test', 'tests.test_a', 'tests.test_b',
+                'tests.sub.test_c', 'tests.test_a:TestA', 'other',
+            ])
+
+    def test_discover_match(self):
+        with self.tempdir:
+            self.assertEqual(self.sharded({'tests': ['tests'], 'match': '^test_[ab]'}).discover(['tests']),
+                             ['tests.test_a', 'tests.test_b'])
+
+    def test_no_tests(self):
+        with self.assertRaises(BuildFailure):
+            self.sharded({'tests': []}, 4)()
+
+        with self.tempdir:
+            with self.assertRaises(BuildFailure):
+                self.sharded({'tests': ['tests.sub'], 'match': 'nothing'}, 4)()
+
+    def test_balance(self):
+        sharded = self.sharded(processes=2)
+        sharded.durations = {'a': 10, 'b': 6, 'c': 5, 'd': 1}
+        self.assertEqual(sharded.balance(['a', 'b', 'c', 'd', 'new']), [['a', 'c'], ['b', 'new', 'd']])
+
+        sharded.processes = 8
+        self.assertEqual(sharded.balance(['a', 'b']), [['a'], ['b']])
+
+    def test_arguments(self):
+        sharded = self.sharded({
+            'tests': ['tests'],
+            'with-xcoverage': True,
+            'xcoverage-file': 'coverage.xml',
+            'cover-erase': True,
+            'cover-package': ['sett', 'other'],
+            'verbosity': '0',
+        })
+        options = sharded.shard_options('shard-1.xml')
+        self.assertEqual(sharded.arguments(options, ['tests.test_a']), [
+            '--cover-package=sett',
+            '--cover-package=other',
+            '--verbosity=0',
+            '--with-coverage',
+            '--with-xunit',
+            '--xunit-file=shard-1.xml',
+            'tests.test_a',
+        ])
+
+    def write_xunit(self, name, testcases, failures=0):
+        xunit_file = self.tempdir.joinpath(name)
+        xunit_file.write_text(XUNIT.format(
+            tests=len(testcases),
+            failures=failures,
+            testcases=''.join(TESTCASE.format(*testcase) for testcase in testcases),
+        ))
+        return xunit_file
+
+    def test_merge_xunit(self):
+        sharded = self.sharded()
+        sharded.durations = {'tests.test_b': 3.0}
+        report = sharded.merge_xunit([
+            self.write_xunit('shard-1.xml', [
+                ('tests.test_a.TestA', 'test_x', '1.5'),
+                ('tests.test_a.TestA', 'test_y', '0.5'),
+                ('nose.failure.Failure', 'runTest', '0.0'),
+            ], failures=1),
+            self.write_xunit('shard-2.xml', [('tests.sub.test_c.TestC', 'test_z', '0.25')]),
+            self.tempdir.joinpath('missing.xml'),
+        ], ['tests.test_a', 'tests.test_b', 'tests.sub.test_c'])
+        report, unreadable = report
+        self.assertEqual(unreadable, [self.tempdir.joinpath('missing.xml')])
+
+        suite = report.getroot()
+        self.assertEqual((suite.get('tests'), suite.get('failures')), ('4', '1'))
+        self.assertEqual(len(suite.findall('testcase')), 4)
+        self.assertEqual(sharded.durations, {'tests.test_a': 2.0, 'tests.test_b': 3.0, 'tests.sub.test_c': 0.25})
+
+        sharded.save_durations()
+        self.assertEqual(json.loads(self.durations_file.text())['tests.test_a'], 2.0)
+
+    def test_call(self):
+        xunit_file = self.tempdir.joinpath('nosetests.xml')
+        sharded = self.sharded({'tests': ['tests'], 'with-xunit': True, 'xunit-file': xunit_file})
+
+        def run_shard(job):
+            number, tests, shard_xunit_file = job
+            self.write_xunit(shard_xunit_file, [(test + '.Test', 'test', '1') for test in tests])
+            return number, 0 if number == 1 else 1
+
+        with mock.patch.object(sharded, '_run_shard', side_effect=run_shard), self.tempdir:
+            with mock.patch('sett.tests.info'):
+                with self.assertRaises(Exception) as raised:
+                    sharded()
+        self.assertIn('shards 2', str(raised.exception))
+        self.assertEqual(sorted(sharded.durations), [
+            'tests.Test_e', 'tests.models_test', 'tests.sub.test_c', 'tests.test_a', 'tests.test_b',
+            'tests/functional_tests'])
+        self.assertEqual(xunit_file.text().count('<testcase'), 6)
+
+    def test_call_unreported(self):
+        sharded = self.sharded({'tests': ['tests']})
+
+        def run_shard(job):
+            number, tests, shard_xunit_file = job
+            if number == 1:
+                self.write_xunit(shard_xunit_file, [(test + '.Test', 'test', '1') for test in tests])
+            return number, 0
+
+        with mock.patch.object(sharded, '_run_shard', side_effect=run_shard), self.tempdir:
+            with mock.patch('sett.tests.info'):
+                with self.assertRaises(BuildFailure) as raised:
+                    sharded()
+        self.assertIn('shards 2 did not report', str(raised.exception))
+
+
+class TestTestRunner(unittest.TestCase):
+    @mock.patch('sett.tests.info')
+    @mock.patch('sett.tests.call_task')
+    @mock.patch('sett.tests.ShardedNosetests')
+    def test_no_tests_serial(self, ShardedNosetests, call_task, info):
+        test_runner.func(Bunch(test_runner=Bunch({'tests': [], 'processes': 4})))
+        call_task.assert_called_once_with('nosetests', options={'tests': []})
+        self.assertFalse(ShardedNosetests.default.called)
+
+        test_runner.func(Bunch(test_runner=Bunch({'tests': ['tests'], 'processes': 4})))
+        ShardedNosetests.default.assert_called_once_with({'tests': ['tests']}, 4)
@@ -8,7 +8,7 @@ except ImportError:
     import mock
 
 
-from sett.utils.fs import Tempdir, LineReplacer
+from sett.utils.fs import Tempdir, LineReplacer, makedirs
 
 
 def test_Tempdir():
@@ -22,6 +22,21 @@ def test_Tempdir():
         assert not tdir.exists(), 'Tempdir was not deleted'
 
 
+def test_makedirs():
+    with Tempdir() as tdir:
+        makedirs(tdir.joinpath('a/b'))
+        makedirs(tdir.joinpath('a/b'))
+        assert tdir.joinpath('a/b').isdir()
+
+        tdir.joinpath('file').write_text(u'')
+        try:
+            makedirs(tdir.joinpath('file'))
+        except OSError:
+            pass
+        else:
+            raise AssertionError('should have raised OSError')
+
+
 class TestLineReplacer(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import unittest
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+from paver.deps.six import moves
+
+from sett.utils.fs import Tempdir
+from sett.utils.watch import Watcher, BaseBackend, InotifyBackend, get_backend
+
+
+class FakeBackend(BaseBackend):
+    def watch(self, path):
+        pass
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class TestWatcher(unittest.TestCase):
+    def setUp(self):
+        mock.patch.dict('sett.utils.watch.BACKENDS', {'fake': FakeBackend}).start()
+        self.batches = moves.queue.Queue()
+        self.on_overflow = mock.Mock()
+
+    def tearDown(self):
+        mock.patch.stopall()
+
+    def watcher(self, **kw):
+        return Watcher(['/src/'], self.batches.put, backend='fake', on_overflow=self.on_overflow, **kw)
+
+    def test_coalesce(self):
+        watcher = self.watcher()
+        with watcher:
+            for path in ['/src/a.scss', '/src/b.scss', '/src/a.scss']:
+                watcher.backend.callback(path)
+            batch = self.batches.get(timeout=2)
+        self.assertEqual(batch, ['/src/a.scss', '/src/b.scss'])
+        self.assertTrue(self.batches.empty())
+
+    def test_batches(self):
+        watcher = self.watcher()
+        with watcher:
+            watcher.backend.callback('/src/a.scss')
+            self.assertEqual(self.batches.get(timeout=2), ['/src/a.scss'])
+            watcher.backend.callback('/src/b.scss')
+            self.assertEqual(self.batches.get(timeout=2), ['/src/b.scss'])
+
+    def test_adaptive_debounce(self):
+        watcher = self.watcher()
+        with watcher:
+            # Gaps longer than the initial quiet period
+            for path in ['/src/a.scss', '/src/b.scss', '/src/c.scss']:
+                watcher.backend.callback(path)
+                time.sleep(0.04)
+            batch = self.batches.get(timeout=2)
+        self.assertEqual(batch, ['/src/a.scss', '/src/b.scss', '/src/c.scss'])
+
+    def test_patterns(self):
+        watcher = self.watcher(patterns=['*.scss', '/src/vendor/*'])
+        with watcher:
+            for path in ['/src/a.scss', '/src/a.scss~', '/src/vendor/lib.js', '/src/app.js']:
+                watcher.backend.callback(path)
+            batch = self.batches.get(timeout=2)
+        self.assertEqual(batch, ['/src/a.scss', '/src/vendor/lib.js'])
+
+    def test_overflow(self):
+        watcher = self.watcher()
+        with watcher:
+            watcher.backend.callback('/src/a.scss')
+            watcher.backend.callback(None)
+            time.sleep(.2)
+        self.on_overflow.assert_called_once_with()
+        self.assertTrue(self.batches.empty())
+
+    def test_get_backend(self):
+        self.assertEqual(get_backend('fake'), FakeBackend)
+        with self.assertRaises(ValueError):
+            get_backend('unknown')
+
+
+@unittest.skipUnless(InotifyBackend.available(), 'inotify is not available')
+class TestInotifyBackend(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = Tempdir().open()
+        self.events = moves.queue.Queue()
+        self.backend = InotifyBackend(self.events.put)
+        self.backend.watch(self.tempdir)
+        self.backend.start()
+
+    def tearDown(self):
+        self.backend.stop()
+        self.tempdir.rmtree()
+
+    def get_events(self):
+        events = set()
+        try:
+            while True:
+                events.add(self.events.get(timeout=.2))
+        except moves.queue.Empty:
+            return events
+
+    def test_write(self):
+        with open(self.tempdir.joinpath('a.scss'), 'w') as file:
+            file.write('a {}')
+        self.assertEqual(self.get_events(), {self.tempdir.joinpath('a.scss')})
+
+    def test_rename(self):
+        with open(self.tempdir.joinpath('.a.scss.swp'), 'w') as file:
+            file.write('a {}')
+        self.get_events()
+
+        os.rename(self.tempdir.joinpath('.a.scss.swp'), self.tempdir.joinpath('a.scss'))
+        self.assertEqual(self.get_events(), {
+            self.tempdir.joinpath('.a.scss.swp'),
+            self.tempdir.joinpath('a.scss'),
+        })
+
+    def test_delete(self):
+        self.tempdir.joinpath('a.scss').write_text(u'')
+        self.get_events()
+
+        os.unlink(self.tempdir.joinpath('a.scss'))
+        self.assertEqual(self.get_events(), {self.tempdir.joinpath('a.scss')})
+
+    def test_new_directory(self):
+        os.mkdir(self.tempdir.joinpath('sub'))
+        self.get_events()
+
+        with open(self.tempdir.joinpath('sub/b.scss'), 'w') as file:
+            file.write('b {}')
+        self.assertEqual(self.get_events(), {self.tempdir.joinpath('sub/b.scss')})
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+import time
+import importlib
+import threading
+import unittest
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+from paver.easy import BuildFailure
+
+from sett.utils.fs import Tempdir
+from sett.watch import WatchRule, TaskWatcher
+
+from tests.test_utils.test_watch import FakeBackend
+
+watch = importlib.import_module('sett.watch')
+
+
+class TestWatchRule(unittest.TestCase):
+    def setUp(self):
+        self.root = mock.patch.object(watch, 'ROOT', Tempdir().__enter__()).start()
+
+    def tearDown(self):
+        mock.patch.stopall()
+        self.root.rmtree()
+
+    def test_from_tuple(self):
+        self.assertEqual(WatchRule.from_tuple(('compass/*.scss', 'sassc_compile')),
+                         WatchRule('compass/*.scss', 'sassc_compile', None, None))
+
+    def test_directory(self):
+        self.assertEqual(WatchRule.from_tuple(('static/js/app/*.js', 'rjs')).directory,
+                         self.root.joinpath('static/js/app'))
+        self.assertEqual(WatchRule.from_tuple(('compass/[a-z]*/*.scss', 'sassc_compile')).directory,
+                         self.root.joinpath('compass'))
+
+    def test_format(self):
+        rule = WatchRule.from_tuple(('static/js/app/*.js', 'rjs', 'app/{name}', 'paths'))
+        self.assertEqual(rule.format(self.root.joinpath('static/js/app/main.js')), 'app/main')
+
+    def test_format_relname(self):
+        rule = WatchRule.from_tuple(('scripts/js/**/*.js', 'uglify', '{relname}'))
+        self.assertEqual(rule.format(self.root.joinpath('scripts/js/lib/utils.js')), 'lib/utils')
+        self.assertEqual(rule.format(self.root.joinpath('scripts/js/main.js')), 'main')
+
+    def test_match(self):
+        rule = WatchRule.from_tuple(('scripts/js/*.js', 'uglify'))
+        self.assertTrue(rule.match('scripts/js/main.js'))
+        self.assertFalse(rule.match('scripts/js/lib/utils.js'))
+
+        rule = WatchRule.from_tuple(('scripts/**/*.js', 'uglify'))
+        self.assertTrue(rule.match('scripts/main.js'))
+        self.assertTrue(rule.match('scripts/js/lib/utils.js'))
+        self.assertFalse(rule.match('static/js/main.js'))
+
+
+class TestTaskWatcher(unittest.TestCase):
+    def setUp(self):
+        mock.patch.dict('sett.utils.watch.BACKENDS', {'fake': FakeBackend}).start()
+        self.root = mock.patch.object(watch, 'ROOT', Tempdir().__enter__()).start()
+        self.root.joinpath('compass').makedirs()
+        self.root.joinpath('scripts/js').makedirs()
+        self.call_task = mock.patch.object(watch, 'environment').start().call_task
+
+        self.watcher = TaskWatcher([WatchRule.from_tuple(rule) for rule in [
+            ('compass/**/*.scss', 'sassc_compile'),
+            ('scripts/js/**/*.js', 'uglify', '{relname}'),
+            ('static/js/app/*.js', 'rjs', 'app/{name}', 'paths'),
+            ('static/js/app/*.js', 'jshint', '{relpath}'),
+        ]], backend='fake')
+
+    def tearDown(self):
+        mock.patch.stopall()
+        self.root.rmtree()
+
+    def test_paths(self):
+        self.assertEqual(self.watcher.paths, [self.root.joinpath('compass'), self.root.joinpath('scripts/js')])
+
+    def test_no_directory(self):
+        with self.assertRaises(BuildFailure):
+            TaskWatcher([WatchRule.from_tuple(('static/js/app/*.js', 'rjs'))], backend='fake')
+
+    def test_match(self):
+        self.assertTrue(self.watcher.match(self.root.joinpath('compass/main.scss')))
+        self.assertTrue(self.watcher.match(self.root.joinpath('compass/pages/page.scss')))
+        self.assertFalse(self.watcher.match(self.root.joinpath('compass/main.scss~')))
+        self.assertFalse(self.watcher.match(self.root.joinpath('scripts/main.js')))
+        self.assertFalse(self.watcher.match(self.root.joinpath('static/js/app/lib/utils.js')))
+
+    def test_build(self):
+        self.watcher.build([
+            self.root.joinpath('compass/main.scss'),
+            self.root.joinpath('compass/_colors.scss'),
+            self.root.joinpath('scripts/js/a.js'),
+            self.root.joinpath('scripts/js/lib/b.js'),
+            self.root.joinpath('static/js/app/main.js'),
+        ])
+        self.assertEqual(self.call_task.call_count, 4)
+        self.call_task.assert_has_calls([
+            mock.call('sassc_compile'),
+            mock.call('uglify', args=['a', 'lib/b']),
+            mock.call('rjs', options={'paths': ['app/main']}),
+            mock.call('jshint', args=['static/js/app/main.js']),
+        ], any_order=True)
+
+    def test_build_args_sequential(self):
+        lock = threading.Lock()
+        running = []
+        overlaps = []
+
+        def call_task(name, args=None, options=None):
+            if args is None:
+                return
+            with lock:
+                overlaps.append(bool(running))
+                running.append(name)
+            time.sleep(0.05)
+            with lock:
+                running.remove(name)
+
+        self.call_task.side_effect = call_task
+        self.watcher.build([
+            self.root.joinpath('compass/main.scss'),
+            self.root.joinpath('scripts/js/a.js'),
+            self.root.joinpath('static/js/app/main.js'),
+        ])
+        self.assertEqual(overlaps, [False, False])
+
+    def test_build_nothing(self):
+        self.watcher.build([self.root.joinpath('README.md')])
+        self.assertFalse(self.call_task.called)
+
+    def test_build_failure(self):
+        self.call_task.side_effect = [BuildFailure('sass'), None]
+        with self.assertRaises(RuntimeError):
+            self.watcher.build([
+                self.root.joinpath('compass/main.scss'),
+                self.root.joinpath('scripts/js/a.js'),
+            ])
+        self.assertEqual(self.call_task.call_count, 2)